@@ -0,0 +1,297 @@
+import asyncio
+import json
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+from multiprocessing.connection import Connection
+from multiprocessing.synchronize import Event
+
+from app.client import create_client
+from app.proxy import Impairment, start_proxy
+from app.tcp.tcp_server import TCPServer
+from app.udp.sim import LINK_MTU, percentile
+from app.udp.udp_server import UDPServer
+
+HOST = "127.0.0.1"
+BASE_PORT = 18080
+PROTOCOLS = ("tcp", "udp")
+SIZES = (64 << 10, 1 << 20, 16 << 20)
+ECHO_ROUNDS = 50
+STARTUP_TIMEOUT = 10.0
+COMPLETION_TIMEOUT = 30.0
+POLL_INTERVAL = 0.001
+RESULT_TIMEOUT = 300.0
+FILL_CHUNK_SIZE = 1 << 20
+GIB = 1 << 30
+
+LINKS = {
+    "direct": None,
+    "loopback": Impairment(),
+    "lan": Impairment(delay=0.0005, jitter=0.0002),
+    "wan": Impairment(
+        delay=0.02,
+        jitter=0.002,
+        loss=0.001,
+        duplicate=0.001,
+        reorder=0.01,
+        mtu=LINK_MTU,
+    ),
+    "lossy": Impairment(
+        delay=0.01, jitter=0.005, loss=0.02, duplicate=0.01, reorder=0.02, mtu=LINK_MTU
+    ),
+}
+
+
+def cpu_time(pid: int) -> float | None:
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+    except OSError:
+        return None
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+
+def fill_file(path: str, size: int):
+    with open(path, "wb") as f:
+        remaining = size
+        while remaining:
+            n = min(FILL_CHUNK_SIZE, remaining)
+            f.write(os.urandom(n))
+            remaining -= n
+
+
+def wait_for_file(path: str, size: int, timeout: float) -> bool:
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            if os.path.getsize(path) == size:
+                return True
+        except FileNotFoundError:
+            pass
+        if time.monotonic() >= deadline:
+            return False
+        time.sleep(POLL_INTERVAL)
+
+
+def silence():
+    sys.stdout = open(os.devnull, "w")
+
+
+def run_server(protocol: str, port: int, base_dir: str, ready: Event):
+    silence()
+    if protocol == "tcp":
+        server = TCPServer(HOST, port, base_dir)
+    else:
+        server = UDPServer(HOST, port, base_dir)
+    ready.set()
+    server.start()
+
+
+def run_proxy(
+    protocol: str, port: int, target_port: int, impairment: Impairment, ready: Event
+):
+    async def main():
+        await start_proxy(protocol, (HOST, port), (HOST, target_port), impairment)
+        ready.set()
+        await asyncio.Event().wait()
+
+    asyncio.run(main())
+
+
+def run_client(
+    protocol: str,
+    port: int,
+    server_dir: str,
+    client_dir: str,
+    sizes: list[int],
+    rounds: int,
+    server_pid: int,
+    results: Connection,
+):
+    silence()
+    os.chdir(client_dir)
+    client = create_client(protocol, HOST, port)
+    try:
+        if protocol == "tcp":
+            client.connect()
+
+        samples = []
+        for _ in range(rounds):
+            start = time.perf_counter()
+            client.handle_command("ECHO ping")
+            samples.append(time.perf_counter() - start)
+        samples.sort()
+        results.send(
+            {
+                "op": "echo",
+                "rounds": len(samples),
+                "p50": percentile(samples, 0.5),
+                "p90": percentile(samples, 0.9),
+                "p99": percentile(samples, 0.99),
+            }
+        )
+
+        for size in sizes:
+            for op in ("download", "upload"):
+                results.send(measure(client, op, size, server_dir, server_pid))
+    except Exception as e:
+        results.send({"op": "error", "error": f"{type(e).__name__}: {e}"})
+    finally:
+        client.sock.close()
+        results.send(None)
+
+
+def measure(client, op: str, size: int, server_dir: str, server_pid: int) -> dict:
+    if op == "download":
+        filename = f"dl_{size}.bin"
+        target = filename
+    else:
+        filename = f"ul_{size}.bin"
+        target = os.path.join(server_dir, filename)
+
+    client_cpu = time.process_time()
+    server_cpu = cpu_time(server_pid)
+    start = time.time()
+    client.handle_command(f"{op.upper()} {filename}")
+    completed = wait_for_file(target, size, COMPLETION_TIMEOUT)
+    elapsed = time.time() - start
+    client_cpu = time.process_time() - client_cpu
+    if server_cpu is not None:
+        server_cpu = cpu_time(server_pid) - server_cpu
+
+    if completed:
+        os.remove(target)
+
+    ttfb = None
+    if op == "download" and client.first_byte_time is not None:
+        ttfb = client.first_byte_time - start
+
+    cpu = client_cpu + (server_cpu or 0.0)
+    return {
+        "op": op,
+        "size": size,
+        "completed": completed,
+        "time": elapsed,
+        "ttfb": ttfb,
+        "goodput": size / elapsed if completed and elapsed else 0.0,
+        "client_cpu": client_cpu,
+        "server_cpu": server_cpu,
+        "cpu_per_gib": cpu * GIB / size if size else 0.0,
+    }
+
+
+def start_process(target, *args) -> multiprocessing.Process:
+    ready = multiprocessing.Event()
+    process = multiprocessing.Process(target=target, args=(*args, ready), daemon=True)
+    process.start()
+    if not ready.wait(STARTUP_TIMEOUT):
+        process.kill()
+        raise TimeoutError(f"{target.__name__} did not start")
+    return process
+
+
+def benchmark(
+    protocol: str,
+    impairment: Impairment | None,
+    port: int,
+    sizes: list[int],
+    rounds: int,
+    root: str,
+):
+    server_dir = os.path.join(root, "server")
+    client_dir = os.path.join(root, "client")
+    processes = []
+    try:
+        server = start_process(run_server, protocol, port, server_dir)
+        processes.append(server)
+        client_port = port
+        if impairment is not None:
+            client_port = port + 1
+            processes.append(
+                start_process(run_proxy, protocol, client_port, port, impairment)
+            )
+
+        receiver, sender = multiprocessing.Pipe(duplex=False)
+        client = multiprocessing.Process(
+            target=run_client,
+            args=(
+                protocol,
+                client_port,
+                server_dir,
+                client_dir,
+                sizes,
+                rounds,
+                server.pid,
+                sender,
+            ),
+            daemon=True,
+        )
+        client.start()
+        processes.append(client)
+        sender.close()
+
+        while receiver.poll(RESULT_TIMEOUT):
+            try:
+                result = receiver.recv()
+            except EOFError:
+                break
+            if result is None:
+                break
+            yield result
+        else:
+            yield {"op": "error", "error": "Benchmark timed out"}
+    finally:
+        for process in reversed(processes):
+            process.kill()
+            process.join()
+
+
+def main(protocols: list[str], links: list[str], sizes: list[int]):
+    start = time.perf_counter()
+    count = 0
+    with tempfile.TemporaryDirectory() as root:
+        os.makedirs(os.path.join(root, "server"))
+        os.makedirs(os.path.join(root, "client"))
+        for size in sizes:
+            fill_file(os.path.join(root, "server", f"dl_{size}.bin"), size)
+            fill_file(os.path.join(root, "client", f"ul_{size}.bin"), size)
+
+        port = BASE_PORT
+        for protocol in protocols:
+            for link in links:
+                impairment = LINKS[link]
+                params = {}
+                if impairment is not None:
+                    params = impairment.as_dict()
+                    params["ignored"] = impairment.ignored(protocol)
+                for result in benchmark(
+                    protocol, impairment, port, sizes, ECHO_ROUNDS, root
+                ):
+                    print(
+                        json.dumps(
+                            {"protocol": protocol, "link": link, **params, **result}
+                        ),
+                        flush=True,
+                    )
+                    count += 1
+                port += 2
+    print(f"{count} results in {time.perf_counter() - start:.1f} s", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    protocol = sys.argv[1] if len(sys.argv) > 1 else "all"
+    link = sys.argv[2] if len(sys.argv) > 2 else "all"
+    sizes = [int(arg) for arg in sys.argv[3:]] or list(SIZES)
+
+    if protocol not in ("all", *PROTOCOLS) or link not in ("all", *LINKS):
+        print(
+            "Usage: python bench.py [tcp | udp | all] "
+            f"[{' | '.join(LINKS)} | all] [size ...]"
+        )
+        sys.exit(1)
+
+    protocols = list(PROTOCOLS) if protocol == "all" else [protocol]
+    links = list(LINKS) if link == "all" else [link]
+    main(protocols, links, sizes)
@@ -13,15 +13,19 @@ def create_client(protocol, ip, port) -> TCPClient | UDPClient:
 
 if __name__ == "__main__":
     if len(sys.argv) < 4:
-        print("Usage: python client.py {tcp | udp} <ip> <port>")
+        print("Usage: python client.py {tcp | udp} <ip> <port> [command ...]")
         sys.exit(1)
 
     protocol = sys.argv[1]
     ip = sys.argv[2]
     port = int(sys.argv[3])
+    commands = sys.argv[4:]
 
     try:
         client = create_client(protocol, ip, port)
-        client.start()
+        if commands:
+            client.run(commands)
+        else:
+            client.start()
     except OSError as e:
         print(f"Error: {e}")
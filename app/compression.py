@@ -0,0 +1,232 @@
+import queue
+import struct
+import threading
+import zlib
+from collections.abc import Callable
+from typing import BinaryIO
+
+try:
+    import bz2
+except ImportError:
+    bz2 = None
+
+try:
+    import lzma
+except ImportError:
+    lzma = None
+
+COMPRESSION: str | None = None
+COMPRESSION_LEVEL = 6
+BLOCK_SIZE = 1 << 20
+SAMPLE_SIZE = 64 << 10
+SAMPLE_SLICES = 4
+SKIP_RATIO = 0.9
+QUEUE_SIZE = 4
+QUEUE_TIMEOUT = 0.1
+
+CODEC_NONE = 0
+CODEC_ZLIB = 1
+CODEC_LZMA = 2
+CODEC_BZ2 = 3
+
+KIND_RAW = 0
+KIND_COMPRESSED = 1
+
+BLOCK = struct.Struct("!BI")
+
+CODECS = {"zlib": CODEC_ZLIB}
+if lzma is not None:
+    CODECS["lzma"] = CODEC_LZMA
+if bz2 is not None:
+    CODECS["bz2"] = CODEC_BZ2
+
+
+def supported_mask() -> int:
+    mask = 0
+    for codec in CODECS.values():
+        mask |= 1 << codec
+    return mask
+
+
+def choose_codec(name: str | None, mask: int) -> int:
+    codec = CODECS.get(name or "", CODEC_NONE)
+    if not mask & (1 << codec):
+        return CODEC_NONE
+    return codec
+
+
+def parse_setting(arg: str) -> tuple[str | None, int]:
+    parts = arg.split()
+    if not parts or len(parts) > 2:
+        raise ValueError("Usage: COMPRESS {off | " + " | ".join(CODECS) + "} [level]")
+    name = parts[0].lower()
+    if name != "off" and name not in CODECS:
+        raise ValueError(f"Unknown codec '{name}'")
+    level = int(parts[1]) if len(parts) > 1 else COMPRESSION_LEVEL
+    if not 0 <= level <= 9:
+        raise ValueError("Compression level must be between 0 and 9")
+    return (None if name == "off" else name), level
+
+
+def accept_codec(codec: int) -> int:
+    return codec if codec in CODECS.values() else CODEC_NONE
+
+
+def compress(codec: int, level: int, data: bytes) -> bytes:
+    if codec == CODEC_ZLIB:
+        return zlib.compress(data, min(level, 9))
+    if codec == CODEC_LZMA:
+        return lzma.compress(data, preset=min(level, 9))
+    if codec == CODEC_BZ2:
+        return bz2.compress(data, max(1, min(level, 9)))
+    raise ValueError(f"Unknown codec {codec}")
+
+
+def decompress(codec: int, data: bytes | memoryview, max_length: int) -> bytes:
+    if codec == CODEC_ZLIB:
+        decompressor = zlib.decompressobj()
+    elif codec == CODEC_LZMA:
+        decompressor = lzma.LZMADecompressor()
+    elif codec == CODEC_BZ2:
+        decompressor = bz2.BZ2Decompressor()
+    else:
+        raise ValueError(f"Unknown codec {codec}")
+    out = decompressor.decompress(data, max_length + 1)
+    if len(out) > max_length or not decompressor.eof:
+        raise ValueError("Compressed block exceeds its declared size")
+    return out
+
+
+def sample_ratio(data: bytes) -> float:
+    if len(data) <= SAMPLE_SIZE:
+        sample = data
+    else:
+        step = len(data) // SAMPLE_SLICES
+        size = SAMPLE_SIZE // SAMPLE_SLICES
+        sample = b"".join(
+            data[i * step : i * step + size] for i in range(SAMPLE_SLICES)
+        )
+    if not sample:
+        return 1.0
+    return len(zlib.compress(sample, 1)) / len(sample)
+
+
+def encode_block(codec: int, level: int, data: bytes) -> bytes:
+    if sample_ratio(data) < SKIP_RATIO:
+        packed = compress(codec, level, data)
+        if len(packed) < len(data):
+            return BLOCK.pack(KIND_COMPRESSED, len(data)) + packed
+    return BLOCK.pack(KIND_RAW, len(data)) + data
+
+
+def decode_block(codec: int, frame: bytes) -> bytes | memoryview:
+    kind, size = BLOCK.unpack_from(frame)
+    payload = memoryview(frame)[BLOCK.size :]
+    if size > BLOCK_SIZE:
+        raise ValueError("Block is larger than the block size")
+    if kind == KIND_RAW:
+        if len(payload) != size:
+            raise ValueError("Raw block has unexpected size")
+        return payload
+    data = decompress(codec, payload, size)
+    if len(data) != size:
+        raise ValueError("Compressed block has unexpected size")
+    return data
+
+
+def send_file(
+    channel,
+    f: BinaryIO,
+    offset: int,
+    end: int,
+    codec: int,
+    level: int,
+    progress: Callable[[int, int], None],
+):
+    blocks: queue.Queue = queue.Queue(QUEUE_SIZE)
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                blocks.put(item, timeout=QUEUE_TIMEOUT)
+                return
+            except queue.Full:
+                pass
+
+    def produce():
+        try:
+            pos = offset
+            f.seek(offset)
+            while pos < end and not stop.is_set():
+                data = f.read(min(BLOCK_SIZE, end - pos))
+                if not data:
+                    break
+                put((len(data), encode_block(codec, level, data)))
+                pos += len(data)
+        except Exception as e:
+            put(e)
+        put(None)
+
+    worker = threading.Thread(target=produce, daemon=True)
+    worker.start()
+    try:
+        while (item := blocks.get()) is not None:
+            if isinstance(item, Exception):
+                raise item
+            size, frame = item
+            channel.send(frame)
+            progress(size, len(frame))
+        channel.flush()
+    finally:
+        stop.set()
+        worker.join()
+
+
+def recv_file(
+    channel,
+    f: BinaryIO,
+    offset: int,
+    end: int,
+    codec: int,
+    progress: Callable[[int, int], None],
+    sink: Callable[[int, bytes], None] | None = None,
+):
+    frames: queue.Queue = queue.Queue(QUEUE_SIZE)
+    errors: list[Exception] = []
+
+    def consume():
+        pos = offset
+        while (frame := frames.get()) is not None:
+            if errors:
+                continue
+            try:
+                data = decode_block(codec, frame)
+                f.write(data)
+                if sink is not None:
+                    sink(pos, data)
+                pos += len(data)
+            except Exception as e:
+                errors.append(e)
+
+    f.seek(offset)
+    worker = threading.Thread(target=consume, daemon=True)
+    worker.start()
+    try:
+        received = offset
+        while received < end:
+            frame = channel.recv()
+            _, size = BLOCK.unpack_from(frame)
+            frames.put(frame)
+            received += size
+            progress(size, len(frame))
+    finally:
+        frames.put(None)
+        worker.join()
+    if errors:
+        raise errors[0]
+
+
+def print_ratio(raw: int, wire: int):
+    if raw:
+        print(f"Compression: {raw} bytes sent as {wire} ({wire / raw:.1%})")
@@ -0,0 +1,332 @@
+import hashlib
+import json
+import math
+import os
+import struct
+import threading
+import time
+from collections.abc import Callable
+
+import app.protocol as proto
+
+USE_DEDUP = False
+STORE_DIR = ".store"
+CHUNK_SIZE = 1 << 20
+DIGEST_SIZE = 32
+DIGEST_BATCH = 4096
+
+SIZE = struct.Struct("!Q")
+
+
+def chunk_digest(data: bytes | memoryview) -> bytes:
+    return hashlib.blake2b(data, digest_size=DIGEST_SIZE).digest()
+
+
+def file_digests(path: str, known: list[bytes | None] | None = None) -> list[bytes]:
+    count = chunk_count(os.path.getsize(path))
+    if known is None or len(known) != count:
+        known = [None] * count
+    digests = []
+    with open(path, "rb") as f:
+        for i, digest in enumerate(known):
+            if digest is None:
+                f.seek(i * CHUNK_SIZE)
+                digest = chunk_digest(f.read(CHUNK_SIZE))
+            digests.append(digest)
+    return digests
+
+
+def object_id(digests: list[bytes], size: int) -> str:
+    digest = hashlib.blake2b(SIZE.pack(size), digest_size=DIGEST_SIZE)
+    for chunk in digests:
+        digest.update(chunk)
+    return digest.hexdigest()
+
+
+def chunk_count(size: int) -> int:
+    return math.ceil(size / CHUNK_SIZE)
+
+
+def has_bit(bitmap: bytes, index: int) -> bool:
+    return bool(bitmap[index >> 3] >> (index & 7) & 1)
+
+
+class ChunkDigests:
+    def __init__(self, size: int):
+        self.size = size
+        self.digests: list[bytes | None] = [None] * chunk_count(size)
+        self.partial: dict[int, tuple[int, "hashlib.blake2b"]] = {}
+        self.lock = threading.Lock()
+
+    def update(self, offset: int, data: bytes | memoryview):
+        view = memoryview(data).cast("B")
+        while view:
+            index, pos = divmod(offset, CHUNK_SIZE)
+            n = min(len(view), CHUNK_SIZE - pos)
+            with self.lock:
+                state = self.partial.pop(index, None)
+            if pos == 0:
+                state = (0, hashlib.blake2b(digest_size=DIGEST_SIZE))
+            if state is not None and state[0] == pos:
+                digest = state[1]
+                digest.update(view[:n])
+                with self.lock:
+                    if pos + n == min(CHUNK_SIZE, self.size - index * CHUNK_SIZE):
+                        self.digests[index] = digest.digest()
+                    else:
+                        self.partial[index] = (pos + n, digest)
+            offset += n
+            view = view[n:]
+
+
+class ChunkStore:
+    def __init__(self, base_dir: str):
+        self.base_dir = base_dir
+        self.root = os.path.join(base_dir, STORE_DIR)
+        self.index_path = os.path.join(self.root, "index.json")
+        self.lock = threading.Lock()
+        self.files: dict[str, dict] = {}
+        self.chunks: dict[bytes, tuple[str, int, int]] = {}
+        os.makedirs(os.path.join(self.root, "objects"), exist_ok=True)
+        try:
+            with open(self.index_path) as f:
+                self.files = json.load(f)
+        except FileNotFoundError:
+            pass
+        self.rebuild()
+
+    def object_path(self, oid: str) -> str:
+        return os.path.join(self.root, "objects", oid[:2], oid)
+
+    def contains(self, path: str) -> bool:
+        return os.path.realpath(path).startswith(os.path.realpath(self.root))
+
+    def rebuild(self):
+        self.chunks.clear()
+        for entry in self.files.values():
+            size = entry["size"]
+            for i, digest in enumerate(entry["chunks"]):
+                offset = i * CHUNK_SIZE
+                length = min(CHUNK_SIZE, size - offset)
+                self.chunks[bytes.fromhex(digest)] = (entry["object"], offset, length)
+
+    def save(self):
+        temp_path = self.index_path + ".tmp"
+        with open(temp_path, "w") as f:
+            json.dump(self.files, f)
+        os.replace(temp_path, self.index_path)
+
+    def have(self, digests: list[bytes]) -> bytes:
+        bitmap = bytearray(math.ceil(len(digests) / 8))
+        with self.lock:
+            for i, digest in enumerate(digests):
+                if digest in self.chunks:
+                    bitmap[i >> 3] |= 1 << (i & 7)
+        return bytes(bitmap)
+
+    def read_chunk(self, digest: bytes) -> bytes | None:
+        with self.lock:
+            location = self.chunks.get(digest)
+        if location is None:
+            return None
+        oid, offset, length = location
+        try:
+            fd = os.open(self.object_path(oid), os.O_RDONLY)
+        except FileNotFoundError:
+            return None
+        try:
+            data = os.pread(fd, length, offset)
+        finally:
+            os.close(fd)
+        if chunk_digest(data) != digest:
+            return None
+        return data
+
+    def add(self, name: str, path: str, known: list[bytes | None] | None = None):
+        try:
+            digests = file_digests(path, known)
+            size = os.path.getsize(path)
+        except FileNotFoundError:
+            return
+        oid = object_id(digests, size)
+        obj_path = self.object_path(oid)
+
+        with self.lock:
+            if os.path.isfile(obj_path):
+                link_path = path + ".link"
+                try:
+                    os.link(obj_path, link_path)
+                    os.replace(link_path, path)
+                except OSError:
+                    pass
+            else:
+                os.makedirs(os.path.dirname(obj_path), exist_ok=True)
+                try:
+                    os.link(path, obj_path)
+                except OSError:
+                    return
+
+            previous = self.files.get(name)
+            self.files[name] = {
+                "object": oid,
+                "size": size,
+                "chunks": [digest.hex() for digest in digests],
+            }
+            for i, digest in enumerate(digests):
+                offset = i * CHUNK_SIZE
+                self.chunks[digest] = (oid, offset, min(CHUNK_SIZE, size - offset))
+            if previous is not None and previous["object"] != oid:
+                self.release(previous["object"])
+            self.save()
+
+    def release(self, oid: str):
+        if any(entry["object"] == oid for entry in self.files.values()):
+            return
+        try:
+            os.remove(self.object_path(oid))
+        except FileNotFoundError:
+            pass
+        self.rebuild()
+
+    def gc(self) -> int:
+        with self.lock:
+            for name, entry in list(self.files.items()):
+                path = os.path.join(self.base_dir, name)
+                try:
+                    if os.path.samefile(path, self.object_path(entry["object"])):
+                        continue
+                except FileNotFoundError:
+                    pass
+                del self.files[name]
+
+            referenced = {entry["object"] for entry in self.files.values()}
+            removed = 0
+            objects_dir = os.path.join(self.root, "objects")
+            for prefix in os.listdir(objects_dir):
+                for oid in os.listdir(os.path.join(objects_dir, prefix)):
+                    if oid not in referenced:
+                        os.remove(os.path.join(objects_dir, prefix, oid))
+                        removed += 1
+
+            self.rebuild()
+            self.save()
+        return removed
+
+
+def send_file(channel, path: str, name: str) -> bool:
+    print(f"Uploading file '{name}' with deduplication...")
+    start_time = time.time()
+    size = os.path.getsize(path)
+    digests = file_digests(path)
+    for i in range(0, len(digests), DIGEST_BATCH):
+        channel.send(b"".join(digests[i : i + DIGEST_BATCH]))
+    channel.flush()
+
+    bitmap = channel.recv()
+    sent = 0
+    done = 0
+    last_update = 0
+    proto.print_transfer_status(done, size)
+
+    with open(path, "rb") as f:
+        for i in range(len(digests)):
+            length = min(CHUNK_SIZE, size - i * CHUNK_SIZE)
+            if not has_bit(bitmap, i):
+                f.seek(i * CHUNK_SIZE)
+                channel.send(f.read(length))
+                sent += length
+            done += length
+
+            now = time.time()
+            if now - last_update > 1 or done == size:
+                proto.print_transfer_status(done, size)
+                last_update = now
+    channel.flush()
+
+    result = channel.recv()
+    if result[0] != proto.STATUS_OK:
+        print(f"\n{result[1:].decode()}")
+        return False
+
+    print("\nDone")
+    proto.print_data_speed(start_time, size)
+    print_dedup_stats(sent, size)
+    return True
+
+
+def receive_file(
+    channel,
+    store: ChunkStore,
+    name: str,
+    temp_path: str,
+    final_path: str,
+    size: int,
+    throttle: Callable[[int], None],
+):
+    print(f"Receiving file '{name}' with deduplication...")
+    start_time = time.time()
+    count = chunk_count(size)
+    digests = []
+    while len(digests) < count:
+        batch = channel.recv()
+        throttle(len(batch))
+        digests.extend(
+            bytes(batch[i : i + DIGEST_SIZE]) for i in range(0, len(batch), DIGEST_SIZE)
+        )
+
+    bitmap = store.have(digests)
+    channel.send(bitmap)
+    channel.flush()
+
+    error = None
+    received = 0
+    done = 0
+    last_update = 0
+
+    try:
+        with open(temp_path, "wb") as f:
+            for i, digest in enumerate(digests):
+                if has_bit(bitmap, i):
+                    data = store.read_chunk(digest)
+                    if data is None:
+                        error = error or f"ERR: Stored chunk {i} is missing or damaged"
+                        continue
+                else:
+                    data = channel.recv()
+                    received += len(data)
+                    throttle(len(data))
+                    if chunk_digest(data) != digest:
+                        error = error or f"ERR: Chunk {i} does not match its digest"
+                        continue
+                f.write(data)
+                done += len(data)
+
+                now = time.time()
+                if now - last_update > 1 or done == size:
+                    proto.print_transfer_status(done, size)
+                    last_update = now
+    except BaseException:
+        os.remove(temp_path)
+        raise
+
+    if error is None and os.path.getsize(temp_path) != size:
+        error = "ERR: Deduplicated file has unexpected size"
+    if error is not None:
+        os.remove(temp_path)
+        print(f"\n{error}")
+        channel.send(bytes([proto.STATUS_ERR]) + error.encode())
+        channel.flush()
+        return
+
+    os.replace(temp_path, final_path)
+    store.add(name, final_path, digests)
+    channel.send(bytes([proto.STATUS_OK]))
+    channel.flush()
+
+    print("\nDone")
+    proto.print_data_speed(start_time, size)
+    print_dedup_stats(received, size)
+
+
+def print_dedup_stats(transferred: int, total: int):
+    print(f"Dedup: {transferred} bytes transferred, {total - transferred} bytes reused")
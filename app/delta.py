@@ -0,0 +1,372 @@
+import hashlib
+import math
+import mmap
+import os
+import struct
+import time
+import zlib
+from collections.abc import Callable
+
+import app.protocol as proto
+
+USE_DELTA = True
+MIN_BLOCK_SIZE = 2048
+MAX_BLOCK_SIZE = 1 << 20
+DIGEST_SIZE = 16
+FILE_DIGEST_SIZE = 32
+SIGNATURE_BATCH = 4096
+LITERAL_SIZE = 1 << 20
+BATCH_SIZE = 1 << 20
+ROLL_MISSES = 2
+RESYNC_INTERVAL = 32
+ADLER_MOD = 65521
+
+HEADER = struct.Struct("!IQ")
+BLOCK = struct.Struct(f"!I{DIGEST_SIZE}s")
+COPY = struct.Struct("!BQI")
+DATA = struct.Struct("!BI")
+
+OP_END = 0
+OP_COPY = 1
+OP_DATA = 2
+
+
+class Signature:
+    def __init__(self, block_size: int, size: int):
+        self.block_size = block_size
+        self.size = size
+        self.blocks: dict[int, list[tuple[bytes, int]]] = {}
+        self.tail: tuple[int, bytes, int] | None = None
+
+    @property
+    def count(self) -> int:
+        return math.ceil(self.size / self.block_size)
+
+    def add(self, index: int, weak: int, strong: bytes):
+        if (index + 1) * self.block_size > self.size:
+            self.tail = (weak, strong, index)
+        else:
+            self.blocks.setdefault(weak, []).append((strong, index))
+
+    def find(self, weak: int, block: memoryview) -> int | None:
+        candidates = self.blocks.get(weak)
+        if candidates is None:
+            return None
+        strong = strong_digest(block)
+        for digest, index in candidates:
+            if digest == strong:
+                return index
+        return None
+
+    def find_tail(self, block: memoryview) -> int | None:
+        if self.tail is None or len(block) != self.size % self.block_size:
+            return None
+        weak, strong, index = self.tail
+        if zlib.adler32(block) == weak and strong_digest(block) == strong:
+            return index
+        return None
+
+
+def strong_digest(block: bytes | memoryview) -> bytes:
+    return hashlib.blake2b(block, digest_size=DIGEST_SIZE).digest()
+
+
+def block_size_for(size: int) -> int:
+    block = 1 << math.isqrt(size).bit_length()
+    return min(MAX_BLOCK_SIZE, max(MIN_BLOCK_SIZE, block))
+
+
+def send_signature(channel, path: str) -> int:
+    size = os.path.getsize(path)
+    block_size = block_size_for(size)
+    channel.send(HEADER.pack(block_size, size))
+
+    batch = []
+    with open(path, "rb") as f:
+        while block := f.read(block_size):
+            batch.append(BLOCK.pack(zlib.adler32(block), strong_digest(block)))
+            if len(batch) == SIGNATURE_BATCH:
+                channel.send(b"".join(batch))
+                batch.clear()
+    if batch:
+        channel.send(b"".join(batch))
+    channel.flush()
+    return block_size
+
+
+def recv_signature(channel) -> Signature:
+    block_size, size = HEADER.unpack(channel.recv())
+    signature = Signature(block_size, size)
+    index = 0
+    while index < signature.count:
+        for weak, strong in BLOCK.iter_unpack(channel.recv()):
+            signature.add(index, weak, strong)
+            index += 1
+    return signature
+
+
+class DeltaWriter:
+    def __init__(
+        self,
+        channel,
+        view: memoryview,
+        total: int,
+        throttle: Callable[[int], None] | None = None,
+    ):
+        self.channel = channel
+        self.throttle = throttle
+        self.view = view
+        self.total = total
+        self.batch: list[bytes | memoryview] = []
+        self.batch_size = 0
+        self.copy: tuple[int, int] | None = None
+        self.digest = hashlib.blake2b(digest_size=FILE_DIGEST_SIZE)
+        self.done = 0
+        self.literal = 0
+        self.last_update = 0
+
+    def add_literal(self, start: int, end: int):
+        if start >= end:
+            return
+        self.flush_copy()
+        while start < end:
+            stop = min(end, start + LITERAL_SIZE)
+            data = self.view[start:stop]
+            self.push(DATA.pack(OP_DATA, len(data)), data)
+            self.digest.update(data)
+            self.literal += len(data)
+            self.advance(len(data))
+            start = stop
+
+    def add_copy(self, index: int, offset: int, length: int):
+        self.digest.update(self.view[offset : offset + length])
+        if self.copy is not None and self.copy[0] + self.copy[1] == index:
+            self.copy = (self.copy[0], self.copy[1] + 1)
+        else:
+            self.flush_copy()
+            self.copy = (index, 1)
+        self.advance(length)
+
+    def flush_copy(self):
+        if self.copy is not None:
+            self.push(COPY.pack(OP_COPY, *self.copy))
+            self.copy = None
+
+    def push(self, *parts: bytes | memoryview):
+        for part in parts:
+            self.batch.append(part)
+            self.batch_size += len(part)
+        if self.batch_size >= BATCH_SIZE:
+            self.send_batch()
+
+    def send_batch(self):
+        if self.batch:
+            data = b"".join(self.batch)
+            if self.throttle is not None:
+                self.throttle(len(data))
+            self.channel.send(data)
+            self.batch.clear()
+            self.batch_size = 0
+
+    def advance(self, n: int):
+        self.done += n
+        now = time.time()
+        if now - self.last_update > 1 or self.done == self.total:
+            proto.print_transfer_status(self.done, self.total)
+            self.last_update = now
+
+    def finish(self):
+        self.flush_copy()
+        self.push(bytes([OP_END]), self.digest.digest())
+        self.send_batch()
+        self.channel.flush()
+
+
+def send_delta(
+    channel,
+    path: str,
+    signature: Signature,
+    throttle: Callable[[int], None] | None = None,
+) -> int:
+    size = os.path.getsize(path)
+    with open(path, "rb") as f:
+        if size:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            view = memoryview(data)
+        else:
+            data = None
+            view = memoryview(b"")
+        try:
+            writer = DeltaWriter(channel, view, size, throttle)
+            scan(writer, view, signature)
+            writer.finish()
+        finally:
+            view.release()
+            if data is not None:
+                data.close()
+    return writer.literal
+
+
+def scan(writer: DeltaWriter, view: memoryview, signature: Signature):
+    size = len(view)
+    block_size = signature.block_size
+    pos = 0
+    literal = 0
+    misses = 0
+
+    while pos + block_size <= size:
+        if pos - literal >= LITERAL_SIZE:
+            writer.add_literal(literal, pos)
+            literal = pos
+
+        block = view[pos : pos + block_size]
+        index = signature.find(zlib.adler32(block), block)
+        if index is None:
+            ahead = pos + block_size
+            nxt = view[ahead : ahead + block_size]
+            if (
+                len(nxt) == block_size
+                and signature.find(zlib.adler32(nxt), nxt) is not None
+            ):
+                pos = ahead
+                continue
+            if misses < ROLL_MISSES or misses % RESYNC_INTERVAL == 0:
+                end, index = roll(view, signature, pos, zlib.adler32(block))
+                pos = end if end > pos else pos + block_size
+            else:
+                pos += block_size
+        if index is None:
+            misses += 1
+            continue
+
+        misses = 0
+        writer.add_literal(literal, pos)
+        writer.add_copy(index, pos, block_size)
+        pos += block_size
+        literal = pos
+
+    index = signature.find_tail(view[pos:])
+    if index is None:
+        writer.add_literal(literal, size)
+    else:
+        writer.add_literal(literal, pos)
+        writer.add_copy(index, pos, size - pos)
+
+
+def roll(
+    view: memoryview, signature: Signature, pos: int, weak: int
+) -> tuple[int, int | None]:
+    block_size = signature.block_size
+    blocks = signature.blocks
+    a = weak & 0xFFFF
+    b = weak >> 16
+    limit = min(len(view) - block_size, pos + block_size)
+    while pos < limit:
+        out = view[pos]
+        a = (a - out + view[pos + block_size]) % ADLER_MOD
+        b = (b - block_size * out + a - 1) % ADLER_MOD
+        pos += 1
+        weak = (b << 16) | a
+        if weak in blocks:
+            index = signature.find(weak, view[pos : pos + block_size])
+            if index is not None:
+                return pos, index
+    return pos, None
+
+
+def send_file(
+    channel, path: str, name: str, throttle: Callable[[int], None] | None = None
+):
+    print(f"Sending delta of file '{name}'...")
+    start_time = time.time()
+    signature = recv_signature(channel)
+    literal = send_delta(channel, path, signature, throttle)
+    print("\nDone")
+    proto.print_data_speed(start_time, os.path.getsize(path))
+    print_delta_stats(literal, os.path.getsize(path))
+
+
+def receive_file(
+    channel,
+    basis_path: str,
+    temp_path: str,
+    final_path: str,
+    total: int,
+    throttle: Callable[[int], None] | None = None,
+    sink: Callable[[int, bytes | memoryview], None] | None = None,
+) -> bool:
+    print(f"Receiving delta of file '{os.path.basename(final_path)}'...")
+    start_time = time.time()
+    block_size = send_signature(channel, basis_path)
+    try:
+        literal = apply_delta(
+            channel, basis_path, temp_path, block_size, total, throttle, sink
+        )
+    except proto.ChecksumMismatch as e:
+        os.remove(temp_path)
+        print(f"\nERR: {e}")
+        return False
+    os.replace(temp_path, final_path)
+    print("\nDone")
+    proto.print_data_speed(start_time, total)
+    print_delta_stats(literal, total)
+    return True
+
+
+def print_delta_stats(literal: int, total: int):
+    print(f"Delta: {literal} literal bytes, {total - literal} bytes matched")
+
+
+def apply_delta(
+    channel,
+    basis_path: str,
+    out_path: str,
+    block_size: int,
+    total: int,
+    throttle: Callable[[int], None] | None = None,
+    sink: Callable[[int, bytes | memoryview], None] | None = None,
+) -> int:
+    digest = hashlib.blake2b(digest_size=FILE_DIGEST_SIZE)
+    done = 0
+    literal = 0
+    last_update = 0
+    expected = None
+
+    with open(basis_path, "rb") as basis, open(out_path, "wb") as out:
+        while expected is None:
+            msg = memoryview(channel.recv())
+            if throttle is not None:
+                throttle(len(msg))
+            offset = 0
+            while offset < len(msg):
+                op = msg[offset]
+                if op == OP_COPY:
+                    _, index, count = COPY.unpack_from(msg, offset)
+                    offset += COPY.size
+                    basis.seek(index * block_size)
+                    data = basis.read(count * block_size)
+                elif op == OP_DATA:
+                    _, length = DATA.unpack_from(msg, offset)
+                    offset += DATA.size
+                    data = msg[offset : offset + length]
+                    offset += length
+                    literal += length
+                elif op == OP_END:
+                    expected = bytes(msg[offset + 1 : offset + 1 + FILE_DIGEST_SIZE])
+                    break
+                else:
+                    raise ValueError(f"Unknown delta operation {op}")
+                out.write(data)
+                digest.update(data)
+                if sink is not None:
+                    sink(done, data)
+                done += len(data)
+
+                now = time.time()
+                if now - last_update > 1 or done == total:
+                    proto.print_transfer_status(done, total)
+                    last_update = now
+
+    if digest.digest() != expected:
+        raise proto.ChecksumMismatch("Delta result does not match the source file")
+    return literal
@@ -0,0 +1,261 @@
+import hashlib
+import json
+import math
+import os
+import secrets
+import threading
+import time
+
+import app.dedup as dedup
+import app.protocol as proto
+
+JOURNAL_DIR = ".journal"
+CHUNK_SIZE = 1 << 20
+EXPIRY = 7 * 24 * 60 * 60
+EXPIRE_INTERVAL = 60 * 60
+TOKEN_SIZE = 16
+STATE_DIR = os.path.join(
+    os.environ.get("XDG_STATE_HOME")
+    or os.path.join(os.path.expanduser("~"), ".local", "state"),
+    "sspoirs",
+)
+TOKEN_FILE = os.path.join(STATE_DIR, "transfer_token")
+
+KIND_DOWNLOAD = "download"
+KIND_UPLOAD = "upload"
+
+
+def valid_token(token: str) -> bool:
+    try:
+        return len(bytes.fromhex(token)) == TOKEN_SIZE
+    except ValueError:
+        return False
+
+
+def load_token(path: str = TOKEN_FILE) -> str:
+    try:
+        with open(path) as f:
+            token = f.read().strip()
+        if valid_token(token):
+            return token
+    except FileNotFoundError:
+        pass
+    token = secrets.token_hex(TOKEN_SIZE)
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, "w") as f:
+        f.write(token)
+    return token
+
+
+class Transfer:
+    def __init__(
+        self,
+        root: str,
+        key: str,
+        token: str,
+        kind: str,
+        name: str,
+        size: int,
+        mtime: int,
+    ):
+        self.root = root
+        self.key = key
+        self.token = token
+        self.kind = kind
+        self.name = name
+        self.size = size
+        self.mtime = mtime
+        self.bitmap = bytearray(math.ceil(self.count / 8))
+        self.updated = time.time()
+        self.ranges: list[tuple[int, int]] = []
+        self.lock = threading.Lock()
+        self.removed = False
+        self.digests = dedup.ChunkDigests(size)
+
+    @property
+    def count(self) -> int:
+        return math.ceil(self.size / CHUNK_SIZE)
+
+    @property
+    def path(self) -> str:
+        return os.path.join(self.root, self.key + ".json")
+
+    @property
+    def part_path(self) -> str:
+        return os.path.join(self.root, self.key + ".part")
+
+    def matches(self, size: int, mtime: int) -> bool:
+        return self.size == size and self.mtime == mtime
+
+    def done(self, index: int) -> bool:
+        return bool(self.bitmap[index >> 3] >> (index & 7) & 1)
+
+    def mark(self, start: int, end: int):
+        first = math.ceil(start / CHUNK_SIZE)
+        last = self.count if end >= self.size else end // CHUNK_SIZE
+        with self.lock:
+            for index in range(first, last):
+                self.bitmap[index >> 3] |= 1 << (index & 7)
+            self.updated = time.time()
+
+    def resume_offset(self, start: int, end: int) -> int:
+        pos = start
+        while pos < end and self.done(pos // CHUNK_SIZE):
+            pos = min(end, (pos // CHUNK_SIZE + 1) * CHUNK_SIZE)
+        return pos
+
+    def missing(self) -> list[tuple[int, int]]:
+        ranges = []
+        for index in range(self.count):
+            if self.done(index):
+                continue
+            start = index * CHUNK_SIZE
+            end = min(start + CHUNK_SIZE, self.size)
+            if ranges and ranges[-1][1] == start:
+                ranges[-1] = (ranges[-1][0], end)
+            else:
+                ranges.append((start, end))
+        return ranges
+
+    def complete(self) -> bool:
+        return self.resume_offset(0, self.size) == self.size
+
+    def checkpoint(self, fd: int, start: int, end: int):
+        self.mark(start, end)
+        os.fsync(fd)
+        self.save()
+
+    def save(self):
+        with self.lock:
+            if self.removed:
+                return
+            data = {
+                "token": self.token,
+                "kind": self.kind,
+                "name": self.name,
+                "size": self.size,
+                "mtime": self.mtime,
+                "bitmap": self.bitmap.hex(),
+                "updated": self.updated,
+            }
+            temp_path = self.path + ".tmp"
+            with open(temp_path, "w") as f:
+                json.dump(data, f)
+            os.replace(temp_path, self.path)
+
+    @classmethod
+    def load(cls, root: str, key: str) -> "Transfer | None":
+        try:
+            with open(os.path.join(root, key + ".json")) as f:
+                data = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+        transfer = cls(
+            root,
+            key,
+            data["token"],
+            data["kind"],
+            data["name"],
+            data["size"],
+            data["mtime"],
+        )
+        bitmap = bytes.fromhex(data["bitmap"])
+        if len(bitmap) == len(transfer.bitmap):
+            transfer.bitmap[:] = bitmap
+        transfer.updated = data["updated"]
+        return transfer
+
+
+class Journal:
+    def __init__(self, base_dir: str):
+        self.root = os.path.join(base_dir, JOURNAL_DIR)
+        self.transfers: dict[str, Transfer] = {}
+        self.lock = threading.Lock()
+        self.last_expire = 0.0
+        os.makedirs(self.root, exist_ok=True)
+        self.expire()
+
+    def contains(self, path: str) -> bool:
+        return os.path.realpath(path).startswith(os.path.realpath(self.root))
+
+    def key(self, token: str, kind: str, name: str) -> str:
+        data = "\0".join((token, kind, name)).encode()
+        return hashlib.blake2b(data, digest_size=TOKEN_SIZE).hexdigest()
+
+    def open(
+        self, token: str, kind: str, name: str, size: int, mtime: int
+    ) -> tuple[Transfer, bool]:
+        if time.time() - self.last_expire > EXPIRE_INTERVAL:
+            self.expire()
+
+        key = self.key(token, kind, name)
+        with self.lock:
+            transfer = self.transfers.get(key) or Transfer.load(self.root, key)
+            if transfer is not None and not transfer.matches(size, mtime):
+                self.remove(transfer)
+                transfer = None
+
+            if (
+                transfer is not None
+                and kind == KIND_UPLOAD
+                and not os.path.isfile(transfer.part_path)
+            ):
+                self.remove(transfer)
+                transfer = None
+
+            resumed = transfer is not None
+            if transfer is None:
+                transfer = Transfer(self.root, key, token, kind, name, size, mtime)
+                if kind == KIND_UPLOAD:
+                    os.close(proto.open_part(transfer.part_path, size, truncate=True))
+            self.transfers[key] = transfer
+            transfer.updated = time.time()
+            transfer.save()
+        return transfer, resumed
+
+    def commit(self, transfer: Transfer, final_path: str) -> bool:
+        with self.lock:
+            if self.transfers.get(transfer.key) is not transfer:
+                return False
+            os.replace(transfer.part_path, final_path)
+            self.remove(transfer)
+        return True
+
+    def finish(self, transfer: Transfer):
+        with self.lock:
+            if self.transfers.get(transfer.key) is transfer:
+                self.remove(transfer)
+
+    def remove(self, transfer: Transfer):
+        if self.transfers.get(transfer.key) is transfer:
+            del self.transfers[transfer.key]
+        with transfer.lock:
+            transfer.removed = True
+        for path in (transfer.path, transfer.part_path):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def expire(self) -> int:
+        deadline = time.time() - EXPIRY
+        removed = 0
+        with self.lock:
+            self.last_expire = time.time()
+            for filename in os.listdir(self.root):
+                key, ext = os.path.splitext(filename)
+                path = os.path.join(self.root, filename)
+                if ext == ".json":
+                    transfer = self.transfers.get(key) or Transfer.load(self.root, key)
+                    if transfer is None:
+                        os.remove(path)
+                    elif transfer.updated < deadline:
+                        self.remove(transfer)
+                        removed += 1
+                elif not os.path.exists(os.path.join(self.root, key + ".json")):
+                    try:
+                        if os.path.getmtime(path) < deadline:
+                            os.remove(path)
+                    except FileNotFoundError:
+                        pass
+        return removed
@@ -1,15 +1,28 @@
 import ctypes
 import enum
+import os
 import socket
 import struct
 import sys
+import threading
+from typing import BinaryIO
 
 STATUS_OK = 0
 STATUS_ERR = 1
 STATUS_APPEND = 2
 
+MODE_FRAMED = 0
+MODE_BULK = 1
+
+FLAG_DELTA = 1
+FLAG_DEDUP = 2
+
+CHUNK_SIZE = 4 << 20
+MIN_CHUNK_SIZE = 4096
+MAX_CHUNK_SIZE = 16 << 20
+
 PORT = 8080
-BACKLOG = 1
+BACKLOG = 128
 
 
 class Command(str, enum.Enum):
@@ -18,6 +31,8 @@ class Command(str, enum.Enum):
     EXIT = "EXIT"
     DOWNLOAD = "DOWNLOAD"
     UPLOAD = "UPLOAD"
+    TOKEN = "TOKEN"
+    COMPRESS = "COMPRESS"
 
 
 class ExitException(Exception):
@@ -32,25 +47,172 @@ class PeerChangedException(Exception):
     pass
 
 
-def recv_exact(sock: socket.socket, size: int) -> bytes:
-    data = b""
-    while len(data) < size:
-        chunk = sock.recv(size - len(data))
-        if not chunk:
+class ChecksumMismatch(Exception):
+    pass
+
+
+LENGTH = struct.Struct("!I")
+
+_write_lock = threading.Lock()
+
+
+def recv_exact_into(sock: socket.socket, buf: memoryview) -> memoryview:
+    received = 0
+    while received < len(buf):
+        n = sock.recv_into(buf[received:])
+        if not n:
             raise PeerDisconnected("Peer closed connection during receiving data")
-        data += chunk
+        received += n
+    return buf
+
+
+def recv_exact(sock: socket.socket, size: int) -> bytearray:
+    data = bytearray(size)
+    recv_exact_into(sock, memoryview(data))
     return data
 
 
-def recv_data(sock: socket.socket) -> bytes:
-    raw_len = recv_exact(sock, 4)
-    length = struct.unpack("!I", raw_len)[0]
-    return recv_exact(sock, length)
+def recv_length(sock: socket.socket) -> int:
+    raw_len = bytearray(LENGTH.size)
+    recv_exact_into(sock, memoryview(raw_len))
+    return LENGTH.unpack(raw_len)[0]
+
+
+def recv_data(sock: socket.socket) -> bytearray:
+    return recv_exact(sock, recv_length(sock))
+
+
+def recv_data_into(sock: socket.socket, buf: memoryview) -> memoryview:
+    length = recv_length(sock)
+    if length > len(buf):
+        raise ValueError(f"Frame of {length} bytes does not fit into {len(buf)}")
+    return recv_exact_into(sock, buf[:length])
+
+
+def sendmsg_all(sock: socket.socket, buffers: list[bytes | memoryview]):
+    views = [memoryview(b).cast("B") for b in buffers if len(b)]
+    while views:
+        sent = sock.sendmsg(views)
+        while views and sent >= len(views[0]):
+            sent -= len(views.pop(0))
+        if sent:
+            views[0] = views[0][sent:]
+
+
+def send_data(sock: socket.socket, data: bytes | memoryview):
+    header = LENGTH.pack(len(data))
+    if hasattr(sock, "sendmsg"):
+        sendmsg_all(sock, [header, data])
+    else:
+        sock.sendall(header)
+        sock.sendall(data)
+
+
+class TCPChannel:
+    def __init__(self, sock):
+        self.sock = sock
+
+    def send(self, data: bytes | memoryview):
+        send_data(self.sock, data)
+
+    def recv(self) -> bytes:
+        return recv_data(self.sock)
+
+    def flush(self):
+        pass
+
+
+class UDPChannel:
+    def __init__(self, sock):
+        self.sock = sock
+
+    def send(self, data: bytes | memoryview):
+        self.sock.write(LENGTH.pack(len(data)))
+        if len(data):
+            self.sock.write(data)
+
+    def recv(self) -> bytes:
+        length = LENGTH.unpack(self.sock.recv(LENGTH.size))[0]
+        return self.sock.recv(length) if length else b""
+
+    def flush(self):
+        self.sock.flush()
+
+
+def negotiate_chunk_size(local: int, remote: int) -> int:
+    return max(MIN_CHUNK_SIZE, min(local, remote, MAX_CHUNK_SIZE))
+
+
+def send_file_chunk(
+    sock: socket.socket, f: BinaryIO, offset: int, size: int, mode: int
+) -> int:
+    if mode == MODE_BULK:
+        return sock.sendfile(f, offset, size)
+
+    f.seek(offset)
+    chunk = f.read(size)
+    if chunk:
+        send_data(sock, chunk)
+    return len(chunk)
+
+
+def recv_file_chunk(
+    sock: socket.socket, buf: memoryview, size: int, mode: int
+) -> memoryview:
+    if mode != MODE_BULK:
+        return recv_data_into(sock, buf)
+
+    return recv_exact_into(sock, buf[: min(len(buf), size)])
+
+
+def open_part(path: str, size: int, truncate: bool = False) -> int:
+    flags = os.O_RDWR | os.O_CREAT | getattr(os, "O_BINARY", 0)
+    if truncate:
+        flags |= os.O_TRUNC
+    fd = os.open(path, flags, 0o644)
+    try:
+        preallocate(fd, size)
+    except OSError:
+        os.close(fd)
+        raise
+    return fd
+
+
+def preallocate(fd: int, size: int):
+    current = os.fstat(fd).st_size
+    if current > size:
+        os.ftruncate(fd, size)
+    if current >= size:
+        return
+    try:
+        os.posix_fallocate(fd, 0, size)
+    except (AttributeError, OSError):
+        os.ftruncate(fd, size)
+
+
+def write_at(fd: int, data: bytes | memoryview, offset: int):
+    view = memoryview(data).cast("B")
+    while view:
+        if hasattr(os, "pwrite"):
+            n = os.pwrite(fd, view, offset)
+        else:
+            with _write_lock:
+                os.lseek(fd, offset, os.SEEK_SET)
+                n = os.write(fd, view)
+        view = view[n:]
+        offset += n
 
 
-def send_data(sock: socket.socket, data: bytes):
-    sock.sendall(struct.pack("!I", len(data)))
-    sock.sendall(data)
+def split_range(
+    start: int, end: int, parts: int, align: int = 1
+) -> list[tuple[int, int]]:
+    parts = max(1, min(parts, end - start))
+    step = (end - start) // parts
+    step = max(align, step - step % align)
+    bounds = [start + i * step for i in range(parts)]
+    bounds = [bound for bound in bounds if bound < end] or [start]
+    bounds.append(end)
+    return list(zip(bounds[:-1], bounds[1:], strict=True))
 
 
 def print_transfer_status(current: int, total: int):
@@ -0,0 +1,286 @@
+import asyncio
+import math
+import random
+import sys
+import time
+
+from app.udp.reliable_udp import set_buffer_sizes
+
+STREAM_CHUNK_SIZE = 64 << 10
+STREAM_QUEUE_SIZE = 256
+REORDER_DELAY = 0.005
+STREAM_SEGMENT_SIZE = 1448
+STREAM_IGNORED = ("duplicate", "mtu")
+IDLE_TIMEOUT = 60.0
+
+
+class Impairment:
+    def __init__(
+        self,
+        delay: float = 0.0,
+        jitter: float = 0.0,
+        loss: float = 0.0,
+        duplicate: float = 0.0,
+        reorder: float = 0.0,
+        mtu: int | None = None,
+        seed: int | None = None,
+    ):
+        self.delay = delay
+        self.jitter = jitter
+        self.loss = loss
+        self.duplicate = duplicate
+        self.reorder = reorder
+        self.mtu = mtu
+        self.rng = random.Random(seed)
+
+    def latency(self) -> float:
+        if not self.jitter:
+            return self.delay
+        return self.delay + self.rng.uniform(0, self.jitter)
+
+    def schedule(self, size: int) -> list[float]:
+        if self.mtu is not None and size > self.mtu:
+            return []
+        if self.rng.random() < self.loss:
+            return []
+        copies = 2 if self.rng.random() < self.duplicate else 1
+        delays = []
+        for _ in range(copies):
+            delay = self.latency()
+            if self.rng.random() < self.reorder:
+                delay += max(self.delay, REORDER_DELAY)
+            delays.append(delay)
+        return delays
+
+    def hit(self, probability: float, size: int) -> bool:
+        segments = math.ceil(size / STREAM_SEGMENT_SIZE)
+        return self.rng.random() < 1 - (1 - probability) ** segments
+
+    def spike(self, size: int) -> float:
+        if not self.hit(self.reorder, size):
+            return 0.0
+        return max(self.delay, REORDER_DELAY)
+
+    def stall(self, size: int) -> float:
+        if not self.hit(self.loss, size):
+            return 0.0
+        return max(2 * self.latency(), REORDER_DELAY)
+
+    def ignored(self, protocol: str) -> list[str]:
+        if protocol != "tcp":
+            return []
+        return [name for name in STREAM_IGNORED if getattr(self, name)]
+
+    def as_dict(self) -> dict:
+        return {
+            "delay": self.delay,
+            "jitter": self.jitter,
+            "loss": self.loss,
+            "duplicate": self.duplicate,
+            "reorder": self.reorder,
+            "mtu": self.mtu,
+        }
+
+
+class UpstreamProtocol(asyncio.DatagramProtocol):
+    def __init__(self, proxy: "UDPProxy", addr: tuple[str, int]):
+        self.proxy = proxy
+        self.addr = addr
+        self.transport: asyncio.DatagramTransport | None = None
+        self.backlog: list[bytes] = []
+        self.last_seen = time.monotonic()
+
+    def connection_made(self, transport: asyncio.DatagramTransport):
+        self.transport = transport
+        set_buffer_sizes(transport.get_extra_info("socket"))
+        for data in self.backlog:
+            self.proxy.relay(data, self.send)
+        self.backlog.clear()
+
+    def datagram_received(self, data: bytes, addr: tuple[str, int]):
+        self.last_seen = time.monotonic()
+        self.proxy.relay(data, self.reply)
+
+    def error_received(self, exc: Exception):
+        pass
+
+    def send(self, data: bytes):
+        if self.transport is not None and not self.transport.is_closing():
+            self.transport.sendto(data)
+
+    def reply(self, data: bytes):
+        if self.proxy.transport is not None and not self.proxy.transport.is_closing():
+            self.proxy.transport.sendto(data, self.addr)
+
+
+class UDPProxy(asyncio.DatagramProtocol):
+    def __init__(self, target: tuple[str, int], impairment: Impairment):
+        self.target = target
+        self.impairment = impairment
+        self.transport: asyncio.DatagramTransport | None = None
+        self.loop = asyncio.get_running_loop()
+        self.forwarded = 0
+        self.dropped = 0
+        self.duplicated = 0
+        self.upstreams: dict[tuple[str, int], UpstreamProtocol] = {}
+        self.evict_handle: asyncio.TimerHandle | None = None
+
+    def connection_made(self, transport: asyncio.DatagramTransport):
+        self.transport = transport
+        set_buffer_sizes(transport.get_extra_info("socket"))
+        self.evict_handle = self.loop.call_later(IDLE_TIMEOUT, self.evict)
+
+    def connection_lost(self, exc: Exception | None):
+        if self.evict_handle is not None:
+            self.evict_handle.cancel()
+        for upstream in self.upstreams.values():
+            if upstream.transport is not None:
+                upstream.transport.close()
+        self.upstreams.clear()
+
+    def datagram_received(self, data: bytes, addr: tuple[str, int]):
+        upstream = self.upstreams.get(addr)
+        if upstream is None:
+            upstream = self.upstreams[addr] = UpstreamProtocol(self, addr)
+            self.loop.create_task(
+                self.loop.create_datagram_endpoint(
+                    lambda: upstream, remote_addr=self.target
+                )
+            )
+        upstream.last_seen = time.monotonic()
+        if upstream.transport is None:
+            upstream.backlog.append(data)
+        else:
+            self.relay(data, upstream.send)
+
+    def error_received(self, exc: Exception):
+        pass
+
+    def relay(self, data: bytes, send):
+        delays = self.impairment.schedule(len(data))
+        if not delays:
+            self.dropped += 1
+            return
+        self.forwarded += 1
+        self.duplicated += len(delays) - 1
+        for delay in delays:
+            if delay > 0:
+                self.loop.call_later(delay, send, data)
+            else:
+                send(data)
+
+    def evict(self):
+        deadline = time.monotonic() - IDLE_TIMEOUT
+        for addr, upstream in list(self.upstreams.items()):
+            if upstream.last_seen < deadline and upstream.transport is not None:
+                upstream.transport.close()
+                del self.upstreams[addr]
+        self.evict_handle = self.loop.call_later(IDLE_TIMEOUT, self.evict)
+
+
+class TCPProxy:
+    def __init__(self, target: tuple[str, int], impairment: Impairment):
+        self.target = target
+        self.impairment = impairment
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            up_reader, up_writer = await asyncio.open_connection(*self.target)
+        except OSError:
+            writer.close()
+            return
+        try:
+            await asyncio.gather(
+                self.pipe(reader, up_writer), self.pipe(up_reader, writer)
+            )
+        finally:
+            writer.close()
+            up_writer.close()
+
+    async def pipe(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        loop = asyncio.get_running_loop()
+        queue: asyncio.Queue[tuple[float, bytes]] = asyncio.Queue(STREAM_QUEUE_SIZE)
+
+        async def deliver():
+            failed = False
+            while (item := await queue.get())[1]:
+                at, data = item
+                if failed:
+                    continue
+                delay = at - loop.time()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                try:
+                    writer.write(data)
+                    await writer.drain()
+                except OSError:
+                    failed = True
+            if not failed and writer.can_write_eof():
+                try:
+                    writer.write_eof()
+                except OSError:
+                    pass
+
+        task = loop.create_task(deliver())
+        last = 0.0
+        try:
+            while data := await reader.read(STREAM_CHUNK_SIZE):
+                delay = self.impairment.latency() + self.impairment.spike(len(data))
+                last = max(last, loop.time() + delay) + self.impairment.stall(len(data))
+                await queue.put((last, data))
+        except OSError:
+            pass
+        finally:
+            await queue.put((last, b""))
+            await task
+
+
+async def start_proxy(
+    protocol: str,
+    listen: tuple[str, int],
+    target: tuple[str, int],
+    impairment: Impairment,
+):
+    loop = asyncio.get_running_loop()
+    if protocol == "tcp":
+        proxy = TCPProxy(target, impairment)
+        return await asyncio.start_server(proxy.handle, *listen)
+    transport, _ = await loop.create_datagram_endpoint(
+        lambda: UDPProxy(target, impairment), local_addr=listen
+    )
+    return transport
+
+
+async def serve(
+    protocol: str,
+    listen: tuple[str, int],
+    target: tuple[str, int],
+    impairment: Impairment,
+):
+    server = await start_proxy(protocol, listen, target, impairment)
+    print(f"Proxy {protocol} {listen[0]}:{listen[1]} -> {target[0]}:{target[1]}")
+    if ignored := impairment.ignored(protocol):
+        print(f"Not emulated over {protocol}: {', '.join(ignored)}")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        server.close()
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 5:
+        print(
+            "Usage: python proxy.py {tcp | udp} <listen_port> <target_ip> "
+            "<target_port> [delay] [jitter] [loss] [duplicate] [reorder]"
+        )
+        sys.exit(1)
+
+    protocol = sys.argv[1]
+    listen = ("127.0.0.1", int(sys.argv[2]))
+    target = (sys.argv[3], int(sys.argv[4]))
+    params = [float(arg) for arg in sys.argv[5:10]]
+
+    try:
+        asyncio.run(serve(protocol, listen, target, Impairment(*params)))
+    except KeyboardInterrupt:
+        print("\nProxy is shutting down...")
@@ -0,0 +1,83 @@
+import threading
+import time
+
+THROTTLE_INTERVAL = 0.05
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: float, now: float | None = None):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = time.monotonic() if now is None else now
+        self.lock = threading.Lock()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def available(self, now: float) -> float:
+        with self.lock:
+            self._refill(now)
+            return self.tokens
+
+    def consume(self, n: int):
+        with self.lock:
+            self.tokens -= n
+
+    def delay(self, now: float) -> float:
+        with self.lock:
+            self._refill(now)
+            if self.tokens > 0:
+                return 0.0
+            return -self.tokens / self.rate
+
+    def reserve(self, n: int) -> float:
+        with self.lock:
+            self._refill(time.monotonic())
+            self.tokens -= n
+            if self.tokens >= 0:
+                return 0.0
+            return -self.tokens / self.rate
+
+
+class ClientBuckets:
+    def __init__(self, rate: float | None):
+        self.rate = rate
+        self.buckets: dict[str, TokenBucket | None] = {}
+        self.clients: dict[str, int] = {}
+        self.lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.buckets)
+
+    def acquire(self, ip: str) -> TokenBucket | None:
+        with self.lock:
+            if ip not in self.buckets:
+                self.buckets[ip] = new_bucket(self.rate)
+            self.clients[ip] = self.clients.get(ip, 0) + 1
+            return self.buckets[ip]
+
+    def release(self, ip: str):
+        with self.lock:
+            self.clients[ip] -= 1
+            if not self.clients[ip]:
+                del self.clients[ip]
+                del self.buckets[ip]
+
+
+def throttle(buckets: list[TokenBucket | None], n: int):
+    delay = max((b.reserve(n) for b in buckets if b is not None), default=0.0)
+    if delay > 0:
+        time.sleep(delay)
+
+
+def new_bucket(rate: float | None) -> TokenBucket | None:
+    if not rate:
+        return None
+    return TokenBucket(rate, rate * THROTTLE_INTERVAL)
+
+
+def throttled_chunk_size(chunk_size: int, rates: list[float | None]) -> int:
+    limits = [int(rate * THROTTLE_INTERVAL) for rate in rates if rate]
+    return min([chunk_size, *limits])
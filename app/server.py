@@ -6,20 +6,31 @@ from app.tcp.tcp_server import TCPServer
 from app.udp.udp_server import UDPServer
 
 
-def create_server(protocol, ip, base_dir) -> TCPServer | UDPServer:
+def create_server(
+    protocol, ip, base_dir, client_rate=None, total_rate=None
+) -> TCPServer | UDPServer:
     if protocol == "tcp":
-        return TCPServer(ip, PORT, base_dir)
+        return TCPServer(
+            ip, PORT, base_dir, client_rate=client_rate, total_rate=total_rate
+        )
     else:
-        return UDPServer(ip, PORT, base_dir)
+        return UDPServer(
+            ip, PORT, base_dir, client_rate=client_rate, total_rate=total_rate
+        )
 
 
 if __name__ == "__main__":
     if len(sys.argv) < 3:
-        print("Usage: python client.py {tcp | udp} <ip>")
+        print(
+            "Usage: python server.py {tcp | udp} <ip> "
+            "[client_rate_bytes_per_sec] [total_rate_bytes_per_sec]"
+        )
         sys.exit(1)
 
     protocol = sys.argv[1]
     ip = sys.argv[2]
+    client_rate = float(sys.argv[3]) if len(sys.argv) > 3 else None
+    total_rate = float(sys.argv[4]) if len(sys.argv) > 4 else None
 
     base_dir = os.path.join(
         os.path.dirname(os.path.abspath(__file__)), "..", "server_files"
@@ -27,7 +38,7 @@ if __name__ == "__main__":
     os.makedirs(base_dir, exist_ok=True)
 
     try:
-        server = create_server(protocol, ip, base_dir)
+        server = create_server(protocol, ip, base_dir, client_rate, total_rate)
         server.start()
     except OSError as e:
         print(f"Error: {e}")
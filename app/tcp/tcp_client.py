@@ -2,25 +2,50 @@ import os
 import socket
 import struct
 import time
+from concurrent.futures import FIRST_EXCEPTION, ThreadPoolExecutor, wait
 
+import app.compression as compression
+import app.dedup as dedup
+import app.delta as delta
+import app.journal as journal
 import app.protocol as proto
 from app.protocol import Command
 
+STREAMS = 4
+STRIPE_MIN_SIZE = 64 << 20
+PROGRESS_INTERVAL = 1.0
+
 
 class TCPClient:
-    def __init__(self, ip: str, port: int):
+    def __init__(self, ip: str, port: int, streams: int = STREAMS):
         self.ip = ip
         self.port = port
+        self.transfer_mode = proto.MODE_BULK
+        self.chunk_size = proto.CHUNK_SIZE
+        self.streams = streams
+        self.delta = delta.USE_DELTA
+        self.dedup = dedup.USE_DEDUP
+        self.compression = compression.COMPRESSION
+        self.compression_level = compression.COMPRESSION_LEVEL
+        self.stripe_socks: list[socket.socket] = []
+        self.first_byte_time: float | None = None
+        self.token = journal.load_token()
 
     def new_socket(self):
         sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         sock.settimeout(30)
         proto.enable_keepalive(sock)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
         return sock
 
     def connect(self):
         self.sock = self.new_socket()
         self.sock.connect((self.ip, self.port))
+        self.send_token(self.sock)
+
+    def send_token(self, sock: socket.socket):
+        proto.send_data(sock, f"{Command.TOKEN.value} {self.token}".encode())
+        proto.recv_data(sock)
 
     def start(self):
         print("Connecting...")
@@ -45,6 +70,16 @@ class TCPClient:
             finally:
                 self.sock.close()
 
+    def run(self, commands: list[str]):
+        self.connect()
+        try:
+            for message in commands:
+                self.handle_command(message)
+        except proto.ExitException:
+            pass
+        finally:
+            self.sock.close()
+
     def handle_input(self):
         while True:
             message = input("> ")
@@ -61,6 +96,9 @@ class TCPClient:
         except ValueError:
             cmd = None
 
+        if cmd is Command.COMPRESS:
+            self.set_compression(arg)
+            return
         if cmd is Command.UPLOAD:
             self.upload(arg)
             return
@@ -76,11 +114,23 @@ class TCPClient:
         if cmd is Command.EXIT:
             raise proto.ExitException
 
+    def set_compression(self, arg: str):
+        try:
+            self.compression, self.compression_level = compression.parse_setting(arg)
+        except ValueError as e:
+            print(f"ERR: {e}")
+            return
+        if self.compression is None:
+            print("Compression disabled")
+        else:
+            print(f"Compression: {self.compression}, level {self.compression_level}")
+
     def download(self, arg: str):
         base_filename = arg.replace("\\", "/").split("/")[-1]
         temp_filename = base_filename + ".part"
 
         data = proto.recv_data(self.sock)
+        self.first_byte_time = time.time()
         status = data[0]
         msg = data[1:]
 
@@ -88,18 +138,72 @@ class TCPClient:
             print(msg.decode())
             return
 
+        file_size, transfer_mode, server_chunk_size, codecs = struct.unpack(
+            "!QBIB", msg
+        )
+        chunk_size = proto.negotiate_chunk_size(self.chunk_size, server_chunk_size)
+        codec = compression.choose_codec(self.compression, codecs)
+
         client_file_size = 0
         mode = "wb"
 
-        if status == proto.STATUS_APPEND:
+        progress = journal.Transfer.load(".", temp_filename)
+        if progress is not None:
+            if (
+                status != proto.STATUS_APPEND
+                or not progress.matches(file_size, 0)
+                or not os.path.isfile(temp_filename)
+            ):
+                os.remove(progress.path)
+                progress = None
+        elif status == proto.STATUS_APPEND:
             try:
                 client_file_size = os.path.getsize(temp_filename)
                 mode = "ab"
             except FileNotFoundError:
                 pass
-            proto.send_data(self.sock, struct.pack("!Q", client_file_size))
 
-        file_size = struct.unpack("!Q", msg)[0]
+        if progress is not None:
+            self.download_striped(arg, progress, transfer_mode, chunk_size)
+            return
+
+        if self.delta and not client_file_size and os.path.isfile(base_filename):
+            proto.send_data(
+                self.sock,
+                struct.pack(
+                    "!QQIBBB", 0, file_size, self.chunk_size, proto.FLAG_DELTA, 0, 0
+                ),
+            )
+            channel = proto.TCPChannel(self.sock)
+            delta.receive_file(
+                channel, base_filename, temp_filename, base_filename, file_size
+            )
+            return
+
+        if (
+            self.streams > 1
+            and not codec
+            and file_size - client_file_size >= STRIPE_MIN_SIZE
+        ):
+            progress = journal.Transfer(
+                ".", temp_filename, self.token, journal.KIND_DOWNLOAD, arg, file_size, 0
+            )
+            progress.mark(0, client_file_size)
+            self.download_striped(arg, progress, transfer_mode, chunk_size)
+            return
+
+        proto.send_data(
+            self.sock,
+            struct.pack(
+                "!QQIBBB",
+                client_file_size,
+                file_size,
+                self.chunk_size,
+                0,
+                codec,
+                self.compression_level,
+            ),
+        )
         print(f"Downloading file '{arg}'...")
 
         start_time = time.time()
@@ -107,10 +211,15 @@ class TCPClient:
         proto.print_transfer_status(received, file_size)
 
         last_update = 0
+        buf = memoryview(bytearray(chunk_size))
 
         with open(temp_filename, mode) as f:
+            if codec:
+                received = self.recv_compressed(f, received, file_size, codec)
             while received < file_size:
-                chunk = proto.recv_data(self.sock)
+                chunk = proto.recv_file_chunk(
+                    self.sock, buf, file_size - received, transfer_mode
+                )
                 f.write(chunk)
                 received += len(chunk)
 
@@ -131,18 +240,40 @@ class TCPClient:
             print(f"ERR: File '{arg}' not found")
             return
 
+        file_size = os.path.getsize(real_path)
+        if (self.delta or self.dedup) and self.upload_probe(arg, real_path, file_size):
+            return
+
+        codec = compression.CODECS.get(self.compression or "", 0)
+        if self.streams > 1 and not codec and file_size >= STRIPE_MIN_SIZE:
+            self.upload_striped(arg, real_path, file_size)
+            return
+
         proto.send_data(self.sock, f"UPLOAD {arg}".encode())
 
-        file_size = os.path.getsize(real_path)
-        proto.send_data(self.sock, struct.pack("!Q", file_size))
+        transfer_mode = self.transfer_mode
+        proto.send_data(
+            self.sock,
+            struct.pack(
+                "!QQQQBIBB",
+                file_size,
+                os.stat(real_path).st_mtime_ns,
+                0,
+                file_size,
+                transfer_mode,
+                self.chunk_size,
+                0,
+                codec,
+            ),
+        )
 
         data = proto.recv_data(self.sock)
         status = data[0]
-        msg = data[1:]
+        server_file_size, chunk_size, _, codec = struct.unpack("!QIBB", data[1:])
 
         seek = 0
         if status == proto.STATUS_APPEND:
-            seek = struct.unpack("!Q", msg)[0]
+            seek = server_file_size
 
         print(f"Uploading file '{arg}'...")
 
@@ -153,10 +284,15 @@ class TCPClient:
         last_update = 0
 
         with open(real_path, "rb") as f:
-            f.seek(sent)
-            while chunk := f.read(4096):
-                proto.send_data(self.sock, chunk)
-                sent += len(chunk)
+            if codec:
+                sent = self.send_compressed(f, sent, file_size, codec)
+            while sent < file_size:
+                n = proto.send_file_chunk(
+                    self.sock, f, sent, min(chunk_size, file_size - sent), transfer_mode
+                )
+                if not n:
+                    break
+                sent += n
 
                 now = time.time()
                 if now - last_update > 1 or sent == file_size:
@@ -165,3 +301,326 @@ class TCPClient:
 
         print("\nDone")
         proto.print_data_speed(start_time, sent - seek)
+
+    def send_compressed(self, f, sent: int, end: int, codec: int) -> int:
+        start = sent
+        wire = 0
+        last_update = 0
+
+        def progress(raw: int, size: int):
+            nonlocal sent, wire, last_update
+            sent += raw
+            wire += size
+            now = time.time()
+            if now - last_update > 1 or sent == end:
+                proto.print_transfer_status(sent, end)
+                last_update = now
+
+        channel = proto.TCPChannel(self.sock)
+        compression.send_file(
+            channel, f, sent, end, codec, self.compression_level, progress
+        )
+        compression.print_ratio(sent - start, wire)
+        return sent
+
+    def recv_compressed(self, f, received: int, end: int, codec: int) -> int:
+        start = received
+        wire = 0
+        last_update = 0
+
+        def progress(raw: int, size: int):
+            nonlocal received, wire, last_update
+            received += raw
+            wire += size
+            now = time.time()
+            if now - last_update > 1 or received == end:
+                proto.print_transfer_status(received, end)
+                last_update = now
+
+        channel = proto.TCPChannel(self.sock)
+        compression.recv_file(channel, f, received, end, codec, progress)
+        compression.print_ratio(received - start, wire)
+        return received
+
+    def upload_probe(self, arg: str, real_path: str, file_size: int) -> bool:
+        flags = proto.FLAG_DELTA if self.delta else 0
+        if self.dedup:
+            flags |= proto.FLAG_DEDUP
+        proto.send_data(self.sock, f"UPLOAD {arg}".encode())
+        proto.send_data(
+            self.sock,
+            struct.pack(
+                "!QQQQBIBB",
+                file_size,
+                os.stat(real_path).st_mtime_ns,
+                0,
+                file_size,
+                self.transfer_mode,
+                self.chunk_size,
+                flags,
+                0,
+            ),
+        )
+        data = proto.recv_data(self.sock)
+        _, _, flags, _ = struct.unpack("!QIBB", data[1:])
+        channel = proto.TCPChannel(self.sock)
+        if flags & proto.FLAG_DELTA:
+            delta.send_file(channel, real_path, arg)
+            return True
+        if flags & proto.FLAG_DEDUP:
+            return dedup.send_file(channel, real_path, arg)
+        return False
+
+    def open_stripe(self) -> socket.socket:
+        sock = self.new_socket()
+        self.stripe_socks.append(sock)
+        sock.connect((self.ip, self.port))
+        self.send_token(sock)
+        return sock
+
+    def close_stripe(self, sock: socket.socket):
+        try:
+            proto.send_data(sock, Command.EXIT.encode())
+            proto.recv_data(sock)
+        except OSError:
+            pass
+
+    def run_stripes(self, tasks: list, done: list[int], base: int, total: int):
+        self.stripe_socks = []
+        error = None
+        with ThreadPoolExecutor(len(tasks)) as executor:
+            pending = {executor.submit(*task) for task in tasks}
+            while pending and error is None:
+                finished, pending = wait(
+                    pending, PROGRESS_INTERVAL, return_when=FIRST_EXCEPTION
+                )
+                proto.print_transfer_status(base + sum(done), total)
+                error = next((f.exception() for f in finished if f.exception()), None)
+            if error is not None:
+                for sock in [self.sock, *self.stripe_socks]:
+                    try:
+                        sock.shutdown(socket.SHUT_RDWR)
+                    except OSError:
+                        pass
+        if error is not None:
+            raise error
+
+    def download_striped(
+        self,
+        arg: str,
+        progress: journal.Transfer,
+        transfer_mode: int,
+        chunk_size: int,
+    ):
+        base_filename = arg.replace("\\", "/").split("/")[-1]
+        temp_filename = base_filename + ".part"
+        file_size = progress.size
+        missing = progress.missing()
+        pieces = [
+            piece
+            for start, end in missing
+            for piece in proto.split_range(start, end, self.streams, journal.CHUNK_SIZE)
+        ]
+        stripes = [pieces[i :: self.streams] for i in range(self.streams)]
+        stripes = [ranges for ranges in stripes if ranges] or [[(file_size, file_size)]]
+        done = [0] * len(stripes)
+        offset = file_size - sum(end - start for start, end in missing)
+
+        print(f"Downloading file '{arg}' over {len(stripes)} connections...")
+
+        start_time = time.time()
+        proto.print_transfer_status(offset, file_size)
+
+        progress.save()
+        fd = proto.open_part(temp_filename, file_size)
+        try:
+            tasks = [
+                (
+                    self.download_ranges,
+                    self.sock,
+                    arg,
+                    fd,
+                    progress,
+                    stripes[0],
+                    (transfer_mode, chunk_size),
+                    done,
+                    0,
+                )
+            ]
+            for i, ranges in enumerate(stripes[1:], 1):
+                tasks.append((self.download_stripe, arg, fd, progress, ranges, done, i))
+            self.run_stripes(tasks, done, offset, file_size)
+        finally:
+            os.close(fd)
+
+        os.replace(temp_filename, base_filename)
+        os.remove(progress.path)
+
+        print("\nDone")
+        proto.print_data_speed(start_time, file_size - offset)
+
+    def download_stripe(
+        self,
+        arg: str,
+        fd: int,
+        progress: journal.Transfer,
+        ranges: list[tuple[int, int]],
+        done: list[int],
+        index: int,
+    ):
+        sock = self.open_stripe()
+        try:
+            self.download_ranges(sock, arg, fd, progress, ranges, None, done, index)
+            self.close_stripe(sock)
+        finally:
+            sock.close()
+
+    def download_ranges(
+        self,
+        sock: socket.socket,
+        arg: str,
+        fd: int,
+        progress: journal.Transfer,
+        ranges: list[tuple[int, int]],
+        header: tuple[int, int] | None,
+        done: list[int],
+        index: int,
+    ):
+        for start, end in ranges:
+            if header is None:
+                proto.send_data(sock, f"DOWNLOAD {arg}".encode())
+                data = proto.recv_data(sock)
+                if data[0] == proto.STATUS_ERR:
+                    raise ConnectionError(data[1:].decode())
+                _, transfer_mode, server_chunk_size, _ = struct.unpack(
+                    "!QBIB", data[1:]
+                )
+                chunk_size = proto.negotiate_chunk_size(
+                    self.chunk_size, server_chunk_size
+                )
+                header = (transfer_mode, chunk_size)
+            self.download_range(sock, fd, progress, start, end, *header, done, index)
+            header = None
+
+    def download_range(
+        self,
+        sock: socket.socket,
+        fd: int,
+        progress: journal.Transfer,
+        start: int,
+        end: int,
+        transfer_mode: int,
+        chunk_size: int,
+        done: list[int],
+        index: int,
+    ):
+        proto.send_data(
+            sock, struct.pack("!QQIBBB", start, end, self.chunk_size, 0, 0, 0)
+        )
+        buf = memoryview(bytearray(chunk_size))
+        received = start
+        last_update = time.time()
+        try:
+            while received < end:
+                chunk = proto.recv_file_chunk(sock, buf, end - received, transfer_mode)
+                proto.write_at(fd, chunk, received)
+                received += len(chunk)
+                done[index] += len(chunk)
+
+                now = time.time()
+                if now - last_update > PROGRESS_INTERVAL or received == end:
+                    progress.checkpoint(fd, start, received)
+                    last_update = now
+        except BaseException:
+            progress.checkpoint(fd, start, received)
+            raise
+
+    def upload_striped(self, arg: str, real_path: str, file_size: int):
+        ranges = proto.split_range(0, file_size, self.streams, journal.CHUNK_SIZE)
+        done = [0] * len(ranges)
+
+        print(f"Uploading file '{arg}' over {len(ranges)} connections...")
+
+        start_time = time.time()
+        proto.print_transfer_status(0, file_size)
+
+        tasks = [
+            (
+                self.upload_range,
+                self.sock,
+                arg,
+                real_path,
+                file_size,
+                *ranges[0],
+                done,
+                0,
+            )
+        ]
+        for i, (start, end) in enumerate(ranges[1:], 1):
+            tasks.append(
+                (self.upload_stripe, arg, real_path, file_size, start, end, done, i)
+            )
+        self.run_stripes(tasks, done, 0, file_size)
+
+        print("\nDone")
+        proto.print_data_speed(start_time, sum(done))
+
+    def upload_stripe(
+        self,
+        arg: str,
+        real_path: str,
+        file_size: int,
+        start: int,
+        end: int,
+        done: list[int],
+        index: int,
+    ):
+        sock = self.open_stripe()
+        try:
+            self.upload_range(sock, arg, real_path, file_size, start, end, done, index)
+            self.close_stripe(sock)
+        finally:
+            sock.close()
+
+    def upload_range(
+        self,
+        sock: socket.socket,
+        arg: str,
+        real_path: str,
+        file_size: int,
+        start: int,
+        end: int,
+        done: list[int],
+        index: int,
+    ):
+        transfer_mode = self.transfer_mode
+        proto.send_data(sock, f"UPLOAD {arg}".encode())
+        proto.send_data(
+            sock,
+            struct.pack(
+                "!QQQQBIBB",
+                file_size,
+                os.stat(real_path).st_mtime_ns,
+                start,
+                end,
+                transfer_mode,
+                self.chunk_size,
+                0,
+                0,
+            ),
+        )
+
+        data = proto.recv_data(sock)
+        offset, chunk_size, _, _ = struct.unpack("!QIBB", data[1:])
+
+        sent = max(start, offset)
+        done[index] += sent - start
+        with open(real_path, "rb") as f:
+            while sent < end:
+                n = proto.send_file_chunk(
+                    sock, f, sent, min(chunk_size, end - sent), transfer_mode
+                )
+                if not n:
+                    break
+                sent += n
+                done[index] += n
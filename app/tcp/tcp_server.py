@@ -1,18 +1,88 @@
 import datetime
 import os
+import queue
+import selectors
 import socket
 import struct
 import time
+from collections.abc import Callable
+from concurrent.futures import ThreadPoolExecutor
 
+import app.compression as compression
+import app.dedup as dedup
+import app.delta as delta
+import app.journal as journal
 import app.protocol as proto
 from app.protocol import BACKLOG, Command
+from app.ratelimit import (
+    ClientBuckets,
+    TokenBucket,
+    new_bucket,
+    throttle,
+    throttled_chunk_size,
+)
+
+MAX_WORKERS = 32
+CONTROL_WORKERS = 4
+TRANSFER_COMMANDS = {Command.DOWNLOAD.value, Command.UPLOAD.value}
+
+
+def covered_size(ranges: list[tuple[int, int]]) -> int:
+    total = 0
+    reach = 0
+    for start, end in sorted(ranges):
+        start = max(start, reach)
+        if end > start:
+            total += end - start
+            reach = end
+    return total
+
+
+def is_transfer(message: str) -> bool:
+    parts = message.split(maxsplit=1)
+    return bool(parts) and parts[0].upper() in TRANSFER_COMMANDS
+
+
+class TCPConnection:
+    def __init__(
+        self,
+        sock: socket.socket,
+        addr: tuple[str, int],
+        token: str,
+        bucket: TokenBucket | None = None,
+    ):
+        self.sock = sock
+        self.addr = addr
+        self.token = token
+        self.bucket = bucket
 
 
 class TCPServer:
-    def __init__(self, ip: str, port: int, base_dir: str):
+    def __init__(
+        self,
+        ip: str,
+        port: int,
+        base_dir: str,
+        max_workers: int = MAX_WORKERS,
+        client_rate: float | None = None,
+        total_rate: float | None = None,
+    ):
         self.server_sock = self.new_socket(ip, port)
         self.base_dir = base_dir
-        self.session = {"cmd": Command.DOWNLOAD, "filename": "", "client_ip": ""}
+        self.transfer_mode = proto.MODE_BULK
+        self.chunk_size = proto.CHUNK_SIZE
+        self.client_rate = client_rate
+        self.total_bucket = new_bucket(total_rate)
+        self.buckets = ClientBuckets(client_rate)
+        self.connections: set[TCPConnection] = set()
+        self.store = dedup.ChunkStore(base_dir)
+        self.store.gc()
+        self.journal = journal.Journal(base_dir)
+        self.selector = selectors.DefaultSelector()
+        self.executor = ThreadPoolExecutor(max_workers)
+        self.control = ThreadPoolExecutor(CONTROL_WORKERS)
+        self.ready: queue.SimpleQueue[TCPConnection] = queue.SimpleQueue()
+        self.wakeup_recv, self.wakeup_send = socket.socketpair()
         print(f"Server is listening on {ip}:{port}")
 
     def new_socket(self, ip: str, port: int) -> socket.socket:
@@ -20,47 +90,115 @@ class TCPServer:
         sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         sock.bind((ip, port))
         sock.listen(BACKLOG)
+        sock.setblocking(False)
         return sock
 
     def start(self):
+        self.wakeup_recv.setblocking(False)
+        self.selector.register(self.server_sock, selectors.EVENT_READ)
+        self.selector.register(self.wakeup_recv, selectors.EVENT_READ)
+
         try:
             while True:
-                self.client_sock, addr = self.server_sock.accept()
-                ip, port = addr
-                print(f"Client {ip}:{port} connected")
-
-                proto.enable_keepalive(self.client_sock)
-
-                if ip != self.session["client_ip"]:
-                    if os.path.exists(self.session["filename"] + ".part"):
-                        os.remove(self.session["filename"] + ".part")
-                    self.session["filename"] = ""
-                    self.session["client_ip"] = ip
-
-                try:
-                    self.handle_client()
-                except proto.ExitException:
-                    print(f"Client {ip}:{port} disconnected")
-                except (ConnectionError, TimeoutError) as e:
-                    print(f"\nConnection with the client {ip}:{port} was lost")
-                    print(f"Details: {e}")
-                finally:
-                    self.client_sock.close()
+                for key, _ in self.selector.select():
+                    if key.fileobj is self.server_sock:
+                        self.accept()
+                    elif key.fileobj is self.wakeup_recv:
+                        self.resume_connections()
+                    else:
+                        self.selector.unregister(key.fileobj)
+                        self.control.submit(self.serve, key.data)
         except KeyboardInterrupt:
             print("\nServer is shutting down...")
         finally:
+            for conn in list(self.connections):
+                conn.sock.close()
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.control.shutdown(wait=False, cancel_futures=True)
+            self.selector.close()
+            self.wakeup_recv.close()
+            self.wakeup_send.close()
             self.server_sock.close()
 
-    def handle_client(self):
+    def accept(self):
+        try:
+            client_sock, addr = self.server_sock.accept()
+        except BlockingIOError:
+            return
+
+        ip, port = addr
+        print(f"Client {ip}:{port} connected")
+
+        client_sock.setblocking(True)
+        proto.enable_keepalive(client_sock)
+        client_sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+        conn = TCPConnection(client_sock, addr, ip, self.buckets.acquire(ip))
+        self.connections.add(conn)
+        self.selector.register(client_sock, selectors.EVENT_READ, conn)
+
+    def resume_connections(self):
+        try:
+            while self.wakeup_recv.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+
         while True:
-            message = proto.recv_data(self.client_sock).decode()
-            time = datetime.datetime.now().strftime("%H:%M:%S")
-            print(f"[{time}] Received message: {message}")
-            self.client_sock.settimeout(30)
-            self.handle_command(message)
-            self.client_sock.settimeout(None)
+            try:
+                conn = self.ready.get_nowait()
+            except queue.Empty:
+                break
+            self.selector.register(conn.sock, selectors.EVENT_READ, conn)
+
+    def serve(self, conn: TCPConnection, message: str | None = None):
+        ip, port = conn.addr
+        keep = handed_off = False
+        try:
+            if message is None:
+                message = self.recv_command(conn)
+                if is_transfer(message):
+                    self.executor.submit(self.serve, conn, message)
+                    handed_off = True
+                    return
+            self.handle_command(conn, message)
+            conn.sock.settimeout(None)
+            keep = True
+        except proto.ExitException:
+            print(f"Client {ip}:{port} disconnected")
+        except (ConnectionError, TimeoutError) as e:
+            print(f"\nConnection with the client {ip}:{port} was lost")
+            print(f"Details: {e}")
+        except Exception as e:
+            print(f"\nError while serving the client {ip}:{port}")
+            print(f"Details: {type(e).__name__}: {e}")
+        finally:
+            if handed_off:
+                pass
+            elif keep:
+                self.ready.put(conn)
+                self.wakeup_send.send(b"\0")
+            else:
+                self.close_connection(conn)
 
-    def handle_command(self, message: str):
+    def close_connection(self, conn: TCPConnection):
+        try:
+            self.selector.unregister(conn.sock)
+        except (KeyError, ValueError):
+            pass
+        self.connections.discard(conn)
+        self.buckets.release(conn.addr[0])
+        conn.sock.close()
+
+    def recv_command(self, conn: TCPConnection) -> str:
+        conn.sock.settimeout(30)
+        message = proto.recv_data(conn.sock).decode()
+        time = datetime.datetime.now().strftime("%H:%M:%S")
+        ip, port = conn.addr
+        print(f"[{time}] Received message from the client {ip}:{port}: {message}")
+        return message
+
+    def handle_command(self, conn: TCPConnection, message: str):
         parts = message.strip().split(maxsplit=1)
         cmd = parts[0].upper()
         arg = parts[1] if len(parts) > 1 else ""
@@ -68,104 +206,257 @@ class TCPServer:
         try:
             cmd = Command(cmd)
         except ValueError:
-            proto.send_data(
-                self.client_sock, f"ERR: Unknown command: {parts[0]}".encode()
-            )
+            proto.send_data(conn.sock, f"ERR: Unknown command: {parts[0]}".encode())
             return
 
         if cmd is Command.ECHO:
-            proto.send_data(self.client_sock, arg.encode())
+            proto.send_data(conn.sock, arg.encode())
         elif cmd is Command.TIME:
             time = datetime.datetime.now().strftime("%H:%M:%S")
-            proto.send_data(self.client_sock, time.encode())
+            proto.send_data(conn.sock, time.encode())
         elif cmd is Command.EXIT:
-            proto.send_data(self.client_sock, b"Bye!")
+            proto.send_data(conn.sock, b"Bye!")
             raise proto.ExitException
         elif cmd is Command.DOWNLOAD:
-            self.download(arg)
+            self.download(conn, arg)
         elif cmd is Command.UPLOAD:
-            self.upload(arg)
-
-    def download(self, arg: str):
+            self.upload(conn, arg)
+        elif cmd is Command.TOKEN:
+            if journal.valid_token(arg):
+                conn.token = arg
+                proto.send_data(conn.sock, b"OK")
+            else:
+                proto.send_data(conn.sock, b"ERR: Invalid token")
+
+    def transfer_chunk_size(self, conn: TCPConnection) -> int:
+        rates = [bucket.rate for bucket in (conn.bucket, self.total_bucket) if bucket]
+        return throttled_chunk_size(self.chunk_size, rates)
+
+    def download(self, conn: TCPConnection, arg: str):
         file_path = os.path.join(self.base_dir, arg)
         real_path = os.path.realpath(file_path)
 
-        if not real_path.startswith(os.path.realpath(self.base_dir)):
+        if (
+            not real_path.startswith(os.path.realpath(self.base_dir))
+            or self.store.contains(real_path)
+            or self.journal.contains(real_path)
+        ):
             msg = bytes([proto.STATUS_ERR]) + b"ERR: Access denied"
-            proto.send_data(self.client_sock, msg)
+            proto.send_data(conn.sock, msg)
             return
 
         if not os.path.isfile(real_path):
             msg = bytes([proto.STATUS_ERR]) + f"ERR: File '{arg}' not found".encode()
-            proto.send_data(self.client_sock, msg)
+            proto.send_data(conn.sock, msg)
             return
 
-        seek = 0
-        file_size = os.path.getsize(real_path)
-        msg = bytearray([proto.STATUS_OK]) + struct.pack("!Q", file_size)
-
-        if (
-            self.session["cmd"] == Command.DOWNLOAD
-            and self.session["filename"] == real_path
-        ):
+        stat = os.stat(real_path)
+        file_size = stat.st_size
+        transfer_mode = self.transfer_mode
+        msg = bytearray([proto.STATUS_OK]) + struct.pack(
+            "!QBIB",
+            file_size,
+            transfer_mode,
+            self.chunk_size,
+            compression.supported_mask(),
+        )
+
+        transfer, resumed = self.journal.open(
+            conn.token, journal.KIND_DOWNLOAD, real_path, file_size, stat.st_mtime_ns
+        )
+        if resumed:
             msg[0] = proto.STATUS_APPEND
-            proto.send_data(self.client_sock, msg)
-            client_raw_file_size = proto.recv_data(self.client_sock)
-            seek = struct.unpack("!Q", client_raw_file_size)[0]
-        else:
-            proto.send_data(self.client_sock, msg)
 
-        print(f"Sending file '{arg}'...")
+        proto.send_data(conn.sock, msg)
+
+        start, end, client_chunk_size, flags, codec, level = struct.unpack(
+            "!QQIBBB", proto.recv_data(conn.sock)
+        )
+        if flags & proto.FLAG_DELTA:
+            delta.send_file(
+                proto.TCPChannel(conn.sock),
+                real_path,
+                arg,
+                lambda n: throttle([conn.bucket, self.total_bucket], n),
+            )
+            self.journal.finish(transfer)
+            return
+
+        end = min(end, file_size)
+        seek = min(start, end)
+        base = 0 if end == file_size else seek
+        chunk_size = proto.negotiate_chunk_size(
+            self.transfer_chunk_size(conn), client_chunk_size
+        )
+
+        if end - seek < file_size:
+            print(f"Sending bytes {seek}-{end} of file '{arg}'...")
+        else:
+            print(f"Sending file '{arg}'...")
 
         start_time = time.time()
         sent = seek
-        proto.print_transfer_status(sent, file_size)
-
-        self.session["cmd"] = Command.DOWNLOAD
-        self.session["filename"] = real_path
+        proto.print_transfer_status(sent - base, end - base)
 
         last_update = 0
 
         with open(real_path, "rb") as f:
-            f.seek(seek)
-            while chunk := f.read(4096):
-                proto.send_data(self.client_sock, chunk)
-                sent += len(chunk)
+            codec = compression.accept_codec(codec)
+            if codec != compression.CODEC_NONE:
+                sent = self.send_compressed(conn, f, seek, end, base, codec, level)
+            while sent < end:
+                size = min(chunk_size, end - sent)
+                throttle([conn.bucket, self.total_bucket], size)
+                n = proto.send_file_chunk(conn.sock, f, sent, size, transfer_mode)
+                if not n:
+                    break
+                sent += n
 
                 now = time.time()
-                if now - last_update > 1 or sent == file_size:
-                    proto.print_transfer_status(sent, file_size)
+                if now - last_update > 1 or sent == end:
+                    proto.print_transfer_status(sent - base, end - base)
                     last_update = now
 
+        if sent == file_size:
+            self.journal.finish(transfer)
         print("\nDone")
         proto.print_data_speed(start_time, sent - seek)
 
-    def upload(self, arg: str):
+    def send_compressed(
+        self,
+        conn: TCPConnection,
+        f,
+        seek: int,
+        end: int,
+        base: int,
+        codec: int,
+        level: int,
+    ) -> int:
+        sent = seek
+        wire = 0
+        last_update = 0
+
+        def progress(raw: int, size: int):
+            nonlocal sent, wire, last_update
+            throttle([conn.bucket, self.total_bucket], size)
+            sent += raw
+            wire += size
+            now = time.time()
+            if now - last_update > 1 or sent == end:
+                proto.print_transfer_status(sent - base, end - base)
+                last_update = now
+
+        channel = proto.TCPChannel(conn.sock)
+        compression.send_file(channel, f, seek, end, codec, level, progress)
+        compression.print_ratio(sent - seek, wire)
+        return sent
+
+    def recv_compressed(
+        self,
+        conn: TCPConnection,
+        f,
+        received: int,
+        end: int,
+        codec: int,
+        sink: Callable[[int, bytes], None],
+    ) -> int:
+        start = received
+        wire = 0
+        last_update = 0
+
+        def progress(raw: int, size: int):
+            nonlocal received, wire, last_update
+            throttle([conn.bucket, self.total_bucket], size)
+            received += raw
+            wire += size
+            now = time.time()
+            if now - last_update > 1 or received == end:
+                proto.print_transfer_status(received, end)
+                last_update = now
+
+        channel = proto.TCPChannel(conn.sock)
+        compression.recv_file(channel, f, received, end, codec, progress, sink)
+        compression.print_ratio(received - start, wire)
+        return received
+
+    def upload(self, conn: TCPConnection, arg: str):
         base_filename = arg.replace("\\", "/").split("/")[-1]
         temp_filename = base_filename + ".part"
         file_path = os.path.join(self.base_dir, temp_filename)
 
-        raw_file_size = proto.recv_data(self.client_sock)
-        file_size = struct.unpack("!Q", raw_file_size)[0]
+        header = proto.recv_data(conn.sock)
+        (
+            file_size,
+            mtime,
+            start,
+            end,
+            transfer_mode,
+            client_chunk_size,
+            flags,
+            codec,
+        ) = struct.unpack("!QQQQBIBB", header)
+        chunk_size = proto.negotiate_chunk_size(
+            self.transfer_chunk_size(conn), client_chunk_size
+        )
+
+        if (start, end) != (0, file_size):
+            self.upload_range(
+                conn,
+                base_filename,
+                file_size,
+                mtime,
+                start,
+                end,
+                transfer_mode,
+                chunk_size,
+            )
+            return
 
-        mode = "wb"
-        server_file_size = 0
-        msg = bytearray([proto.STATUS_OK])
+        final_path = file_path.removesuffix(".part")
+        if flags & (proto.FLAG_DELTA | proto.FLAG_DEDUP):
+            accepted = 0
+            if flags & proto.FLAG_DELTA and os.path.isfile(final_path):
+                accepted = proto.FLAG_DELTA
+            elif flags & proto.FLAG_DEDUP and file_size:
+                accepted = proto.FLAG_DEDUP
+            msg = bytes([proto.STATUS_OK]) + struct.pack(
+                "!QIBB", 0, chunk_size, accepted, 0
+            )
+            proto.send_data(conn.sock, msg)
+            channel = proto.TCPChannel(conn.sock)
+            if accepted == proto.FLAG_DELTA:
+                digests = dedup.ChunkDigests(file_size)
+                if delta.receive_file(
+                    channel,
+                    final_path,
+                    file_path,
+                    final_path,
+                    file_size,
+                    lambda n: throttle([conn.bucket, self.total_bucket], n),
+                    digests.update,
+                ):
+                    self.store.add(base_filename, final_path, digests.digests)
+            elif accepted == proto.FLAG_DEDUP:
+                dedup.receive_file(
+                    channel,
+                    self.store,
+                    base_filename,
+                    file_path,
+                    final_path,
+                    file_size,
+                    lambda n: throttle([conn.bucket, self.total_bucket], n),
+                )
+            return
 
-        if (
-            self.session["cmd"] == Command.UPLOAD
-            and self.session["filename"] == base_filename
-        ):
-            try:
-                server_file_size = os.path.getsize(file_path)
-                mode = "ab"
-                msg[0] = proto.STATUS_APPEND
-                msg[1:] = struct.pack("!Q", server_file_size)
-            except FileNotFoundError:
-                pass
-            proto.send_data(self.client_sock, msg)
-        else:
-            proto.send_data(self.client_sock, msg)
+        transfer, _ = self.journal.open(
+            conn.token, journal.KIND_UPLOAD, base_filename, file_size, mtime
+        )
+        server_file_size = transfer.resume_offset(0, file_size)
+        msg = bytearray([proto.STATUS_APPEND if server_file_size else proto.STATUS_OK])
+
+        codec = compression.accept_codec(codec)
+        msg += struct.pack("!QIBB", server_file_size, chunk_size, 0, codec)
+        proto.send_data(conn.sock, msg)
 
         print(f"Receiving file '{base_filename}'...")
 
@@ -173,24 +464,110 @@ class TCPServer:
         received = server_file_size
         proto.print_transfer_status(received, file_size)
 
-        self.session["cmd"] = Command.UPLOAD
-        self.session["filename"] = base_filename
+        last_update = 0
+        buf = memoryview(bytearray(chunk_size))
+
+        def sink(pos: int, data: bytes):
+            nonlocal received, last_update
+            transfer.digests.update(pos, data)
+            received = pos + len(data)
+            now = time.time()
+            if now - last_update > 1:
+                f.flush()
+                transfer.checkpoint(f.fileno(), server_file_size, received)
+                last_update = now
+
+        with open(transfer.part_path, "r+b") as f:
+            f.seek(received)
+            try:
+                if codec != compression.CODEC_NONE:
+                    self.recv_compressed(conn, f, received, file_size, codec, sink)
+                while received < file_size:
+                    chunk = proto.recv_file_chunk(
+                        conn.sock, buf, file_size - received, transfer_mode
+                    )
+                    f.write(chunk)
+                    transfer.digests.update(received, chunk)
+                    received += len(chunk)
+                    throttle([conn.bucket, self.total_bucket], len(chunk))
+
+                    now = time.time()
+                    if now - last_update > 1 or received == file_size:
+                        proto.print_transfer_status(received, file_size)
+                        f.flush()
+                        transfer.checkpoint(f.fileno(), server_file_size, received)
+                        last_update = now
+            except BaseException:
+                f.flush()
+                transfer.checkpoint(f.fileno(), server_file_size, received)
+                raise
+
+        if self.journal.commit(transfer, final_path):
+            self.store.add(base_filename, final_path, transfer.digests.digests)
+
+        print("\nDone")
+        proto.print_data_speed(start_time, received - server_file_size)
+
+    def upload_range(
+        self,
+        conn: TCPConnection,
+        base_filename: str,
+        file_size: int,
+        mtime: int,
+        start: int,
+        end: int,
+        transfer_mode: int,
+        chunk_size: int,
+    ):
+        end = min(end, file_size)
+        start = min(start, end)
+
+        transfer, _ = self.journal.open(
+            conn.token, journal.KIND_UPLOAD, base_filename, file_size, mtime
+        )
+        offset = transfer.resume_offset(start, end)
+
+        msg = bytes([proto.STATUS_OK]) + struct.pack("!QIBB", offset, chunk_size, 0, 0)
+        proto.send_data(conn.sock, msg)
+
+        print(f"Receiving bytes {offset}-{end} of file '{base_filename}'...")
+
+        start_time = time.time()
+        received = offset
+        proto.print_transfer_status(received - start, end - start)
 
         last_update = 0
+        buf = memoryview(bytearray(chunk_size))
 
-        with open(file_path, mode) as f:
-            while received < file_size:
-                chunk = proto.recv_data(self.client_sock)
-                f.write(chunk)
+        fd = proto.open_part(transfer.part_path, file_size)
+        try:
+            while received < end:
+                chunk = proto.recv_file_chunk(
+                    conn.sock, buf, end - received, transfer_mode
+                )
+                proto.write_at(fd, chunk, received)
+                transfer.digests.update(received, chunk)
                 received += len(chunk)
+                throttle([conn.bucket, self.total_bucket], len(chunk))
 
                 now = time.time()
-                if now - last_update > 1 or received == file_size:
-                    proto.print_transfer_status(received, file_size)
+                if now - last_update > 1 or received == end:
+                    proto.print_transfer_status(received - start, end - start)
+                    transfer.checkpoint(fd, offset, received)
                     last_update = now
+        except BaseException:
+            transfer.checkpoint(fd, offset, received)
+            raise
+        finally:
+            os.close(fd)
 
-        final_path = file_path.removesuffix(".part")
-        os.replace(file_path, final_path)
+        with transfer.lock:
+            transfer.ranges.append((start, end))
+            complete = covered_size(transfer.ranges) >= file_size
+        if complete or transfer.complete():
+            final_path = os.path.join(self.base_dir, base_filename)
+            if self.journal.commit(transfer, final_path):
+                self.store.add(base_filename, final_path, transfer.digests.digests)
 
         print("\nDone")
-        proto.print_data_speed(start_time, received - server_file_size)
+        proto.print_data_speed(start_time, received - offset)
@@ -0,0 +1,472 @@
+import asyncio
+import errno
+import heapq
+import inspect
+import itertools
+import math
+import os
+import socket
+import time
+from collections import deque
+from collections.abc import Awaitable, Callable
+from typing import BinaryIO
+
+import app.protocol as proto
+from app.udp.core import (
+    CONGESTION_CONTROL,
+    FLAG_RST,
+    HEADER,
+    HEADER_SIZE,
+    PAYLOAD_SIZE,
+    PEER_OPEN,
+    PEER_RESET,
+    USE_FEC,
+    ReliableUDPCore,
+    classify_opening,
+)
+from app.udp.reliable_udp import (
+    IDLE_TIMEOUT,
+    KEEPALIVE_INTERVAL,
+    set_buffer_sizes,
+    set_dont_fragment,
+)
+
+SESSION_SEND_WINDOW = 1024
+SESSION_RECV_WINDOW = 1024
+MAX_SESSIONS = 16384
+
+
+class ReliableUDPSession(ReliableUDPCore):
+    def __init__(self, addr: tuple[str, int], congestion: str, fec: bool, now: float):
+        super().__init__(congestion, fec, SESSION_SEND_WINDOW, SESSION_RECV_WINDOW, now)
+        self._addr = addr
+        self._last_seen = now
+        self._closed = False
+        self._error: Exception | None = None
+        self._reset_by_peer = False
+
+    def _restart(self, now: float):
+        self._reset_by_peer = True
+
+
+class ReliableUDPProtocol(asyncio.DatagramProtocol):
+    def __init__(
+        self,
+        on_connection: Callable[[ReliableUDPSession], None] | None = None,
+        congestion: str = CONGESTION_CONTROL,
+        fec: bool = USE_FEC,
+        max_sessions: int = MAX_SESSIONS,
+    ):
+        self.transport: asyncio.DatagramTransport | None = None
+        self._closed = False
+        self._peers: dict[tuple[str, int], ReliableUDPSession] = {}
+        self._on_connection = on_connection
+        self._congestion = congestion
+        self._fec = fec
+        self._max_sessions = max_sessions
+
+        self._loop = asyncio.get_running_loop()
+        self._dirty: set[ReliableUDPSession] = set()
+        self._scheduled = False
+        self._timers: list[tuple[float, int, ReliableUDPSession]] = []
+        self._timer_deadlines: dict[ReliableUDPSession, float] = {}
+        self._timer_handle: asyncio.TimerHandle | None = None
+        self._evict_handle: asyncio.TimerHandle | None = None
+        self._counter = itertools.count()
+        self._events: dict[ReliableUDPSession, asyncio.Event] = {}
+        self._pending: dict[ReliableUDPSession, deque[memoryview]] = {}
+        self._closed_waiter = self._loop.create_future()
+
+    def connection_made(self, transport: asyncio.DatagramTransport):
+        self.transport = transport
+        sock = transport.get_extra_info("socket")
+        if sock is not None:
+            set_buffer_sizes(sock)
+            set_dont_fragment(sock)
+
+    def datagram_received(self, data: bytes, addr: tuple[str, int]):
+        if len(data) < HEADER_SIZE:
+            return
+        conn = self._peers.get(addr)
+        if conn is not None and self._on_connection and conn.is_reopened_by(data):
+            self._drop(conn, proto.PeerDisconnected("Peer has reconnected"))
+            conn = None
+        if conn is None:
+            conn = self._accept(addr, data)
+            if conn is None:
+                return
+        now = time.monotonic()
+        conn._last_seen = now
+        conn.receive_datagram(data, now)
+        if conn._reset_by_peer:
+            self._drop(conn, proto.PeerDisconnected("Peer closed the connection"))
+            return
+        self._mark(conn)
+
+    def error_received(self, exc: Exception):
+        pass
+
+    def connection_lost(self, exc: Exception | None):
+        self._closed = True
+        for conn in list(self._peers.values()):
+            conn._closed = True
+            if exc is not None:
+                conn._error = exc
+            self._notify(conn)
+        for handle in (self._timer_handle, self._evict_handle):
+            if handle is not None:
+                handle.cancel()
+        if not self._closed_waiter.done():
+            self._closed_waiter.set_result(None)
+
+    def open(self, addr: tuple[str, int]) -> ReliableUDPSession:
+        conn = ReliableUDPSession(addr, self._congestion, self._fec, time.monotonic())
+        conn._keepalive = KEEPALIVE_INTERVAL
+        self._peers[addr] = conn
+        self._events[conn] = asyncio.Event()
+        self._pending[conn] = deque()
+        return conn
+
+    def close(self):
+        if self.transport is not None:
+            self.transport.close()
+
+    def _accept(self, addr: tuple[str, int], data: bytes) -> ReliableUDPSession | None:
+        if self._on_connection is None:
+            return None
+
+        action = classify_opening(data)
+        if action == PEER_RESET:
+            self.transport.sendto(HEADER.pack(0, 0, 0, FLAG_RST, 0), addr)
+        if action != PEER_OPEN or len(self._peers) >= self._max_sessions:
+            return None
+
+        conn = self.open(addr)
+        self._on_connection(conn)
+        self._schedule_eviction()
+        return conn
+
+    def _drain(self, conn: ReliableUDPSession):
+        if conn._closed or self.transport is None:
+            return
+        if conn._need_to_ack:
+            conn._ack_now = True
+        self._pump(conn)
+        for _, frame in conn.poll(time.monotonic()):
+            self.transport.sendto(b"".join(frame), conn._addr)
+
+    def _release(self, conn: ReliableUDPSession):
+        if not conn._closed and self.transport is not None:
+            self.transport.sendto(HEADER.pack(0, 0, 0, FLAG_RST, 0), conn._addr)
+        conn._closed = True
+        if self._peers.get(conn._addr) is conn:
+            del self._peers[conn._addr]
+        self._events.pop(conn, None)
+        self._pending.pop(conn, None)
+        self._timer_deadlines.pop(conn, None)
+        self._dirty.discard(conn)
+
+    def _mark(self, conn: ReliableUDPSession):
+        self._dirty.add(conn)
+        if not self._scheduled:
+            self._scheduled = True
+            self._loop.call_soon(self._run)
+
+    def _notify(self, conn: ReliableUDPSession):
+        event = self._events.get(conn)
+        if event is not None:
+            event.set()
+
+    def _run(self):
+        self._scheduled = False
+        if self._timer_handle is not None:
+            self._timer_handle.cancel()
+            self._timer_handle = None
+        cur_time = time.monotonic()
+
+        while self._timers and self._timers[0][0] <= cur_time:
+            deadline, _, conn = heapq.heappop(self._timers)
+            if self._timer_deadlines.get(conn) == deadline:
+                del self._timer_deadlines[conn]
+                self._dirty.add(conn)
+
+        dirty, self._dirty = self._dirty, set()
+        for conn in dirty:
+            if conn._closed:
+                continue
+            self._pump(conn)
+            for _, frame in conn.poll(cur_time):
+                self.transport.sendto(b"".join(frame), conn._addr)
+            self._schedule_timer(conn)
+            self._notify(conn)
+
+        if self._timers and not self._closed:
+            self._timer_handle = self._loop.call_at(self._timers[0][0], self._run)
+
+    def _pump(self, conn: ReliableUDPSession):
+        pending = self._pending.get(conn)
+        while pending and conn._send.free():
+            view = pending[0]
+            pushed = conn.push(view)
+            if pushed == len(view):
+                pending.popleft()
+            else:
+                pending[0] = view[pushed:]
+
+    def _schedule_timer(self, conn: ReliableUDPSession):
+        deadline = conn._deadline()
+        if deadline is None:
+            return
+        current = self._timer_deadlines.get(conn)
+        if current is not None and current <= deadline:
+            return
+        self._timer_deadlines[conn] = deadline
+        heapq.heappush(self._timers, (deadline, next(self._counter), conn))
+
+    def _schedule_eviction(self):
+        if self._evict_handle is not None or not self._peers:
+            return
+        oldest = min(conn._last_seen for conn in self._peers.values())
+        self._evict_handle = self._loop.call_at(oldest + IDLE_TIMEOUT, self._evict)
+
+    def _evict(self):
+        self._evict_handle = None
+        cur_time = time.monotonic()
+        for conn in list(self._peers.values()):
+            if cur_time - conn._last_seen >= IDLE_TIMEOUT:
+                self._drop(
+                    conn, proto.PeerDisconnected("Peer has been idle for too long")
+                )
+        self._schedule_eviction()
+
+    def _drop(self, conn: ReliableUDPSession, error: Exception):
+        del self._peers[conn._addr]
+        conn._error = error
+        conn._closed = True
+        self._notify(conn)
+
+    async def _wait(self, conn: ReliableUDPSession, predicate: Callable[[], bool]):
+        event = self._events.get(conn)
+        while not predicate():
+            if conn._error is not None:
+                error, conn._error = conn._error, None
+                raise error
+            if conn._closed or self._closed or event is None:
+                raise OSError(errno.EBADF, "Socket is closed")
+            event.clear()
+            await event.wait()
+
+
+class ReliableStreamReader:
+    def __init__(self, protocol: ReliableUDPProtocol, conn: ReliableUDPSession):
+        self._protocol = protocol
+        self._conn = conn
+
+    async def read(self, size: int = PAYLOAD_SIZE) -> bytes:
+        conn = self._conn
+        n = math.ceil(size / PAYLOAD_SIZE)
+        chunks = []
+        while n:
+            k = min(n, conn._recv.capacity)
+            await self._protocol._wait(conn, lambda k=k: conn._recv.available() >= k)
+            chunks += conn.pop(k)
+            self._wakeup_for_ack()
+            n -= k
+        return b"".join(chunks)
+
+    async def readinto(self, buf: memoryview) -> int:
+        buf = memoryview(buf).cast("B")
+
+        def sink(k: int, payload: bytes):
+            start = k * PAYLOAD_SIZE
+            end = min(start + len(payload), len(buf))
+            buf[start:end] = payload[: end - start]
+
+        return await self._place(len(buf), sink)
+
+    async def read_into_file(self, f: BinaryIO, offset: int, size: int) -> int:
+        if hasattr(os, "pwrite"):
+            fd = f.fileno()
+
+            def sink(k: int, payload: bytes):
+                os.pwrite(fd, payload, offset + k * PAYLOAD_SIZE)
+        else:
+
+            def sink(k: int, payload: bytes):
+                f.seek(offset + k * PAYLOAD_SIZE)
+                f.write(payload)
+
+        return await self._place(size, sink)
+
+    async def _place(self, size: int, sink: Callable[[int, bytes], None]) -> int:
+        conn = self._conn
+        n = math.ceil(size / PAYLOAD_SIZE)
+        placed = 0
+        for start in range(0, n, conn._recv.capacity):
+            k = min(n - start, conn._recv.capacity)
+            conn._recv.place(
+                k, lambda i, payload, start=start: sink(start + i, payload)
+            )
+            try:
+                await self._protocol._wait(
+                    conn, lambda k=k: conn._recv.available() >= k
+                )
+            except BaseException:
+                conn._recv.sink = None
+                raise
+            placed += conn._recv.consume(k)
+            conn._update_window()
+            self._wakeup_for_ack()
+        return placed
+
+    def _wakeup_for_ack(self):
+        if self._conn._ack_now:
+            self._protocol._mark(self._conn)
+
+
+class ReliableStreamWriter:
+    def __init__(
+        self,
+        protocol: ReliableUDPProtocol,
+        conn: ReliableUDPSession,
+        owns_transport: bool,
+    ):
+        self._protocol = protocol
+        self._conn = conn
+        self._owns_transport = owns_transport
+        self._closer: asyncio.Task | None = None
+
+    @property
+    def stats(self) -> dict:
+        return self._conn.stats
+
+    def get_extra_info(self, name: str, default=None):
+        if name == "peername":
+            return self._conn._addr
+        if self._protocol.transport is None:
+            return default
+        return self._protocol.transport.get_extra_info(name, default)
+
+    def write(self, data: bytes | memoryview):
+        view = memoryview(data).cast("B")
+        if not view.readonly:
+            view = memoryview(bytes(view))
+        pending = self._protocol._pending.get(self._conn)
+        if pending is None or self._closer is not None:
+            raise OSError(errno.EBADF, "Socket is closed")
+        if view:
+            pending.append(view)
+            self._protocol._mark(self._conn)
+
+    async def drain(self):
+        pending = self._protocol._pending.get(self._conn)
+        await self._protocol._wait(self._conn, lambda: not pending)
+
+    async def flush(self):
+        conn = self._conn
+        pending = self._protocol._pending.get(conn)
+        await self._protocol._wait(conn, lambda: not pending and not len(conn._send))
+
+    def is_closing(self) -> bool:
+        return self._closer is not None or self._conn._closed
+
+    def close(self):
+        if self._closer is None:
+            self._closer = self._protocol._loop.create_task(self._close())
+
+    async def wait_closed(self):
+        if self._closer is not None:
+            await asyncio.shield(self._closer)
+        if self._owns_transport:
+            await asyncio.shield(self._protocol._closed_waiter)
+
+    async def _close(self):
+        try:
+            await asyncio.wait_for(self.flush(), IDLE_TIMEOUT)
+        except (OSError, TimeoutError):
+            pass
+        finally:
+            self._protocol._drain(self._conn)
+            self._protocol._release(self._conn)
+            if self._owns_transport:
+                self._protocol.close()
+
+
+class ReliableUDPServer:
+    def __init__(self, protocol: ReliableUDPProtocol):
+        self._protocol = protocol
+
+    @property
+    def sockets(self) -> list[socket.socket]:
+        sock = self._protocol.transport.get_extra_info("socket")
+        return [sock] if sock is not None else []
+
+    @property
+    def sessions(self) -> int:
+        return len(self._protocol._peers)
+
+    def close(self):
+        self._protocol.close()
+
+    async def wait_closed(self):
+        await asyncio.shield(self._protocol._closed_waiter)
+
+    async def serve_forever(self):
+        await self.wait_closed()
+
+    async def __aenter__(self) -> "ReliableUDPServer":
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.close()
+        await self.wait_closed()
+
+
+async def open_connection(
+    host: str,
+    port: int,
+    congestion: str = CONGESTION_CONTROL,
+    fec: bool = USE_FEC,
+) -> tuple[ReliableStreamReader, ReliableStreamWriter]:
+    loop = asyncio.get_running_loop()
+    infos = await loop.getaddrinfo(host, port, family=socket.AF_INET)
+    addr = infos[0][4]
+
+    transport, protocol = await loop.create_datagram_endpoint(
+        lambda: ReliableUDPProtocol(congestion=congestion, fec=fec),
+        local_addr=("0.0.0.0", 0),
+    )
+    conn = protocol.open(addr)
+    return (
+        ReliableStreamReader(protocol, conn),
+        ReliableStreamWriter(protocol, conn, owns_transport=True),
+    )
+
+
+async def start_server(
+    client_connected_cb: Callable[
+        [ReliableStreamReader, ReliableStreamWriter], Awaitable[None] | None
+    ],
+    host: str,
+    port: int,
+    congestion: str = CONGESTION_CONTROL,
+    fec: bool = USE_FEC,
+    max_sessions: int = MAX_SESSIONS,
+) -> ReliableUDPServer:
+    loop = asyncio.get_running_loop()
+    tasks: set[asyncio.Task] = set()
+
+    def on_connection(conn: ReliableUDPSession):
+        reader = ReliableStreamReader(protocol, conn)
+        writer = ReliableStreamWriter(protocol, conn, owns_transport=False)
+        result = client_connected_cb(reader, writer)
+        if inspect.isawaitable(result):
+            task = loop.create_task(result)
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+
+    _, protocol = await loop.create_datagram_endpoint(
+        lambda: ReliableUDPProtocol(on_connection, congestion, fec, max_sessions),
+        local_addr=(host, port),
+    )
+    return ReliableUDPServer(protocol)
@@ -0,0 +1,98 @@
+INITIAL_WINDOW = 10
+MIN_WINDOW = 1
+MAX_WINDOW = 4096
+
+
+class Reno:
+    def __init__(
+        self, initial_window: int = INITIAL_WINDOW, max_window: int = MAX_WINDOW
+    ):
+        self.cwnd = float(initial_window)
+        self.ssthresh = float(max_window)
+        self.max_window = max_window
+
+    @property
+    def window(self) -> int:
+        return max(MIN_WINDOW, int(self.cwnd))
+
+    def on_ack(self, acked: int, now: float):
+        if self.cwnd < self.ssthresh:
+            self.cwnd += acked
+        else:
+            self._increase(acked, now)
+        self.cwnd = min(self.cwnd, self.max_window)
+
+    def on_loss(self, now: float):
+        self.ssthresh = max(self.cwnd / 2, MIN_WINDOW)
+        self.cwnd = self.ssthresh
+
+    def on_timeout(self, now: float):
+        self.ssthresh = max(self.cwnd / 2, MIN_WINDOW)
+        self.cwnd = MIN_WINDOW
+
+    def save(self) -> dict:
+        return dict(vars(self))
+
+    def restore(self, state: dict):
+        vars(self).update(state)
+
+    def _increase(self, acked: int, now: float):
+        self.cwnd += acked / self.cwnd
+
+
+class Cubic(Reno):
+    C = 0.4
+    BETA = 0.7
+    ALPHA = 3 * (1 - BETA) / (1 + BETA)
+
+    def __init__(
+        self, initial_window: int = INITIAL_WINDOW, max_window: int = MAX_WINDOW
+    ):
+        super().__init__(initial_window, max_window)
+        self.w_max = 0.0
+        self.k = 0.0
+        self.w_est = 0.0
+        self.epoch_start: float | None = None
+
+    def on_loss(self, now: float):
+        self._reduce()
+        self.ssthresh = max(self.cwnd * self.BETA, MIN_WINDOW)
+        self.cwnd = self.ssthresh
+
+    def on_timeout(self, now: float):
+        self._reduce()
+        self.ssthresh = max(self.cwnd * self.BETA, MIN_WINDOW)
+        self.cwnd = MIN_WINDOW
+
+    def _reduce(self):
+        self.epoch_start = None
+        if self.cwnd < self.w_max:
+            self.w_max = self.cwnd * (1 + self.BETA) / 2
+        else:
+            self.w_max = self.cwnd
+
+    def _increase(self, acked: int, now: float):
+        if self.epoch_start is None:
+            self.epoch_start = now
+            self.w_est = self.cwnd
+            if self.cwnd < self.w_max:
+                self.k = ((self.w_max - self.cwnd) / self.C) ** (1 / 3)
+            else:
+                self.k = 0.0
+                self.w_max = self.cwnd
+
+        t = now - self.epoch_start
+        target = self.w_max + self.C * (t - self.k) ** 3
+
+        self.w_est += self.ALPHA * acked / self.cwnd
+        if target > self.cwnd:
+            self.cwnd += (target - self.cwnd) / self.cwnd * acked
+        else:
+            self.cwnd += 0.01 * acked / self.cwnd
+        self.cwnd = max(self.cwnd, self.w_est)
+
+
+CONGESTION_CONTROLS: dict[str, type[Reno]] = {
+    "reno": Reno,
+    "cubic": Cubic,
+}
@@ -0,0 +1,742 @@
+import heapq
+import math
+import struct
+from collections import deque
+
+from app.ratelimit import TokenBucket
+from app.udp.congestion import CONGESTION_CONTROLS, MAX_WINDOW
+from app.udp.fec import MAX_GROUP, PARITY, FECController, encode_parity, recover
+from app.udp.pmtu import PMTUSearch
+from app.udp.rtt import MAX_RTO, RTTEstimator
+from app.udp.window import (
+    DUPLICATE,
+    IN_FLIGHT,
+    IN_ORDER,
+    LOST,
+    SACKED,
+    RecvWindow,
+    SendWindow,
+)
+
+CONGESTION_CONTROL = "cubic"
+
+DGRAM_SIZE = 1400
+HEADER = struct.Struct("!IIHBB")
+HEADER_SIZE = HEADER.size
+PAYLOAD_SIZE = DGRAM_SIZE - HEADER_SIZE
+
+SACK_BLOCK = struct.Struct("!II")
+MAX_SACK_BLOCKS = 32
+DUP_THRESH = 3
+REO_WND_DIVISOR = 4
+MAX_REO_MULT = 16
+REO_DECAY_RECOVERIES = 16
+SEND_WINDOW = 2 * MAX_WINDOW
+RECV_WINDOW = MAX_WINDOW
+INITIAL_PEER_WINDOW = 64
+
+FLAG_PUSH = 1
+FLAG_RST = 2
+FLAG_PROBE = 4
+FLAG_MTU_PROBE = 8
+FLAG_MTU_ACK = 16
+FLAG_FEC = 32
+FLAG_FEC_OK = 64
+FLAG_FEC_RECOVERED = 128
+ACK_EVERY = 2
+USE_FEC = True
+
+PACING_GAIN = 1.25
+SLOW_START_PACING_GAIN = 2.0
+PACING_BURST = 16 * PAYLOAD_SIZE
+PACING_GRANULARITY = 0.001
+DRR_QUANTUM = 16 * PAYLOAD_SIZE
+
+PEER_OPEN = 0
+PEER_RESET = 1
+PEER_IGNORE = 2
+
+Frame = list[bytes | memoryview]
+
+
+def classify_opening(data: bytes) -> int:
+    sn, _, _, flags, sack_count = HEADER.unpack_from(data)
+    if flags & FLAG_RST:
+        return PEER_IGNORE
+    if sn != 0 or len(data) <= HEADER_SIZE + sack_count * SACK_BLOCK.size:
+        return PEER_RESET
+    return PEER_OPEN
+
+
+class ReliableUDPCore:
+    def __init__(
+        self,
+        congestion: str = CONGESTION_CONTROL,
+        fec: bool = USE_FEC,
+        send_window: int = SEND_WINDOW,
+        recv_window: int = RECV_WINDOW,
+        now: float = 0.0,
+    ):
+        self._fec = fec
+        self._congestion = congestion
+        self._send_window = send_window
+        self._recv_window = recv_window
+        self._outbox: list[tuple[int, Frame]] = []
+        self._lost: list[int] = []
+        self._sent_order: deque[tuple[int, int]] = deque()
+        self._sack_seen: dict[int, int] = {}
+        self._timers: list[tuple[float, int, int, int]] = []
+        self._fec_cache: dict[int, bytes | memoryview] = {}
+        self._bucket: TokenBucket | None = None
+        self._keepalive: float | None = None
+        self._greeting: memoryview | None = None
+        self._reset(now)
+
+    def receive_datagram(self, dgram: bytes, now: float):
+        self._handle_dgram(dgram, now)
+
+    def poll(self, now: float) -> list[tuple[int, Frame]]:
+        self._advance(now)
+        outbox, self._outbox = self._outbox, []
+        return outbox
+
+    def next_deadline(self) -> float | None:
+        return self._deadline()
+
+    def is_reopened_by(self, dgram: bytes) -> bool:
+        _, an, _, _, _ = HEADER.unpack_from(dgram)
+        return an == 0 < self._send.base and classify_opening(dgram) == PEER_OPEN
+
+    def push(self, data: bytes | memoryview) -> int:
+        view = memoryview(data).cast("B")
+        w = self._send
+        pushed = 0
+        while pushed < len(view) and w.free():
+            w.push(view[pushed : pushed + PAYLOAD_SIZE])
+            pushed += PAYLOAD_SIZE
+        return min(pushed, len(view))
+
+    def available(self) -> int:
+        return self._recv.available()
+
+    def pop(self, n: int) -> list[bytes]:
+        chunks = self._recv.pop(n)
+        self._update_window()
+        return chunks
+
+    @property
+    def stats(self) -> dict:
+        return {
+            "fec": self._fec and self._peer_fec,
+            "fec_group": self._fec_ctl.group,
+            "fec_parity": self._fec_parity_sent,
+            "fec_recovered": self._fec_recovered,
+        }
+
+    @property
+    def cwnd(self) -> float:
+        return self._cc.cwnd
+
+    @property
+    def srtt(self) -> float | None:
+        return self._rtt.srtt
+
+    @property
+    def rto(self) -> float:
+        return self._rtt.rto
+
+    def _update_window(self):
+        r = self._recv
+        if r.read + r.capacity - self._adv_edge >= r.capacity // 4:
+            self._ack_now = True
+
+    def _deadline(self) -> float | None:
+        while self._timers:
+            _, tx, sn, count = self._timers[0]
+            if self._is_in_flight(sn, tx, count):
+                break
+            heapq.heappop(self._timers)
+
+        deadlines = []
+        if self._timers:
+            deadlines.append(self._timers[0][0])
+        if self._need_to_ack:
+            deadlines.append(self._tda + self._rtt.ack_delay)
+        if self._probe_deadline is not None:
+            deadlines.append(self._probe_deadline)
+        if self._pmtu.deadline is not None:
+            deadlines.append(self._pmtu.deadline)
+        if self._pace_deadline is not None:
+            deadlines.append(self._pace_deadline)
+        if self._reo_deadline is not None:
+            deadlines.append(self._reo_deadline)
+        if self._keepalive is not None and self._send.next_new:
+            deadlines.append(self._last_send + self._keepalive)
+        return min(deadlines, default=None)
+
+    def _advance(self, cur_time: float):
+        self._handle_timers(cur_time)
+        if self._reo_deadline is not None and cur_time >= self._reo_deadline:
+            lost = self._detect_losses(cur_time)
+            if lost:
+                self._on_loss(lost, cur_time)
+        self._transmit(cur_time)
+        self._send_parity()
+        self._handle_persist(cur_time)
+        self._handle_pmtu(cur_time)
+
+        if (
+            self._ack_now
+            or self._unacked >= ACK_EVERY
+            or (self._need_to_ack and cur_time - self._tda >= self._rtt.ack_delay)
+        ):
+            self._send_ack()
+        self._handle_keepalive(cur_time)
+
+    def _is_in_flight(self, first: int, tx: int, count: int = 1) -> bool:
+        w = self._send
+        for sn in range(first, first + count):
+            i = sn & w.mask
+            if w.contains(sn) and w.txs[i] == tx and w.flags[i] & IN_FLIGHT:
+                return True
+        return False
+
+    def _handle_timers(self, cur_time: float):
+        expired = []
+        while self._timers and self._timers[0][0] <= cur_time:
+            _, tx, sn, count = heapq.heappop(self._timers)
+            if not self._rack_covers(sn, tx) and self._is_in_flight(sn, tx, count):
+                expired.append((tx, sn, count))
+
+        if not expired:
+            return
+
+        w = self._send
+        if self._rtt.backoff == 1 and all(
+            w.transmissions[sn & w.mask] == 1 for _, sn, _ in expired
+        ):
+            lost = 0
+            for tx, first, count in expired:
+                for sn in range(first, first + count):
+                    if self._is_in_flight(sn, tx):
+                        self._mark_lost(sn)
+                        lost += 1
+            self._rtt.on_timeout()
+            self._on_loss(lost, cur_time)
+            return
+
+        self._cc.on_timeout(cur_time)
+        self._rtt.on_timeout()
+        if self._rtt.backoff >= 4 and self._pmtu.units > 1:
+            self._pmtu.on_black_hole(cur_time)
+
+        self._recovery_sn = w.next_new
+        for sn in range(w.base, w.next_new):
+            i = sn & w.mask
+            if w.flags[i] & IN_FLIGHT:
+                w.flags[i] = LOST
+                self._lost.append(sn)
+        heapq.heapify(self._lost)
+        self._sent_order.clear()
+        self._reo_deadline = None
+        self._undo = None
+        self._fec_ctl.on_lost(self._in_flight)
+        self._in_flight = 0
+
+    def _handle_persist(self, cur_time: float):
+        w = self._send
+        if self._in_flight or not self._peer_edge <= w.next_new < w.end:
+            self._probe_deadline = None
+            self._probe_backoff = 1
+            return
+
+        if self._probe_deadline is None:
+            self._probe_deadline = cur_time + self._rtt.rto
+        elif cur_time >= self._probe_deadline:
+            self._send_ack(FLAG_PROBE)
+            self._probe_backoff = min(self._probe_backoff * 2, 64)
+            backoff = min(self._rtt.rto * self._probe_backoff, MAX_RTO)
+            self._probe_deadline = cur_time + backoff
+
+    def _handle_keepalive(self, cur_time: float):
+        if self._keepalive is None or not self._send.next_new:
+            return
+        if not self._outbox and cur_time - self._last_send >= self._keepalive:
+            self._send_ack(FLAG_PROBE)
+        if self._outbox:
+            self._last_send = cur_time
+
+    def _transmit(self, cur_time: float):
+        w = self._send
+        window = self._cc.window
+        max_units = 1 if self._fec_group() else self._pmtu.units
+        budget = self._send_budget(cur_time)
+        sent = 0
+
+        while self._in_flight < window and sent < budget:
+            sn = self._take_sn()
+            if sn < 0:
+                break
+            units = [sn]
+            while (
+                len(units) < max_units
+                and self._in_flight + len(units) < window
+                and len(w.payloads[units[-1] & w.mask]) == PAYLOAD_SIZE
+                and self._next_sn() == units[-1] + 1
+            ):
+                units.append(self._take_sn())
+
+            self._tx_count += 1
+            frame = [self._header(sn, FLAG_PUSH if units[-1] == w.end - 1 else 0, 0)]
+            size = HEADER_SIZE
+            for sn in units:
+                i = sn & w.mask
+                payload = w.payloads[i]
+                frame.append(payload)
+                size += len(payload)
+                w.txs[i] = self._tx_count
+                w.send_times[i] = cur_time
+                w.transmissions[i] = min(w.transmissions[i] + 1, 0xFFFF)
+                w.flags[i] = IN_FLIGHT
+                self._sent_order.append((self._tx_count, sn))
+            self._outbox.append((size, frame))
+            sent += size
+            self._in_flight += len(units)
+            deadline = cur_time + self._rtt.rto
+            heapq.heappush(
+                self._timers, (deadline, self._tx_count, units[0], len(units))
+            )
+
+            if self._need_to_ack:
+                self._need_to_ack = False
+                self._unacked = 0
+
+        self._charge(sent, cur_time)
+
+    def _buckets(self) -> list[TokenBucket]:
+        buckets = [self._pacer] if self._pacer.rate else []
+        for bucket in (self._bucket, self._shared_bucket()):
+            if bucket is not None:
+                buckets.append(bucket)
+        return buckets
+
+    def _shared_bucket(self) -> TokenBucket | None:
+        return None
+
+    def _sibling_count(self) -> int:
+        return 1
+
+    def _pacing_rate(self) -> float:
+        srtt = self._rtt.srtt
+        if not srtt:
+            return 0.0
+        cc = self._cc
+        gain = SLOW_START_PACING_GAIN if cc.cwnd < cc.ssthresh else PACING_GAIN
+        return gain * cc.cwnd * PAYLOAD_SIZE / srtt
+
+    def _send_budget(self, cur_time: float) -> float:
+        rate = self._pacing_rate()
+        self._pacer.rate = rate
+        self._pacer.burst = max(PACING_BURST, rate * PACING_GRANULARITY)
+
+        budget = min(
+            (bucket.available(cur_time) for bucket in self._buckets()),
+            default=math.inf,
+        )
+        if self._drr_active():
+            if self._next_sn() < 0:
+                self._deficit = 0
+            else:
+                self._deficit += DRR_QUANTUM
+                budget = min(budget, self._deficit)
+        return budget
+
+    def _charge(self, sent: int, cur_time: float):
+        self._pace_deadline = None
+        if sent:
+            for bucket in self._buckets():
+                bucket.consume(sent)
+            if self._drr_active():
+                self._deficit = max(0, self._deficit - sent)
+
+        if self._in_flight >= self._cc.window or self._next_sn() < 0:
+            return
+        delay = max((bucket.delay(cur_time) for bucket in self._buckets()), default=0.0)
+        self._pace_deadline = cur_time + delay
+
+    def _drr_active(self) -> bool:
+        return self._shared_bucket() is not None and self._sibling_count() > 1
+
+    def _fec_group(self) -> int:
+        if not (self._fec and self._peer_fec):
+            return 0
+        return self._fec_ctl.group
+
+    def _send_parity(self):
+        w = self._send
+        group = self._fec_group()
+        if not group:
+            self._fec_next = w.next_new
+            return
+
+        self._fec_next = max(self._fec_next, w.base)
+        while self._fec_next < w.next_new:
+            start = self._fec_next
+            n = min(group, w.next_new - start)
+            if n < group and w.next_new < w.end:
+                break
+            payloads = [w.payloads[sn & w.mask] for sn in range(start, start + n)]
+            parity = encode_parity(payloads)
+            header = self._header(start, FLAG_FEC, 0)
+            self._outbox.append((HEADER_SIZE + len(parity), [header, parity]))
+            self._fec_next += n
+            self._fec_parity_sent += 1
+
+    def _handle_parity(self, start: int, data: memoryview, now: float):
+        n, lengths = PARITY.unpack_from(data)
+        r = self._recv
+        missing = [
+            sn
+            for sn in range(start, start + n)
+            if r.ack <= sn < r.read + r.capacity and r.payloads[sn & r.mask] is None
+        ]
+        if len(missing) != 1:
+            return
+
+        others = [
+            self._fec_cache.get(sn)
+            for sn in range(start, start + n)
+            if sn != missing[0]
+        ]
+        if any(payload is None for payload in others):
+            return
+
+        payload = recover(data[PARITY.size :], lengths, others)
+        self._handle_payload(missing[0], payload, now)
+        self._fec_recovered += 1
+        self._fec_signal = True
+        self._ack_now = True
+
+    def _next_sn(self) -> int:
+        w = self._send
+        while self._lost:
+            sn = self._lost[0]
+            if w.contains(sn) and w.flags[sn & w.mask] == LOST:
+                return sn
+            heapq.heappop(self._lost)
+        if w.next_new < min(w.end, self._peer_edge):
+            return w.next_new
+        return -1
+
+    def _take_sn(self) -> int:
+        sn = self._next_sn()
+        if self._lost:
+            heapq.heappop(self._lost)
+        elif sn >= 0:
+            self._send.next_new += 1
+        return sn
+
+    def _handle_pmtu(self, cur_time: float):
+        if self._rtt.srtt is None:
+            return
+        units = self._pmtu.next_probe(cur_time, self._rtt.rto)
+        if not units:
+            return
+
+        probe = self._header(units, FLAG_MTU_PROBE, 0) + bytes(units * PAYLOAD_SIZE)
+        self._send_probe(probe, cur_time)
+
+    def _send_probe(self, probe: bytes, cur_time: float):
+        self._outbox.append((len(probe), [probe]))
+
+    def _header(self, sn: int, flags: int, sack_count: int) -> bytes:
+        if self._fec:
+            flags |= FLAG_FEC_OK
+        r = self._recv
+        self._adv_edge = r.read + r.capacity
+        return HEADER.pack(sn, r.ack, self._adv_edge - r.ack, flags, sack_count)
+
+    def _send_ack(self, flags: int = 0):
+        if self._fec_signal:
+            flags |= FLAG_FEC_RECOVERED
+            self._fec_signal = False
+        blocks = self._recv.sack_blocks(MAX_SACK_BLOCKS)
+        header = self._header(self._send.base, flags, len(blocks))
+        sack = b"".join(SACK_BLOCK.pack(start, end) for start, end in blocks)
+        self._outbox.append((len(header) + len(sack), [header + sack]))
+        self._need_to_ack = False
+        self._unacked = 0
+        self._ack_now = False
+
+    def _handle_dgram(self, dgram: bytes, now: float):
+        sn, an, wnd, flags, sack_count = HEADER.unpack_from(dgram)
+        if flags & FLAG_RST:
+            if self._rst_armed:
+                self._restart(now)
+            return
+        self._rst_armed = True
+        if flags & FLAG_MTU_PROBE:
+            self._outbox.append((HEADER_SIZE, [self._header(sn, FLAG_MTU_ACK, 0)]))
+            return
+        if flags & FLAG_MTU_ACK:
+            self._pmtu.on_ack(sn, now)
+            return
+        self._peer_fec = bool(flags & FLAG_FEC_OK)
+        if flags & FLAG_FEC_RECOVERED:
+            self._fec_ctl.on_lost(1)
+        edge = an + wnd
+        pure = not flags & FLAG_PROBE and edge <= self._peer_edge
+        self._peer_edge = max(self._peer_edge, edge)
+        if flags & FLAG_PROBE:
+            self._ack_now = True
+
+        offset = HEADER_SIZE + sack_count * SACK_BLOCK.size
+        blocks = [
+            SACK_BLOCK.unpack_from(dgram, HEADER_SIZE + i * SACK_BLOCK.size)
+            for i in range(sack_count)
+        ]
+        payload = memoryview(dgram)[offset:]
+
+        if flags & FLAG_FEC:
+            if self._fec:
+                self._handle_parity(sn, payload, now)
+            return
+
+        if payload:
+            for k in range(0, len(payload), PAYLOAD_SIZE):
+                self._handle_payload(sn, payload[k : k + PAYLOAD_SIZE], now)
+                sn += 1
+            if flags & FLAG_PUSH:
+                self._ack_now = True
+            if self._discard and self._recv.available():
+                n = min(self._discard, self._recv.available())
+                self.pop(n)
+                self._discard -= n
+
+        if self._send.next_new > self._send.base:
+            self._handle_ack(an, blocks, pure and not payload, now)
+
+    def _handle_payload(self, sn: int, payload: bytes, now: float):
+        ack = self._recv.ack
+        result = self._recv.accept(sn, payload)
+        if self._fec and self._peer_fec and result != DUPLICATE:
+            self._cache_payload(sn, payload)
+
+        if result == IN_ORDER:
+            self._unacked += 1
+            if not self._need_to_ack:
+                self._need_to_ack = True
+                self._tda = now
+            if self._recv.ranges or self._recv.ack > ack + 1:
+                self._ack_now = True
+        else:
+            self._ack_now = True
+
+    def _cache_payload(self, sn: int, payload: bytes | memoryview):
+        self._fec_cache[sn] = payload
+        floor = self._recv.ack - MAX_GROUP
+        while self._fec_floor < floor:
+            self._fec_cache.pop(self._fec_floor, None)
+            self._fec_floor += 1
+
+    def _handle_ack(
+        self, an: int, blocks: list[tuple[int, int]], pure: bool, cur_time: float
+    ):
+        w = self._send
+        an = min(an, w.next_new)
+        delivered = 0
+        spurious = 0
+        sample = -1
+
+        if an > w.base:
+            for sn in range(w.base, an):
+                i = sn & w.mask
+                flags = w.flags[i]
+                if flags & IN_FLIGHT:
+                    self._in_flight -= 1
+                if not flags & SACKED:
+                    delivered += 1
+                    sample = sn
+                    spurious += self._rack_update(i, cur_time)
+                w.release(sn)
+            w.base = an
+            self._dupacks = 0
+            self._sack_seen = {s: e for s, e in self._sack_seen.items() if e > an}
+        elif pure and self._in_flight:
+            self._dupacks += 1
+
+        for start, end in blocks:
+            lo = max(start, self._sack_seen.get(start, start), w.base)
+            hi = min(end, w.next_new)
+            for sn in range(lo, hi):
+                i = sn & w.mask
+                flags = w.flags[i]
+                if flags & SACKED:
+                    continue
+                w.flags[i] = SACKED
+                if flags & IN_FLIGHT:
+                    self._in_flight -= 1
+                delivered += 1
+                sample = sn
+                spurious += self._rack_update(i, cur_time)
+            if hi > lo:
+                self._sack_seen[start] = hi
+
+        if sample >= 0 and w.transmissions[sample & w.mask] == 1:
+            self._rtt.sample(cur_time - w.send_times[sample & w.mask])
+
+        if spurious:
+            self._on_spurious(spurious)
+        lost = self._detect_losses(cur_time)
+        if lost:
+            self._on_loss(lost, cur_time)
+        elif delivered:
+            self._cc.on_ack(delivered, cur_time)
+        self._fec_ctl.on_delivered(delivered)
+
+    def _rack_update(self, i: int, cur_time: float) -> int:
+        w = self._send
+        rtt = cur_time - w.send_times[i]
+        if w.flags[i] == LOST:
+            return 1
+        if w.transmissions[i] > 1 and rtt < (self._rtt.min_rtt or 0.0):
+            return 1
+        if w.txs[i] > self._rack_tx:
+            self._rack_tx = w.txs[i]
+            self._rack_rtt = rtt
+        return 0
+
+    def _rack_covers(self, sn: int, tx: int) -> bool:
+        w = self._send
+        slack = self._fec_group() if w.transmissions[sn & w.mask] == 1 else 0
+        return tx + slack < self._rack_tx
+
+    def _reo_wnd(self) -> float:
+        min_rtt = self._rtt.min_rtt
+        if min_rtt is None:
+            return 0.0
+        return min(self._reo_mult * min_rtt / REO_WND_DIVISOR, self._rtt.srtt)
+
+    def _detect_losses(self, cur_time: float) -> int:
+        w = self._send
+        lost = 0
+        reo_wnd = self._reo_wnd()
+        self._reo_deadline = None
+
+        while self._sent_order:
+            tx, sn = self._sent_order[0]
+            if not self._is_in_flight(sn, tx):
+                self._sent_order.popleft()
+                continue
+            if not self._rack_covers(sn, tx):
+                break
+            deadline = w.send_times[sn & w.mask] + self._rack_rtt + reo_wnd
+            if cur_time < deadline:
+                self._reo_deadline = deadline
+                break
+            self._sent_order.popleft()
+            self._mark_lost(sn)
+            lost += 1
+
+        i = w.base & w.mask
+        if (
+            self._dupacks >= DUP_THRESH + self._fec_group()
+            and w.base < w.next_new
+            and w.flags[i] & IN_FLIGHT
+            and w.transmissions[i] == 1
+            and not self._rack_covers(w.base, w.txs[i])
+        ):
+            self._mark_lost(w.base)
+            self._dupacks = 0
+            lost += 1
+
+        return lost
+
+    def _mark_lost(self, sn: int):
+        w = self._send
+        w.flags[sn & w.mask] = LOST
+        self._in_flight -= 1
+        heapq.heappush(self._lost, sn)
+        self._fec_ctl.on_lost(1)
+
+    def _on_loss(self, count: int, cur_time: float):
+        w = self._send
+        if w.base < self._recovery_sn:
+            self._undo_retrans += count
+            return
+        self._undo = self._cc.save()
+        self._undo_retrans = count
+        self._cc.on_loss(cur_time)
+        self._recovery_sn = w.next_new
+        self._reo_recoveries += 1
+        if self._reo_recoveries >= REO_DECAY_RECOVERIES:
+            self._reo_mult = 1
+            self._reo_recoveries = 0
+
+    def _on_spurious(self, count: int):
+        self._reo_mult = min(self._reo_mult + 1, MAX_REO_MULT)
+        self._reo_recoveries = 0
+        if self._undo is None:
+            return
+        self._undo_retrans -= count
+        if self._undo_retrans <= 0:
+            self._cc.restore(self._undo)
+            self._undo = None
+            self._recovery_sn = self._send.base
+
+    def _restart(self, now: float):
+        w = self._send
+        pending = [w.payloads[sn & w.mask] for sn in range(w.base, w.end)]
+        self._reset(now)
+        if self._greeting is not None:
+            self._send.push(self._greeting)
+            self._discard = 1
+        for payload in pending:
+            if payload is not self._greeting:
+                self._send.push(payload)
+        self._rst_armed = False
+
+    def _reset(self, now: float):
+        self._need_to_ack = False
+        self._tda = 0.0
+        self._unacked = 0
+        self._ack_now = False
+        self._rst_armed = True
+        self._last_send = now
+        self._discard = 0
+        self._outbox.clear()
+        self._send = SendWindow(self._send_window)
+        self._recv = RecvWindow(self._recv_window)
+        self._lost.clear()
+        self._sent_order.clear()
+        self._sack_seen.clear()
+        self._cc = CONGESTION_CONTROLS[self._congestion]()
+        self._in_flight = 0
+        self._rtt = RTTEstimator()
+        self._tx_count = 0
+        self._rack_tx = 0
+        self._rack_rtt = 0.0
+        self._reo_mult = 1
+        self._reo_recoveries = 0
+        self._reo_deadline: float | None = None
+        self._undo: dict | None = None
+        self._undo_retrans = 0
+        self._dupacks = 0
+        self._recovery_sn = 0
+        self._timers.clear()
+        self._peer_edge = INITIAL_PEER_WINDOW
+        self._adv_edge = self._recv_window
+        self._probe_deadline: float | None = None
+        self._probe_backoff = 1
+        self._pmtu = PMTUSearch()
+        self._pacer = TokenBucket(0.0, PACING_BURST, now)
+        self._pace_deadline: float | None = None
+        self._deficit = 0
+        self._peer_fec = False
+        self._fec_ctl = FECController()
+        self._fec_next = 0
+        self._fec_cache.clear()
+        self._fec_floor = 0
+        self._fec_signal = False
+        self._fec_parity_sent = 0
+        self._fec_recovered = 0
@@ -0,0 +1,57 @@
+import struct
+from collections.abc import Iterable
+
+PARITY = struct.Struct("!BH")
+
+MIN_GROUP = 4
+MAX_GROUP = 32
+MIN_LOSS_RATE = 0.001
+TARGET_LOSSES = 0.5
+LOSS_ALPHA = 1 / 64
+
+
+class FECController:
+    def __init__(self):
+        self.loss_rate = 0.0
+
+    @property
+    def group(self) -> int:
+        if self.loss_rate < MIN_LOSS_RATE:
+            return 0
+        return max(MIN_GROUP, min(MAX_GROUP, int(TARGET_LOSSES / self.loss_rate)))
+
+    def on_delivered(self, n: int):
+        self.loss_rate *= (1 - LOSS_ALPHA) ** n
+
+    def on_lost(self, n: int):
+        self.loss_rate = 1 - (1 - self.loss_rate) * (1 - LOSS_ALPHA) ** n
+
+
+def encode_parity(payloads: list[bytes | memoryview]) -> bytes:
+    acc = 0
+    lengths = 0
+    size = 0
+    for payload in payloads:
+        acc ^= int.from_bytes(payload, "little")
+        lengths ^= len(payload)
+        size = max(size, len(payload))
+    return PARITY.pack(len(payloads), lengths) + acc.to_bytes(size, "little")
+
+
+def recover(
+    parity: bytes | memoryview, lengths: int, payloads: Iterable[bytes | memoryview]
+) -> bytes:
+    acc = int.from_bytes(parity, "little")
+    for payload in payloads:
+        acc ^= int.from_bytes(payload, "little")
+        lengths ^= len(payload)
+    return acc.to_bytes(len(parity), "little")[:lengths]
+
+
+def print_fec_stats(stats: dict):
+    if not stats["fec"]:
+        return
+    print(
+        f"FEC: {stats['fec_parity']} parity datagrams sent, "
+        f"{stats['fec_recovered']} datagrams recovered"
+    )
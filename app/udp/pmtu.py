@@ -0,0 +1,57 @@
+BASE_UNITS = 1
+PROBE_UNITS = (6, 11, 23, 47)
+MAX_PROBES = 3
+RAISE_INTERVAL = 600.0
+
+
+class PMTUSearch:
+    def __init__(self, candidates: tuple[int, ...] = PROBE_UNITS):
+        self.candidates = candidates
+        self.units = BASE_UNITS
+        self.probe_units = 0
+        self.probes = 0
+        self.deadline: float | None = None
+        self.next_search = 0.0
+
+    def next_probe(self, now: float, timeout: float) -> int:
+        if self.probe_units:
+            if now < self.deadline:
+                return 0
+            self.probes += 1
+            if self.probes >= MAX_PROBES:
+                self._finish(now)
+                return 0
+        else:
+            if now < self.next_search:
+                return 0
+            larger = [units for units in self.candidates if units > self.units]
+            if not larger:
+                self._finish(now)
+                return 0
+            self.probe_units = larger[0]
+            self.probes = 0
+
+        self.deadline = now + timeout
+        return self.probe_units
+
+    def on_ack(self, units: int, now: float):
+        if units != self.probe_units:
+            return
+        self.units = units
+        self.probe_units = 0
+        self.deadline = None
+        self.next_search = now
+
+    def on_probe_too_big(self, now: float):
+        self._finish(now)
+
+    def on_black_hole(self, now: float):
+        self.units = BASE_UNITS
+        self.probe_units = 0
+        self.deadline = None
+        self.next_search = now
+
+    def _finish(self, now: float):
+        self.probe_units = 0
+        self.deadline = None
+        self.next_search = now + RAISE_INTERVAL
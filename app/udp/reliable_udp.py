@@ -1,40 +1,143 @@
 import errno
 import math
+import os
+import selectors
 import socket
 import struct
+import sys
+import threading
 import time
+from collections import deque
+from collections.abc import Callable
+from typing import BinaryIO
 
 import app.protocol as proto
+from app.ratelimit import TokenBucket
+from app.udp.core import (
+    CONGESTION_CONTROL,
+    FLAG_RST,
+    HEADER,
+    HEADER_SIZE,
+    PAYLOAD_SIZE,
+    PEER_OPEN,
+    PEER_RESET,
+    RECV_WINDOW,
+    SEND_WINDOW,
+    USE_FEC,
+    Frame,
+    ReliableUDPCore,
+    classify_opening,
+)
 
-MAX_WINDOW_SIZE = 5
-RTO = 20
-DELAY_ACK = RTO / 3
+MAX_DGRAM_SIZE = 65507
+CHUNK_SIZE = 5 * PAYLOAD_SIZE
+PLACEMENT_SIZE = 256 * PAYLOAD_SIZE
 
-DGRAM_SIZE = 1400
-HEADER_SIZE = 8
-PAYLOAD_SIZE = DGRAM_SIZE - HEADER_SIZE
+MAX_BATCH = 256
+SOCKET_BUFFER_SIZE = 4 << 20
 
+SOL_UDP = getattr(socket, "SOL_UDP", 17)
+UDP_SEGMENT = getattr(socket, "UDP_SEGMENT", 103)
+UDP_GRO = getattr(socket, "UDP_GRO", 104)
+GSO_MAX_SEGMENTS = 64
+GSO_MAX_SIZE = 65000
+GRO_BUFFER_SIZE = 65535
+GRO_CMSG_SIZE = (
+    socket.CMSG_SPACE(struct.calcsize("i")) if hasattr(socket, "CMSG_SPACE") else 0
+)
+USE_UDP_OFFLOAD = True
 
-class Datagram:
-    def __init__(self, payload: bytes, send_time: float):
-        self.payload = payload
-        self.send_time = send_time
-        self.in_flight = False
+IP_MTU_DISCOVER = getattr(socket, "IP_MTU_DISCOVER", 10)
+IP_PMTUDISC_PROBE = getattr(socket, "IP_PMTUDISC_PROBE", 3)
 
+MAX_PEERS = 1024
+IDLE_TIMEOUT = 30.0
+KEEPALIVE_INTERVAL = IDLE_TIMEOUT / 3
 
-class ReliableUDP:
-    def __init__(self):
-        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self.sock.setblocking(False)
+
+def set_buffer_sizes(sock: socket.socket):
+    for option in (socket.SO_RCVBUF, socket.SO_SNDBUF):
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, option, SOCKET_BUFFER_SIZE)
+        except OSError:
+            pass
+
+
+def set_dont_fragment(sock: socket.socket):
+    if not sys.platform.startswith("linux"):
+        return
+    try:
+        sock.setsockopt(socket.IPPROTO_IP, IP_MTU_DISCOVER, IP_PMTUDISC_PROBE)
+    except OSError:
+        pass
+
+
+class ReliableUDP(ReliableUDPCore):
+    def __init__(
+        self,
+        congestion: str = CONGESTION_CONTROL,
+        offload: bool = USE_UDP_OFFLOAD,
+        fec: bool = USE_FEC,
+        parent: "ReliableUDP | None" = None,
+        send_window: int = SEND_WINDOW,
+        recv_window: int = RECV_WINDOW,
+    ):
+        now = time.monotonic()
+        super().__init__(congestion, fec, send_window, recv_window, now)
+        self._root = parent or self
+        if parent is None:
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.sock.setblocking(False)
+            set_buffer_sizes(self.sock)
+            self._gso = offload and self._enable_gso()
+            self._gro = offload and self._enable_gro()
+            self._keepalive = KEEPALIVE_INTERVAL
+            set_dont_fragment(self.sock)
+        else:
+            self.sock = parent.sock
+            self._gso = parent._gso
+            self._gro = parent._gro
         self._timeout = None
-        self._tda = 0
-        self._need_to_ack = False
-        self._sn = 0
-        self._an = 0
-        self._send_buffer: dict[int, Datagram] = {}
-        self._recv_buffer: dict[int, bytes] = {}
         self._addr: tuple[str, int] = ("0.0.0.0", 0)
-        self._window_size = MAX_WINDOW_SIZE
+        self._rr = 0
+        self._last_seen = now
+
+        self._closed = False
+        self._peer_changed = False
+        self._error: OSError | None = None
+        self._peers: dict[tuple[str, int], ReliableUDP] = {}
+        self._backlog: deque[ReliableUDP] | None = None
+        if parent is not None:
+            self._cond = parent._cond
+            return
+
+        self._cond = threading.Condition()
+        self._wakeup_recv, self._wakeup_send = socket.socketpair()
+        self._wakeup_recv.setblocking(False)
+        self._wakeup_send.setblocking(False)
+        self._selector = selectors.DefaultSelector()
+        self._selector.register(self.sock, selectors.EVENT_READ)
+        self._selector.register(self._wakeup_recv, selectors.EVENT_READ)
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _enable_gso(self) -> bool:
+        if not sys.platform.startswith("linux") or not hasattr(self.sock, "sendmsg"):
+            return False
+        try:
+            self.sock.getsockopt(SOL_UDP, UDP_SEGMENT)
+        except OSError:
+            return False
+        return True
+
+    def _enable_gro(self) -> bool:
+        if not sys.platform.startswith("linux") or not hasattr(self.sock, "recvmsg"):
+            return False
+        try:
+            self.sock.setsockopt(SOL_UDP, UDP_GRO, 1)
+        except OSError:
+            return False
+        return True
 
     def bind(self, addr: tuple[str, int]):
         self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
@@ -43,129 +146,408 @@ class ReliableUDP:
     def set_timeout(self, seconds: float | None):
         self._timeout = seconds
 
-    def sendto(self, msg: bytes, addr: tuple[str, int]):
-        if addr != self._addr:
-            self._addr = addr
+    def set_bucket(self, bucket: TokenBucket | None):
+        with self._cond:
+            self._bucket = bucket
+
+    def set_greeting(self, msg: bytes):
+        with self._cond:
+            self._greeting = memoryview(msg)
+
+    def listen(self):
+        with self._cond:
+            self._backlog = deque()
+            self._keepalive = None
             self.reset()
 
-        n = math.ceil(len(msg) / PAYLOAD_SIZE)
+    def accept(self) -> tuple["ReliableUDP", tuple[str, int]]:
+        with self._cond:
+            backlog = self._backlog
+            if backlog is None:
+                raise OSError(errno.EINVAL, "Socket is not listening")
+            self._wait(lambda: bool(backlog))
+            conn = backlog.popleft()
+            return conn, conn._addr
 
-        temp_sn = self._sn
-        for i in range(n):
-            payload = msg[i * PAYLOAD_SIZE : (i + 1) * PAYLOAD_SIZE]
-            dgram = Datagram(payload, 0)
-            self._send_buffer[temp_sn] = dgram
-            temp_sn += 1
+    def sendto(self, msg: bytes, addr: tuple[str, int]):
+        with self._cond:
+            if addr != self._addr:
+                self._addr = addr
+                self.reset()
+            self.write(msg)
+            self.flush()
 
-        start_time = time.monotonic()
-        while self._sn < temp_sn:
-            try:
-                self._event_loop_step()
-            except OSError as e:
-                if e.errno in (errno.ENETUNREACH, errno.EHOSTUNREACH):
-                    pass
-                else:
-                    raise
-            if (
-                self._timeout is not None
-                and time.monotonic() - start_time > self._timeout
-            ):
-                raise socket.timeout("timeout")
-            time.sleep(0.005)
+    def write(self, data: bytes | memoryview) -> int:
+        view = memoryview(data).cast("B")
+        if not view.readonly:
+            view = memoryview(bytes(view))
+        size = len(view)
+
+        with self._cond:
+            while view:
+                self._wait(lambda: self._send.free() > 0)
+                view = view[self.push(view) :]
+
+                self._transmit(time.monotonic())
+                self._flush()
+                self._wakeup()
+        return size
+
+    def flush(self):
+        with self._cond:
+            self._wait(lambda: not len(self._send))
 
     def send(self, msg: bytes):
         self.sendto(msg, self._addr)
 
     def recvfrom(self, size: int = PAYLOAD_SIZE) -> tuple[bytes, tuple[str, int]]:
         n = math.ceil(size / PAYLOAD_SIZE)
-        except_an = self._an + n
 
-        for an in self._recv_buffer:
-            if an < self._an:
-                except_an -= 1
+        chunks = []
+        with self._cond:
+            while n:
+                k = min(n, self._recv.capacity)
+                self._wait(lambda k=k: self._recv.available() >= k)
+                chunks += self.pop(k)
+                self._wakeup_for_ack()
+                n -= k
+            return (b"".join(chunks), self._addr)
+
+    def recv(self, size: int = PAYLOAD_SIZE) -> bytes:
+        msg, _ = self.recvfrom(size)
+        return msg
+
+    def recv_into(self, buf: memoryview) -> int:
+        buf = memoryview(buf).cast("B")
+
+        def sink(k: int, payload: bytes):
+            start = k * PAYLOAD_SIZE
+            end = min(start + len(payload), len(buf))
+            buf[start:end] = payload[: end - start]
+
+        return self._place(len(buf), sink)
+
+    def recv_into_file(self, f: BinaryIO, offset: int, size: int) -> int:
+        if hasattr(os, "pwrite"):
+            fd = f.fileno()
+
+            def sink(k: int, payload: bytes):
+                os.pwrite(fd, payload, offset + k * PAYLOAD_SIZE)
+        else:
+
+            def sink(k: int, payload: bytes):
+                f.seek(offset + k * PAYLOAD_SIZE)
+                f.write(payload)
+
+        return self._place(size, sink)
+
+    def _place(self, size: int, sink: Callable[[int, bytes], None]) -> int:
+        n = math.ceil(size / PAYLOAD_SIZE)
+        placed = 0
+
+        with self._cond:
+            for start in range(0, n, self._recv.capacity):
+                k = min(n - start, self._recv.capacity)
+                self._recv.place(
+                    k, lambda i, payload, start=start: sink(start + i, payload)
+                )
+                try:
+                    self._wait(lambda k=k: self._recv.available() >= k)
+                except BaseException:
+                    self._recv.sink = None
+                    raise
+                placed += self._recv.consume(k)
+                self._update_window()
+                self._wakeup_for_ack()
+        return placed
+
+    def _wakeup_for_ack(self):
+        if self._ack_now:
+            self._wakeup()
+
+    def _wait(self, predicate: Callable[[], bool]):
+        deadline = None
+        if self._timeout is not None:
+            deadline = time.monotonic() + self._timeout
 
-        start_time = time.monotonic()
-        while self._an < except_an:
+        while not predicate():
+            if self._peer_changed:
+                self._peer_changed = False
+                raise proto.PeerChangedException
+            if self._error is not None:
+                error, self._error = self._error, None
+                raise error
+            if self._closed or self._root._closed:
+                raise OSError(errno.EBADF, "Socket is closed")
+
+            if deadline is None:
+                self._cond.wait()
+                continue
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise socket.timeout("timeout")
+            self._cond.wait(remaining)
+
+    def _wakeup(self):
+        if self._root is not self:
+            self._root._wakeup()
+            return
+        try:
+            self._wakeup_send.send(b"\0")
+        except BlockingIOError:
+            pass
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if self._closed:
+                    return
+                timeout = self._next_timeout(time.monotonic())
+
+            try:
+                events = self._selector.select(timeout)
+            except (OSError, ValueError):
+                events = []
+
+            with self._cond:
+                if self._closed:
+                    return
+                for key, _ in events:
+                    if key.fileobj is self._wakeup_recv:
+                        self._drain_wakeup()
+                try:
+                    self._event_loop_step()
+                except proto.PeerChangedException:
+                    self._peer_changed = True
+                except OSError as e:
+                    self._error = e
+                    for conn in self._peers.values():
+                        conn._error = e
+                except (struct.error, ValueError) as e:
+                    print(f"Dropped malformed datagram: {e}", file=sys.stderr)
+                self._cond.notify_all()
+
+    def _drain_wakeup(self):
+        try:
+            while self._wakeup_recv.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+
+    def _shared_bucket(self) -> TokenBucket | None:
+        if self._root is self:
+            return None
+        return self._root._bucket
+
+    def _sibling_count(self) -> int:
+        if self._root is self:
+            return 1
+        return len(self._root._peers)
+
+    def _connections(self) -> list["ReliableUDP"]:
+        if self._backlog is None:
+            return [self]
+        return list(self._peers.values())
+
+    def _next_timeout(self, cur_time: float) -> float | None:
+        deadlines = [conn._deadline() for conn in self._connections()]
+        if self._peers:
+            oldest = min(conn._last_seen for conn in self._peers.values())
+            deadlines.append(oldest + IDLE_TIMEOUT)
+
+        deadlines = [d for d in deadlines if d is not None]
+        if not deadlines:
+            return None
+        return max(0.0, min(deadlines) - cur_time)
+
+    def _step(self, cur_time: float):
+        self._advance(cur_time)
+        self._flush()
+
+    def _event_loop_step(self):
+        self._receive()
+
+        cur_time = time.monotonic()
+        conns = self._connections()
+        if len(conns) > 1:
+            self._rr = (self._rr + 1) % len(conns)
+            conns = conns[self._rr :] + conns[: self._rr]
+        for conn in conns:
             try:
-                self._event_loop_step()
+                conn._step(cur_time)
             except OSError as e:
-                if e.errno in (errno.ENETUNREACH, errno.EHOSTUNREACH):
-                    pass
+                conn._error = e
+
+        for conn in list(self._peers.values()):
+            if cur_time - conn._last_seen >= IDLE_TIMEOUT:
+                self._drop(
+                    conn, proto.PeerDisconnected("Peer has been idle for too long")
+                )
+
+    def _drop(self, conn: "ReliableUDP", error: OSError):
+        del self._peers[conn._addr]
+        conn._error = error
+        conn._closed = True
+
+    def _receive(self):
+        for _ in range(MAX_BATCH):
+            try:
+                if self._gro:
+                    data, ancdata, _, addr = self.sock.recvmsg(
+                        GRO_BUFFER_SIZE, GRO_CMSG_SIZE
+                    )
                 else:
+                    data, addr = self.sock.recvfrom(MAX_DGRAM_SIZE)
+                    ancdata = []
+            except BlockingIOError:
+                return
+            except OSError as e:
+                if e.errno not in (errno.ENETUNREACH, errno.EHOSTUNREACH):
                     raise
-            if (
-                self._timeout is not None
-                and time.monotonic() - start_time > self._timeout
-            ):
-                raise socket.timeout("timeout")
-            time.sleep(0.005)
+                continue
 
-        msg = bytes()
-        for i in range(n, 0, -1):
-            msg += self._recv_buffer.pop(self._an - i)
+            if len(data) < HEADER_SIZE:
+                continue
+            try:
+                self._dispatch(addr, data, ancdata)
+            except (struct.error, ValueError) as e:
+                print(f"Dropped malformed datagram from {addr}: {e}", file=sys.stderr)
 
-        return (msg, self._addr)
+    def _dispatch(self, addr: tuple[str, int], data: bytes, ancdata: list):
+        conn = self._demux(addr, data)
+        if conn is None:
+            return
 
-    def recv(self, size: int = PAYLOAD_SIZE) -> bytes:
-        msg, _ = self.recvfrom(size)
-        return msg
+        segment = len(data)
+        for level, kind, cdata in ancdata:
+            if level == SOL_UDP and kind == UDP_GRO:
+                segment = struct.unpack("i", cdata[: struct.calcsize("i")])[0]
 
-    def _event_loop_step(self):
-        try:
-            dgram, addr = self.sock.recvfrom(DGRAM_SIZE)
+        now = time.monotonic()
+        if segment >= len(data):
+            conn.receive_datagram(data, now)
+            return
+        for offset in range(0, len(data), segment):
+            dgram = data[offset : offset + segment]
+            if len(dgram) >= HEADER_SIZE:
+                conn.receive_datagram(dgram, now)
+
+    def _demux(self, addr: tuple[str, int], data: bytes) -> "ReliableUDP | None":
+        if self._backlog is None:
             if addr != self._addr:
                 self._addr = addr
                 self.reset()
                 raise proto.PeerChangedException
-            self._handle_dgram(dgram)
+            return self
+
+        conn = self._peers.get(addr)
+        if conn is not None and conn.is_reopened_by(data):
+            self._drop(conn, proto.PeerDisconnected("Peer has reconnected"))
+        elif conn is not None:
+            conn._last_seen = time.monotonic()
+            return conn
+
+        action = classify_opening(data)
+        if action == PEER_RESET:
+            self._sendto_addr(HEADER.pack(0, 0, 0, FLAG_RST, 0), addr)
+        if action != PEER_OPEN or len(self._peers) >= MAX_PEERS:
+            return None
+
+        conn = ReliableUDP(self._congestion, fec=self._fec, parent=self)
+        conn._addr = addr
+        self._peers[addr] = conn
+        self._backlog.append(conn)
+        return conn
+
+    def _sendto_addr(self, dgram: bytes, addr: tuple[str, int]):
+        try:
+            self.sock.sendto(dgram, addr)
         except BlockingIOError:
             pass
-        cur_time = time.monotonic() * 1000
-
-        for sn in list(self._send_buffer):
-            dgram = self._send_buffer[sn]
-
-            if self._window_size > 0:
-                dgram.in_flight = True
-                self._window_size -= 1
-
-            if dgram.in_flight and cur_time - dgram.send_time > RTO:
-                header = struct.pack("!II", sn, self._an)
-                self.sock.sendto(header + dgram.payload, self._addr)
-                dgram.send_time = cur_time
-                if self._need_to_ack:
-                    self._need_to_ack = False
-
-        if self._need_to_ack and cur_time - self._tda > DELAY_ACK:
-            header = struct.pack("!II", self._sn, self._an)
-            self.sock.sendto(header, self._addr)
-            self._need_to_ack = False
-
-    def _handle_dgram(self, dgram: bytes):
-        header, payload = dgram[:HEADER_SIZE], dgram[HEADER_SIZE:]
-        sn, an = struct.unpack("!II", header)
-
-        if payload and sn <= self._an:
-            if not self._need_to_ack:
-                self._need_to_ack = True
-                self._tda = time.monotonic() * 1000
-            if sn == self._an:
-                self._recv_buffer[sn] = payload
-                self._an += 1
-
-        if len(self._send_buffer) != 0:
-            for i in range(self._sn, an):
-                self._send_buffer.pop(i)
-            self._window_size = self._window_size + an - self._sn
-            self._sn = an
+        except OSError as e:
+            if e.errno not in (errno.ENETUNREACH, errno.EHOSTUNREACH):
+                raise
+
+    def _send_probe(self, probe: bytes, cur_time: float):
+        try:
+            self.sock.sendto(probe, self._addr)
+        except BlockingIOError:
+            pass
+        except OSError as e:
+            if e.errno != errno.EMSGSIZE:
+                raise
+            self._pmtu.on_probe_too_big(cur_time)
+
+    def _flush(self):
+        outbox, self._outbox = self._outbox, []
+        i = 0
+        while i < len(outbox):
+            j = self._gso_run(outbox, i) if self._gso else i + 1
+            if j - i == 1:
+                self._sendto(outbox[i][1])
+            elif not self._send_segments(outbox[i:j]):
+                self._gso = False
+                continue
+            i = j
+
+    def _gso_run(self, outbox: list[tuple[int, Frame]], i: int) -> int:
+        size = outbox[i][0]
+        limit = min(len(outbox), i + GSO_MAX_SEGMENTS, i + GSO_MAX_SIZE // size)
+        j = i + 1
+        while j < limit and outbox[j][0] == size:
+            j += 1
+        if j < limit and outbox[j][0] < size:
+            j += 1
+        return j
+
+    def _send_segments(self, segments: list[tuple[int, Frame]]) -> bool:
+        cmsg = [(SOL_UDP, UDP_SEGMENT, struct.pack("H", segments[0][0]))]
+        buffers = [buf for _, frame in segments for buf in frame]
+        try:
+            self.sock.sendmsg(buffers, cmsg, 0, self._addr)
+        except (BlockingIOError, InterruptedError):
+            pass
+        except OSError as e:
+            if e.errno in (errno.EIO, errno.EINVAL, errno.EOPNOTSUPP):
+                return False
+            if e.errno not in (errno.ENETUNREACH, errno.EHOSTUNREACH, errno.ENOBUFS):
+                raise
+        return True
+
+    def _sendto(self, frame: Frame):
+        try:
+            if len(frame) == 1:
+                self.sock.sendto(frame[0], self._addr)
+            elif hasattr(self.sock, "sendmsg"):
+                self.sock.sendmsg(frame, [], 0, self._addr)
+            else:
+                self.sock.sendto(b"".join(frame), self._addr)
+        except BlockingIOError:
+            pass
+        except OSError as e:
+            if e.errno not in (errno.ENETUNREACH, errno.EHOSTUNREACH):
+                raise
 
     def reset(self):
-        self._sn = 0
-        self._an = 0
-        self._need_to_ack = False
-        self._send_buffer.clear()
-        self._recv_buffer.clear()
-        self._window_size = MAX_WINDOW_SIZE
+        self._reset(time.monotonic())
 
     def close(self):
+        with self._cond:
+            if not self._closed and self._backlog is None and self._addr[1]:
+                try:
+                    self._sendto_addr(HEADER.pack(0, 0, 0, FLAG_RST, 0), self._addr)
+                except OSError:
+                    pass
+            self._closed = True
+            self._cond.notify_all()
+            if self._root is not self:
+                if self._root._peers.get(self._addr) is self:
+                    del self._root._peers[self._addr]
+                return
+        self._wakeup()
+        if self._thread is not threading.current_thread():
+            self._thread.join()
+        self._selector.close()
+        self._wakeup_recv.close()
+        self._wakeup_send.close()
         self.sock.close()
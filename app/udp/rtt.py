@@ -0,0 +1,49 @@
+ALPHA = 1 / 8
+BETA = 1 / 4
+K = 4
+GRANULARITY = 0.001
+
+INITIAL_RTO = 1.0
+MIN_RTO = 0.01
+MAX_RTO = 5.0
+
+INITIAL_ACK_DELAY = 0.005
+MIN_ACK_DELAY = 0.001
+MAX_ACK_DELAY = 0.025
+
+
+class RTTEstimator:
+    def __init__(self):
+        self.srtt: float | None = None
+        self.min_rtt: float | None = None
+        self.rttvar = 0.0
+        self.rto = INITIAL_RTO
+        self.backoff = 1
+
+    def sample(self, rtt: float):
+        if self.min_rtt is None or rtt < self.min_rtt:
+            self.min_rtt = rtt
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = (1 - BETA) * self.rttvar + BETA * abs(self.srtt - rtt)
+            self.srtt = (1 - ALPHA) * self.srtt + ALPHA * rtt
+
+        self.backoff = 1
+        self.rto = self._clamp(
+            self.srtt + max(GRANULARITY, K * self.rttvar) + self.ack_delay
+        )
+
+    def on_timeout(self):
+        self.backoff = min(self.backoff * 2, 64)
+        self.rto = self._clamp(self.rto * 2)
+
+    @property
+    def ack_delay(self) -> float:
+        if self.srtt is None:
+            return INITIAL_ACK_DELAY
+        return min(MAX_ACK_DELAY, max(MIN_ACK_DELAY, self.srtt / 4))
+
+    def _clamp(self, rto: float) -> float:
+        return min(MAX_RTO, max(MIN_RTO, rto))
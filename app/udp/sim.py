@@ -0,0 +1,280 @@
+import heapq
+import itertools
+import json
+import math
+import random
+import sys
+import time
+from collections.abc import Callable
+
+from app.udp.congestion import CONGESTION_CONTROLS
+from app.udp.core import CONGESTION_CONTROL, PAYLOAD_SIZE, USE_FEC, ReliableUDPCore
+
+LINK_MTU = 1472
+TIMER_GRANULARITY = 1e-6
+TIME_LIMIT = 600.0
+
+BANDWIDTHS = (1.25e6, 12.5e6, 125e6)
+RTTS = (0.001, 0.02, 0.1)
+LOSSES = (0.0, 0.001, 0.01, 0.05)
+REORDERS = (0.0, 0.01)
+TRANSFER_SIZE = 1 << 20
+ECHO_ROUNDS = 100
+
+
+class Simulator:
+    def __init__(self):
+        self.now = 0.0
+        self._events: list[tuple[float, int, Callable, tuple]] = []
+        self._seq = itertools.count()
+
+    def schedule(self, at: float, callback: Callable, *args):
+        heapq.heappush(self._events, (at, next(self._seq), callback, args))
+
+    def run(self, until: float = math.inf, stop: Callable[[], bool] = lambda: False):
+        while self._events and not stop():
+            at, _, callback, args = self._events[0]
+            if at > until:
+                break
+            heapq.heappop(self._events)
+            self.now = at
+            callback(*args)
+
+
+class Link:
+    def __init__(
+        self,
+        sim: Simulator,
+        bandwidth: float,
+        delay: float,
+        loss: float = 0.0,
+        reorder: float = 0.0,
+        jitter: float = 0.0,
+        queue_size: int | None = None,
+        mtu: int = LINK_MTU,
+        rng: random.Random | None = None,
+    ):
+        self.sim = sim
+        self.bandwidth = bandwidth
+        self.delay = delay
+        self.loss = loss
+        self.reorder = reorder
+        self.jitter = jitter
+        self.queue_size = queue_size or max(64 * LINK_MTU, int(bandwidth * delay * 2))
+        self.mtu = mtu
+        self.rng = rng or random.Random()
+        self.busy_until = 0.0
+        self.sent = 0
+        self.dropped = 0
+
+    def send(self, data: bytes, deliver: Callable[[bytes], None]):
+        now = self.sim.now
+        self.sent += 1
+        if len(data) > self.mtu:
+            self.dropped += 1
+            return
+
+        start = max(now, self.busy_until)
+        if (start - now) * self.bandwidth > self.queue_size:
+            self.dropped += 1
+            return
+        self.busy_until = start + len(data) / self.bandwidth
+        if self.rng.random() < self.loss:
+            self.dropped += 1
+            return
+
+        arrival = self.busy_until + self.delay
+        if self.jitter:
+            arrival += self.rng.uniform(0, self.jitter)
+        if self.rng.random() < self.reorder:
+            arrival += self.delay
+        self.sim.schedule(arrival, deliver, data)
+
+
+class Endpoint:
+    def __init__(self, sim: Simulator, core: ReliableUDPCore, link: Link):
+        self.sim = sim
+        self.core = core
+        self.link = link
+        self.peer: Endpoint | None = None
+        self.on_data: Callable[["Endpoint"], None] | None = None
+        self._pending: list[memoryview] = []
+        self._timer_at: float | None = None
+
+    def write(self, data: bytes | memoryview):
+        self._pending.append(memoryview(data).cast("B"))
+        self.service()
+
+    def read(self, n: int) -> bytes:
+        return b"".join(self.core.pop(n))
+
+    def deliver(self, data: bytes):
+        self.core.receive_datagram(data, self.sim.now)
+        if self.on_data is not None:
+            self.on_data(self)
+        self.service()
+
+    def service(self):
+        now = self.sim.now
+        while self._pending and self.core._send.free():
+            view = self._pending[0]
+            pushed = self.core.push(view)
+            if pushed == len(view):
+                self._pending.pop(0)
+            else:
+                self._pending[0] = view[pushed:]
+
+        for _, frame in self.core.poll(now):
+            self.link.send(b"".join(frame), self.peer.deliver)
+
+        deadline = self.core.next_deadline()
+        if deadline is None:
+            return
+        deadline = max(deadline, now + TIMER_GRANULARITY)
+        if self._timer_at is None or deadline < self._timer_at:
+            self._timer_at = deadline
+            self.sim.schedule(deadline, self._on_timer, deadline)
+
+    def _on_timer(self, at: float):
+        if at != self._timer_at:
+            return
+        self._timer_at = None
+        self.service()
+
+
+def connect(
+    sim: Simulator,
+    bandwidth: float,
+    rtt: float,
+    loss: float = 0.0,
+    reorder: float = 0.0,
+    jitter: float = 0.0,
+    congestion: str = CONGESTION_CONTROL,
+    fec: bool = USE_FEC,
+    seed: int = 0,
+) -> tuple[Endpoint, Endpoint]:
+    rng = random.Random(seed)
+    links = [
+        Link(sim, bandwidth, rtt / 2, loss, reorder, jitter, rng=rng) for _ in range(2)
+    ]
+    a = Endpoint(sim, ReliableUDPCore(congestion, fec), links[0])
+    b = Endpoint(sim, ReliableUDPCore(congestion, fec), links[1])
+    a.peer = b
+    b.peer = a
+    return a, b
+
+
+def simulate_transfer(size: int = TRANSFER_SIZE, **scenario) -> dict:
+    sim = Simulator()
+    sender, receiver = connect(sim, **scenario)
+    received = 0
+    first_byte = None
+
+    def on_data(endpoint: Endpoint):
+        nonlocal received, first_byte
+        n = endpoint.core.available()
+        if n:
+            received += len(endpoint.read(n))
+            if first_byte is None:
+                first_byte = sim.now
+
+    receiver.on_data = on_data
+    sender.write(bytes(size))
+    sim.run(TIME_LIMIT, lambda: received >= size)
+
+    elapsed = sim.now
+    return {
+        "size": size,
+        "completed": received >= size,
+        "time": elapsed,
+        "ttfb": first_byte,
+        "goodput": received / elapsed if elapsed else 0.0,
+        "datagrams": sender.link.sent,
+        "dropped": sender.link.dropped + receiver.link.dropped,
+        "overhead": sender.link.sent * PAYLOAD_SIZE / size - 1 if size else 0.0,
+        **sender.core.stats,
+        "fec_recovered": receiver.core.stats["fec_recovered"],
+    }
+
+
+def simulate_echo(rounds: int = ECHO_ROUNDS, size: int = 64, **scenario) -> dict:
+    sim = Simulator()
+    client, server = connect(sim, **scenario)
+    units = math.ceil(size / PAYLOAD_SIZE)
+    samples = []
+    sent_at = 0.0
+
+    def on_request(endpoint: Endpoint):
+        while endpoint.core.available() >= units:
+            endpoint.write(endpoint.read(units))
+
+    def on_reply(endpoint: Endpoint):
+        nonlocal sent_at
+        while endpoint.core.available() >= units:
+            endpoint.read(units)
+            samples.append(sim.now - sent_at)
+            if len(samples) < rounds:
+                sent_at = sim.now
+                endpoint.write(bytes(size))
+
+    server.on_data = on_request
+    client.on_data = on_reply
+    client.write(bytes(size))
+    sim.run(TIME_LIMIT, lambda: len(samples) >= rounds)
+
+    samples.sort()
+    return {
+        "rounds": len(samples),
+        "completed": len(samples) >= rounds,
+        "p50": percentile(samples, 0.5),
+        "p90": percentile(samples, 0.9),
+        "p99": percentile(samples, 0.99),
+    }
+
+
+def percentile(samples: list[float], q: float) -> float | None:
+    if not samples:
+        return None
+    return samples[min(len(samples) - 1, int(q * len(samples)))]
+
+
+def scenarios(seeds: int = 1):
+    for congestion in CONGESTION_CONTROLS:
+        for fec in (False, True):
+            for bandwidth, rtt, loss, reorder, seed in itertools.product(
+                BANDWIDTHS, RTTS, LOSSES, REORDERS, range(seeds)
+            ):
+                yield {
+                    "bandwidth": bandwidth,
+                    "rtt": rtt,
+                    "loss": loss,
+                    "reorder": reorder,
+                    "congestion": congestion,
+                    "fec": fec,
+                    "seed": seed,
+                }
+
+
+if __name__ == "__main__":
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else TRANSFER_SIZE
+    seeds = int(sys.argv[2]) if len(sys.argv) > 2 else 1
+
+    start = time.perf_counter()
+    count = 0
+    lossy_fec = 0
+    recovered = 0
+    for scenario in scenarios(seeds):
+        result = {
+            **scenario,
+            "transfer": simulate_transfer(size, **scenario),
+            "echo": simulate_echo(**scenario),
+        }
+        print(json.dumps(result), flush=True)
+        count += 1
+        if scenario["fec"] and scenario["loss"]:
+            lossy_fec += 1
+            recovered += result["transfer"]["fec_recovered"]
+    print(f"{count} scenarios in {time.perf_counter() - start:.1f} s", file=sys.stderr)
+    if lossy_fec and not recovered:
+        print("FEC recovered no datagrams in lossy scenarios", file=sys.stderr)
+        sys.exit(1)
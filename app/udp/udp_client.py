@@ -1,29 +1,26 @@
 import os
 import struct
-import threading
 import time
 
+import app.compression as compression
+import app.dedup as dedup
+import app.delta as delta
+import app.journal as journal
 import app.protocol as proto
 from app.protocol import Command
-from app.udp.reliable_udp import ReliableUDP
+from app.udp.fec import print_fec_stats
+from app.udp.reliable_udp import CHUNK_SIZE, PLACEMENT_SIZE, ReliableUDP
 
 
 class UDPClient:
     def __init__(self, ip: str, port: int):
         self.sock = self.new_socket(ip, port)
-        self.thread = threading.Thread(target=self.worker)
-        self.stop = threading.Event()
-        self.check_event_loop = threading.Event()
-        self.thread.start()
-
-    def worker(self):
-        while not self.stop.is_set():
-            try:
-                if self.check_event_loop.wait(0.1):
-                    self.sock._event_loop_step()
-                    time.sleep(0.005)
-            except OSError:
-                pass
+        self.first_byte_time: float | None = None
+        self.delta = delta.USE_DELTA
+        self.dedup = dedup.USE_DEDUP
+        self.token = journal.load_token()
+        self.compression = compression.COMPRESSION
+        self.compression_level = compression.COMPRESSION_LEVEL
 
     def new_socket(self, ip: str, port: int):
         sock = ReliableUDP()
@@ -31,23 +28,36 @@ class UDPClient:
         sock.set_timeout(30)
         return sock
 
+    def send_token(self):
+        greeting = f"{Command.TOKEN.value} {self.token}".encode()
+        self.sock.set_greeting(greeting)
+        self.sock.send(greeting)
+        self.sock.recv()
+
     def start(self):
         try:
+            self.send_token()
             self.handle_input()
         except (KeyboardInterrupt, proto.ExitException):
             print("\nExiting...")
         finally:
-            self.stop.set()
-            self.thread.join()
+            self.sock.close()
+
+    def run(self, commands: list[str]):
+        try:
+            self.send_token()
+            for message in commands:
+                self.handle_command(message)
+        except proto.ExitException:
+            pass
+        finally:
             self.sock.close()
 
     def handle_input(self):
         while True:
             try:
-                self.check_event_loop.set()
                 message = input("> ")
                 if message:
-                    self.check_event_loop.clear()
                     self.handle_command(message)
             except TimeoutError as e:
                 print("\nError occurred during send or recv data from the server")
@@ -63,6 +73,9 @@ class UDPClient:
         except ValueError:
             cmd = None
 
+        if cmd is Command.COMPRESS:
+            self.set_compression(arg)
+            return
         if cmd is Command.UPLOAD:
             self.upload(arg)
             return
@@ -77,11 +90,23 @@ class UDPClient:
             response = self.sock.recv().decode()
             print(response)
 
+    def set_compression(self, arg: str):
+        try:
+            self.compression, self.compression_level = compression.parse_setting(arg)
+        except ValueError as e:
+            print(f"ERR: {e}")
+            return
+        if self.compression is None:
+            print("Compression disabled")
+        else:
+            print(f"Compression: {self.compression}, level {self.compression_level}")
+
     def download(self, arg: str):
         base_filename = arg.replace("\\", "/").split("/")[-1]
         temp_filename = base_filename + ".part"
 
         data = self.sock.recv()
+        self.first_byte_time = time.time()
         status = data[0]
         msg = data[1:]
 
@@ -95,12 +120,24 @@ class UDPClient:
         if status == proto.STATUS_APPEND:
             try:
                 client_file_size = os.path.getsize(temp_filename)
-                mode = "ab"
+                mode = "r+b"
             except FileNotFoundError:
                 pass
-            self.sock.send(struct.pack("!Q", client_file_size))
 
-        file_size = struct.unpack("!Q", msg)[0]
+        file_size, codecs = struct.unpack("!QB", msg)
+
+        if self.delta and not client_file_size and os.path.isfile(base_filename):
+            self.sock.send(struct.pack("!QBBB", 0, proto.FLAG_DELTA, 0, 0))
+            channel = proto.UDPChannel(self.sock)
+            delta.receive_file(
+                channel, base_filename, temp_filename, base_filename, file_size
+            )
+            return
+
+        codec = compression.choose_codec(self.compression, codecs)
+        self.sock.send(
+            struct.pack("!QBBB", client_file_size, 0, codec, self.compression_level)
+        )
         print(f"Downloading file '{arg}'...")
 
         start_time = time.time()
@@ -110,10 +147,12 @@ class UDPClient:
         last_update = 0
 
         with open(temp_filename, mode) as f:
+            if codec:
+                received = self.recv_compressed(f, received, file_size, codec)
             while received < file_size:
-                chunk = self.sock.recv(min(6960, file_size - received))
-                f.write(chunk)
-                received += len(chunk)
+                received += self.sock.recv_into_file(
+                    f, received, min(PLACEMENT_SIZE, file_size - received)
+                )
 
                 now = time.time()
                 if now - last_update > 1 or received == file_size:
@@ -124,6 +163,7 @@ class UDPClient:
 
         print("\nDone")
         proto.print_data_speed(start_time, received - client_file_size)
+        print_fec_stats(self.sock.stats)
 
     def upload(self, arg: str):
         real_path = os.path.realpath(arg)
@@ -132,18 +172,22 @@ class UDPClient:
             print(f"ERR: File '{arg}' not found")
             return
 
-        self.sock.send(f"UPLOAD {arg}".encode())
-
         file_size = os.path.getsize(real_path)
-        self.sock.send(struct.pack("!Q", file_size))
+        if (self.delta or self.dedup) and self.upload_probe(arg, real_path, file_size):
+            return
+
+        self.sock.send(f"UPLOAD {arg}".encode())
+        codec = compression.CODECS.get(self.compression or "", 0)
+        mtime = os.stat(real_path).st_mtime_ns
+        self.sock.send(struct.pack("!QQBB", file_size, mtime, 0, codec))
 
         data = self.sock.recv()
         status = data[0]
-        msg = data[1:]
+        server_file_size, _, codec = struct.unpack("!QBB", data[1:])
 
         seek = 0
         if status == proto.STATUS_APPEND:
-            seek = struct.unpack("!Q", msg)[0]
+            seek = server_file_size
 
         print(f"Uploading file '{arg}'...")
 
@@ -154,9 +198,11 @@ class UDPClient:
         last_update = 0
 
         with open(real_path, "rb") as f:
+            if codec:
+                sent = self.send_compressed(f, sent, file_size, codec)
             f.seek(sent)
-            while chunk := f.read(6960):
-                self.sock.send(chunk)
+            while chunk := f.read(CHUNK_SIZE):
+                self.sock.write(chunk)
                 sent += len(chunk)
 
                 now = time.time()
@@ -164,5 +210,65 @@ class UDPClient:
                     proto.print_transfer_status(sent, file_size)
                     last_update = now
 
+            self.sock.flush()
+
         print("\nDone")
         proto.print_data_speed(start_time, sent - seek)
+        print_fec_stats(self.sock.stats)
+
+    def send_compressed(self, f, sent: int, end: int, codec: int) -> int:
+        start = sent
+        wire = 0
+        last_update = 0
+
+        def progress(raw: int, size: int):
+            nonlocal sent, wire, last_update
+            sent += raw
+            wire += size
+            now = time.time()
+            if now - last_update > 1 or sent == end:
+                proto.print_transfer_status(sent, end)
+                last_update = now
+
+        channel = proto.UDPChannel(self.sock)
+        compression.send_file(
+            channel, f, sent, end, codec, self.compression_level, progress
+        )
+        compression.print_ratio(sent - start, wire)
+        return sent
+
+    def recv_compressed(self, f, received: int, end: int, codec: int) -> int:
+        start = received
+        wire = 0
+        last_update = 0
+
+        def progress(raw: int, size: int):
+            nonlocal received, wire, last_update
+            received += raw
+            wire += size
+            now = time.time()
+            if now - last_update > 1 or received == end:
+                proto.print_transfer_status(received, end)
+                last_update = now
+
+        channel = proto.UDPChannel(self.sock)
+        compression.recv_file(channel, f, received, end, codec, progress)
+        compression.print_ratio(received - start, wire)
+        return received
+
+    def upload_probe(self, arg: str, real_path: str, file_size: int) -> bool:
+        flags = proto.FLAG_DELTA if self.delta else 0
+        if self.dedup:
+            flags |= proto.FLAG_DEDUP
+        self.sock.send(f"UPLOAD {arg}".encode())
+        mtime = os.stat(real_path).st_mtime_ns
+        self.sock.send(struct.pack("!QQBB", file_size, mtime, flags, 0))
+        data = self.sock.recv()
+        _, flags, _ = struct.unpack("!QBB", data[1:])
+        channel = proto.UDPChannel(self.sock)
+        if flags & proto.FLAG_DELTA:
+            delta.send_file(channel, real_path, arg)
+            return True
+        if flags & proto.FLAG_DEDUP:
+            return dedup.send_file(channel, real_path, arg)
+        return False
@@ -1,63 +1,109 @@
 import datetime
 import os
 import struct
+import threading
 import time
+from collections.abc import Callable
 
+import app.compression as compression
+import app.dedup as dedup
+import app.delta as delta
+import app.journal as journal
 import app.protocol as proto
 from app.protocol import Command
-from app.udp.reliable_udp import ReliableUDP
+from app.ratelimit import ClientBuckets, TokenBucket, new_bucket, throttle
+from app.udp.fec import print_fec_stats
+from app.udp.reliable_udp import CHUNK_SIZE, PLACEMENT_SIZE, ReliableUDP
+
+
+class UDPConnection:
+    def __init__(
+        self,
+        sock: ReliableUDP,
+        addr: tuple[str, int],
+        token: str,
+        bucket: TokenBucket | None = None,
+    ):
+        self.sock = sock
+        self.addr = addr
+        self.token = token
+        self.bucket = bucket
 
 
 class UDPServer:
-    def __init__(self, ip: str, port: int, base_dir: str):
+    def __init__(
+        self,
+        ip: str,
+        port: int,
+        base_dir: str,
+        client_rate: float | None = None,
+        total_rate: float | None = None,
+    ):
         self.server_sock = self.new_socket(ip, port)
         self.base_dir = base_dir
-        self.session = {"cmd": Command.DOWNLOAD, "filename": "", "client_ip": ""}
+        self.client_rate = client_rate
+        self.total_bucket = new_bucket(total_rate)
+        self.server_sock.set_bucket(self.total_bucket)
+        self.buckets = ClientBuckets(client_rate)
+        self.store = dedup.ChunkStore(base_dir)
+        self.store.gc()
+        self.journal = journal.Journal(base_dir)
         print(f"Server is listening on {ip}:{port}")
 
     def new_socket(self, ip: str, port: int) -> ReliableUDP:
         sock = ReliableUDP()
         sock.bind((ip, port))
+        sock.listen()
         return sock
 
     def start(self):
         try:
             while True:
-                try:
-                    msg, addr = self.server_sock.recvfrom()
-                except proto.PeerChangedException:
-                    continue
-
+                client_sock, addr = self.server_sock.accept()
                 ip, port = addr
-                msg = msg.decode()
-
-                if ip != self.session["client_ip"]:
-                    if os.path.exists(self.session["filename"] + ".part"):
-                        os.remove(self.session["filename"] + ".part")
-                    self.session["filename"] = ""
-                    self.session["client_ip"] = ip
-
-                time = datetime.datetime.now().strftime("%H:%M:%S")
-                print(f"[{time}] Received message from the client {ip}:{port}: {msg}")
-
-                try:
-                    self.server_sock.set_timeout(30)
-                    self.handle_command(msg)
-                except TimeoutError as e:
-                    print(
-                        f"\nError occurred during send or recv data from the client {ip}:{port}"
-                    )
-                    print(f"Details: {e}")
-                except proto.PeerChangedException:
-                    pass
-                finally:
-                    self.server_sock.set_timeout(None)
+                print(f"Client {ip}:{port} connected")
+
+                bucket = self.buckets.acquire(ip)
+                client_sock.set_bucket(bucket)
+                conn = UDPConnection(client_sock, addr, ip, bucket)
+                threading.Thread(target=self.serve, args=(conn,), daemon=True).start()
         except KeyboardInterrupt:
             print("\nServer is shutting down...")
         finally:
             self.server_sock.close()
 
-    def handle_command(self, message: str):
+    def serve(self, conn: UDPConnection):
+        ip, port = conn.addr
+        try:
+            while True:
+                self.handle_client(conn)
+        except ConnectionError:
+            print(f"Client {ip}:{port} disconnected")
+        except OSError:
+            pass
+        finally:
+            self.buckets.release(ip)
+            conn.sock.close()
+
+    def handle_client(self, conn: UDPConnection):
+        msg = conn.sock.recv().decode()
+        ip, port = conn.addr
+
+        time = datetime.datetime.now().strftime("%H:%M:%S")
+        print(f"[{time}] Received message from the client {ip}:{port}: {msg}")
+
+        try:
+            conn.sock.set_timeout(30)
+            self.handle_command(conn, msg)
+        except TimeoutError as e:
+            print(
+                f"\nError occurred during send or recv data from the client {ip}:{port}"
+            )
+            print(f"Details: {e}")
+        finally:
+            conn.sock.set_timeout(None)
+
+    def handle_command(self, conn: UDPConnection, message: str):
         parts = message.strip().split(maxsplit=1)
         cmd = parts[0].upper()
         arg = parts[1] if len(parts) > 1 else ""
@@ -65,49 +111,66 @@ class UDPServer:
         try:
             cmd = Command(cmd)
         except ValueError:
-            self.server_sock.send(f"ERR: Unknown command: {parts[0]}".encode())
+            conn.sock.send(f"ERR: Unknown command: {parts[0]}".encode())
             return
 
         if cmd is Command.ECHO:
             answ = arg.encode()
-            self.server_sock.send(answ if len(answ) != 0 else b" ")
+            conn.sock.send(answ if len(answ) != 0 else b" ")
         elif cmd is Command.TIME:
             time = datetime.datetime.now().strftime("%H:%M:%S")
-            self.server_sock.send(time.encode())
+            conn.sock.send(time.encode())
         elif cmd is Command.DOWNLOAD:
-            self.download(arg)
+            self.download(conn, arg)
         elif cmd is Command.UPLOAD:
-            self.upload(arg)
-
-    def download(self, arg: str):
+            self.upload(conn, arg)
+        elif cmd is Command.TOKEN:
+            if journal.valid_token(arg):
+                conn.token = arg
+                conn.sock.send(b"OK")
+            else:
+                conn.sock.send(b"ERR: Invalid token")
+
+    def download(self, conn: UDPConnection, arg: str):
         file_path = os.path.join(self.base_dir, arg)
         real_path = os.path.realpath(file_path)
 
-        if not real_path.startswith(os.path.realpath(self.base_dir)):
+        if (
+            not real_path.startswith(os.path.realpath(self.base_dir))
+            or self.store.contains(real_path)
+            or self.journal.contains(real_path)
+        ):
             msg = bytes([proto.STATUS_ERR]) + b"ERR: Access denied"
-            self.server_sock.send(msg)
+            conn.sock.send(msg)
             return
 
         if not os.path.isfile(real_path):
             msg = bytes([proto.STATUS_ERR]) + f"ERR: File '{arg}' not found".encode()
-            self.server_sock.send(msg)
+            conn.sock.send(msg)
             return
 
         seek = 0
-        file_size = os.path.getsize(real_path)
-        msg = bytearray([proto.STATUS_OK]) + struct.pack("!Q", file_size)
-
-        if (
-            self.session["cmd"] == Command.DOWNLOAD
-            and self.session["filename"] == real_path
-        ):
+        stat = os.stat(real_path)
+        file_size = stat.st_size
+        msg = bytearray([proto.STATUS_OK]) + struct.pack(
+            "!QB", file_size, compression.supported_mask()
+        )
+
+        transfer, resumed = self.journal.open(
+            conn.token, journal.KIND_DOWNLOAD, real_path, file_size, stat.st_mtime_ns
+        )
+        if resumed:
             msg[0] = proto.STATUS_APPEND
 
-        self.server_sock.send(msg)
+        conn.sock.send(msg)
 
+        offset, flags, codec, level = struct.unpack("!QBBB", conn.sock.recv())
+        if flags & proto.FLAG_DELTA:
+            delta.send_file(proto.UDPChannel(conn.sock), real_path, arg)
+            self.journal.finish(transfer)
+            return
         if msg[0] == proto.STATUS_APPEND:
-            client_raw_file_size = self.server_sock.recv()
-            seek = struct.unpack("!Q", client_raw_file_size)[0]
+            seek = min(offset, file_size)
 
         print(f"Sending file '{arg}'...")
 
@@ -115,15 +178,15 @@ class UDPServer:
         sent = seek
         proto.print_transfer_status(sent, file_size)
 
-        self.session["cmd"] = Command.DOWNLOAD
-        self.session["filename"] = real_path
-
         last_update = 0
 
         with open(real_path, "rb") as f:
-            f.seek(seek)
-            while chunk := f.read(6960):
-                self.server_sock.send(chunk)
+            codec = compression.accept_codec(codec)
+            if codec != compression.CODEC_NONE:
+                sent = self.send_compressed(conn, f, seek, file_size, codec, level)
+            f.seek(sent)
+            while chunk := f.read(CHUNK_SIZE):
+                conn.sock.write(chunk)
                 sent += len(chunk)
 
                 now = time.time()
@@ -131,33 +194,114 @@ class UDPServer:
                     proto.print_transfer_status(sent, file_size)
                     last_update = now
 
+            conn.sock.flush()
+
+        if sent == file_size:
+            self.journal.finish(transfer)
         print("\nDone")
         proto.print_data_speed(start_time, sent - seek)
+        print_fec_stats(conn.sock.stats)
+
+    def send_compressed(
+        self, conn: UDPConnection, f, seek: int, end: int, codec: int, level: int
+    ) -> int:
+        sent = seek
+        wire = 0
+        last_update = 0
 
-    def upload(self, arg: str):
+        def progress(raw: int, size: int):
+            nonlocal sent, wire, last_update
+            sent += raw
+            wire += size
+            now = time.time()
+            if now - last_update > 1 or sent == end:
+                proto.print_transfer_status(sent, end)
+                last_update = now
+
+        channel = proto.UDPChannel(conn.sock)
+        compression.send_file(channel, f, seek, end, codec, level, progress)
+        compression.print_ratio(sent - seek, wire)
+        return sent
+
+    def recv_compressed(
+        self,
+        conn: UDPConnection,
+        f,
+        received: int,
+        end: int,
+        codec: int,
+        sink: Callable[[int, bytes], None],
+    ) -> int:
+        start = received
+        wire = 0
+        last_update = 0
+
+        def progress(raw: int, size: int):
+            nonlocal received, wire, last_update
+            throttle([conn.bucket, self.total_bucket], size)
+            received += raw
+            wire += size
+            now = time.time()
+            if now - last_update > 1 or received == end:
+                proto.print_transfer_status(received, end)
+                last_update = now
+
+        channel = proto.UDPChannel(conn.sock)
+        compression.recv_file(channel, f, received, end, codec, progress, sink)
+        compression.print_ratio(received - start, wire)
+        return received
+
+    def upload(self, conn: UDPConnection, arg: str):
         base_filename = arg.replace("\\", "/").split("/")[-1]
         temp_filename = base_filename + ".part"
         file_path = os.path.join(self.base_dir, temp_filename)
 
-        raw_file_size = self.server_sock.recv()
-        file_size = struct.unpack("!Q", raw_file_size)[0]
+        file_size, mtime, flags, codec = struct.unpack("!QQBB", conn.sock.recv())
 
-        mode = "wb"
-        server_file_size = 0
-        msg = bytearray([proto.STATUS_OK])
+        final_path = file_path.removesuffix(".part")
+        if flags & (proto.FLAG_DELTA | proto.FLAG_DEDUP):
+            accepted = 0
+            if flags & proto.FLAG_DELTA and os.path.isfile(final_path):
+                accepted = proto.FLAG_DELTA
+            elif flags & proto.FLAG_DEDUP and file_size:
+                accepted = proto.FLAG_DEDUP
+            conn.sock.send(
+                bytes([proto.STATUS_OK]) + struct.pack("!QBB", 0, accepted, 0)
+            )
+            channel = proto.UDPChannel(conn.sock)
+            if accepted == proto.FLAG_DELTA:
+                digests = dedup.ChunkDigests(file_size)
+                if delta.receive_file(
+                    channel,
+                    final_path,
+                    file_path,
+                    final_path,
+                    file_size,
+                    lambda n: throttle([conn.bucket, self.total_bucket], n),
+                    digests.update,
+                ):
+                    self.store.add(base_filename, final_path, digests.digests)
+            elif accepted == proto.FLAG_DEDUP:
+                dedup.receive_file(
+                    channel,
+                    self.store,
+                    base_filename,
+                    file_path,
+                    final_path,
+                    file_size,
+                    lambda n: throttle([conn.bucket, self.total_bucket], n),
+                )
+            return
 
-        if (
-            self.session["cmd"] == Command.UPLOAD
-            and self.session["filename"] == base_filename
-        ):
-            try:
-                server_file_size = os.path.getsize(file_path)
-                mode = "ab"
-                msg[0] = proto.STATUS_APPEND
-                msg[1:] = struct.pack("!Q", server_file_size)
-            except FileNotFoundError:
-                pass
-        self.server_sock.send(msg)
+        transfer, _ = self.journal.open(
+            conn.token, journal.KIND_UPLOAD, base_filename, file_size, mtime
+        )
+        server_file_size = transfer.resume_offset(0, file_size)
+        msg = bytearray([proto.STATUS_APPEND if server_file_size else proto.STATUS_OK])
+
+        codec = compression.accept_codec(codec)
+        msg += struct.pack("!QBB", server_file_size, 0, codec)
+        conn.sock.send(msg)
 
         print(f"Receiving file '{base_filename}'...")
 
@@ -165,24 +309,46 @@ class UDPServer:
         received = server_file_size
         proto.print_transfer_status(received, file_size)
 
-        self.session["cmd"] = Command.UPLOAD
-        self.session["filename"] = base_filename
-
         last_update = 0
 
-        with open(file_path, mode) as f:
-            while received < file_size:
-                chunk = self.server_sock.recv(min(6960, file_size - received))
-                f.write(chunk)
-                received += len(chunk)
-
-                now = time.time()
-                if now - last_update > 1 or received == file_size:
-                    proto.print_transfer_status(received, file_size)
-                    last_update = now
-
-        final_path = file_path.removesuffix(".part")
-        os.replace(file_path, final_path)
+        def sink(pos: int, data: bytes):
+            nonlocal received, last_update
+            transfer.digests.update(pos, data)
+            received = pos + len(data)
+            now = time.time()
+            if now - last_update > 1:
+                f.flush()
+                transfer.checkpoint(f.fileno(), server_file_size, received)
+                last_update = now
+
+        with open(transfer.part_path, "r+b") as f:
+            try:
+                if codec != compression.CODEC_NONE:
+                    self.recv_compressed(conn, f, received, file_size, codec, sink)
+                while received < file_size:
+                    n = conn.sock.recv_into_file(
+                        f, received, min(PLACEMENT_SIZE, file_size - received)
+                    )
+                    if hasattr(os, "pread"):
+                        data = os.pread(f.fileno(), n, received)
+                        transfer.digests.update(received, data)
+                    received += n
+                    throttle([conn.bucket, self.total_bucket], n)
+
+                    now = time.time()
+                    if now - last_update > 1 or received == file_size:
+                        proto.print_transfer_status(received, file_size)
+                        f.flush()
+                        transfer.checkpoint(f.fileno(), server_file_size, received)
+                        last_update = now
+            except BaseException:
+                f.flush()
+                transfer.checkpoint(f.fileno(), server_file_size, received)
+                raise
+
+        if self.journal.commit(transfer, final_path):
+            self.store.add(base_filename, final_path, transfer.digests.digests)
 
         print("\nDone")
         proto.print_data_speed(start_time, received - server_file_size)
+        print_fec_stats(conn.sock.stats)
@@ -0,0 +1,163 @@
+import bisect
+from array import array
+from collections.abc import Callable
+
+IN_FLIGHT = 1
+SACKED = 2
+LOST = 4
+
+IN_ORDER = 0
+OUT_OF_ORDER = 1
+DUPLICATE = 2
+
+PLACED = b""
+
+
+class SendWindow:
+    __slots__ = (
+        "capacity",
+        "mask",
+        "base",
+        "next_new",
+        "end",
+        "payloads",
+        "send_times",
+        "txs",
+        "transmissions",
+        "flags",
+    )
+
+    def __init__(self, capacity: int):
+        if capacity & (capacity - 1):
+            raise ValueError("Window capacity must be a power of two")
+        self.capacity = capacity
+        self.mask = capacity - 1
+        self.base = 0
+        self.next_new = 0
+        self.end = 0
+        self.payloads: list[memoryview | None] = [None] * capacity
+        self.send_times = array("d", bytes(8 * capacity))
+        self.txs = array("Q", bytes(8 * capacity))
+        self.transmissions = array("H", bytes(2 * capacity))
+        self.flags = bytearray(capacity)
+
+    def __len__(self) -> int:
+        return self.end - self.base
+
+    def free(self) -> int:
+        return self.capacity - (self.end - self.base)
+
+    def contains(self, sn: int) -> bool:
+        return self.base <= sn < self.next_new
+
+    def push(self, payload: memoryview):
+        i = self.end & self.mask
+        self.payloads[i] = payload
+        self.send_times[i] = 0.0
+        self.txs[i] = 0
+        self.transmissions[i] = 0
+        self.flags[i] = 0
+        self.end += 1
+
+    def release(self, sn: int):
+        self.payloads[sn & self.mask] = None
+
+
+class RecvWindow:
+    __slots__ = (
+        "capacity",
+        "mask",
+        "read",
+        "ack",
+        "payloads",
+        "ranges",
+        "sink",
+        "sink_end",
+        "placed",
+    )
+
+    def __init__(self, capacity: int):
+        if capacity & (capacity - 1):
+            raise ValueError("Window capacity must be a power of two")
+        self.capacity = capacity
+        self.mask = capacity - 1
+        self.read = 0
+        self.ack = 0
+        self.payloads: list[bytes | None] = [None] * capacity
+        self.ranges: list[list[int]] = []
+        self.sink: Callable[[int, bytes], None] | None = None
+        self.sink_end = 0
+        self.placed = 0
+
+    def available(self) -> int:
+        return self.ack - self.read
+
+    def accept(self, sn: int, payload: bytes) -> int:
+        if sn < self.ack or sn >= self.read + self.capacity:
+            return DUPLICATE
+
+        i = sn & self.mask
+        if sn == self.ack:
+            self.payloads[i] = self._store(sn, payload)
+            self.ack += 1
+            if self.ranges and self.ranges[0][0] == self.ack:
+                self.ack = self.ranges.pop(0)[1]
+            return IN_ORDER
+
+        if self.payloads[i] is not None:
+            return DUPLICATE
+
+        self.payloads[i] = self._store(sn, payload)
+        self._add_range(sn)
+        return OUT_OF_ORDER
+
+    def pop(self, n: int) -> list[bytes]:
+        chunks = []
+        for sn in range(self.read, self.read + n):
+            i = sn & self.mask
+            chunks.append(self.payloads[i])
+            self.payloads[i] = None
+        self.read += n
+        return chunks
+
+    def place(self, n: int, sink: Callable[[int, bytes], None]):
+        self.sink = sink
+        self.sink_end = self.read + n
+        self.placed = 0
+        for sn in range(self.read, min(self.sink_end, self.read + self.capacity)):
+            i = sn & self.mask
+            payload = self.payloads[i]
+            if payload is not None and payload is not PLACED:
+                self.payloads[i] = self._store(sn, payload)
+
+    def consume(self, n: int) -> int:
+        for sn in range(self.read, self.read + n):
+            self.payloads[sn & self.mask] = None
+        self.read += n
+        placed = self.placed
+        self.sink = None
+        self.placed = 0
+        return placed
+
+    def _store(self, sn: int, payload: bytes) -> bytes:
+        if self.sink is None or sn >= self.sink_end:
+            return payload
+        self.sink(sn - self.read, payload)
+        self.placed += len(payload)
+        return PLACED
+
+    def sack_blocks(self, limit: int) -> list[list[int]]:
+        return self.ranges[:limit]
+
+    def _add_range(self, sn: int):
+        ranges = self.ranges
+        k = bisect.bisect_right(ranges, sn, key=lambda r: r[0])
+
+        if k > 0 and ranges[k - 1][1] == sn:
+            ranges[k - 1][1] = sn + 1
+            if k < len(ranges) and ranges[k][0] == sn + 1:
+                ranges[k - 1][1] = ranges.pop(k)[1]
+        elif k < len(ranges) and ranges[k][0] == sn + 1:
+            ranges[k][0] = sn
+        else:
+            ranges.insert(k, [sn, sn + 1])